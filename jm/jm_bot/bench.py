@@ -0,0 +1,320 @@
+"""下载→生成→打包→上传 全流程的性能基准
+
+用合成的本子（可设置页数、分辨率、图片格式比例）在本地假镜像站和假OneBot上跑完整流程，
+每个阶段输出吞吐、p50/p95耗时和峰值内存，加 --json 保存结果便于前后对比：
+
+    python bench.py --pages 60 --size 1200x1700 --formats jpg=7,png=2,webp=1 --repeat 5 --json before.json
+
+加 --codec 只测WebSocket热路径上每帧JSON编解码的耗时，对比标准库和orjson（如已安装）：
+
+    python bench.py --codec --frames 50000
+
+下载阶段用多线程经过机器人的全局下载闸门从假镜像站取图，模拟jmcomic的图片下载；
+不解析真实的禁漫页面，所以只衡量闸门、网络和写盘的开销。
+"""
+import argparse
+import asyncio
+import json
+import os
+import timeit
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import ClientSession
+from PIL import Image
+
+# 只用来统计峰值内存，没装时其余指标照常输出
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+import bot
+from fake_servers import FakeMirror, FakeOneBot
+
+
+class PeakRss:
+    """后台线程采样当前进程RSS，记录一个阶段内的峰值；没有安装psutil时峰值记为0"""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.process = psutil.Process() if psutil is not None else None
+        self.peak = 0
+        self.running = False
+        self.thread = None
+
+    def __enter__(self):
+        if self.process is None:
+            return self
+        self.peak = self.process.memory_info().rss
+        self.running = True
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.thread is None:
+            return
+        self.running = False
+        self.thread.join()
+
+    def _sample(self):
+        while self.running:
+            self.peak = max(self.peak, self.process.memory_info().rss)
+            time.sleep(self.interval)
+
+
+def parse_formats(text: str) -> list:
+    formats = []
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        formats.append((name.strip().lower(), float(weight or 1)))
+    return formats
+
+
+def synthetic_page(width: int, height: int, seed: int) -> Image.Image:
+    """带噪声的渐变图，压缩率接近真实漫画扫描页"""
+    rng = random.Random(seed)
+    base = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+    noise = Image.effect_noise((width, height), rng.uniform(20, 60)).convert('RGB')
+    return Image.blend(base, noise, 0.5)
+
+
+def generate_album(album_dir: str, pages: int, size: tuple, formats: list, seed: int = 0) -> int:
+    """在album_dir下生成jmcomic风格的 00001.jpg 这样的页面，返回总字节数"""
+    os.makedirs(album_dir, exist_ok=True)
+    rng = random.Random(seed)
+    names = [name for name, _ in formats]
+    weights = [weight for _, weight in formats]
+    total = 0
+    for page in range(1, pages + 1):
+        fmt = rng.choices(names, weights)[0]
+        path = os.path.join(album_dir, f"{page:05d}.{fmt}")
+        synthetic_page(*size, seed + page).save(path, quality=85)
+        total += os.path.getsize(path)
+    return total
+
+
+def percentile(values: list, pct: float) -> float:
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def bench_codec(frames: int) -> dict:
+    """按每帧微秒数衡量事件帧解码和API调用编码，帧内容和OneBot实际推送的一致"""
+    onebot = FakeOneBot()
+    event = json.dumps(onebot.group_message(10001, 20002, "今天吃什么 /jm 350234"), ensure_ascii=False)
+    call = {"action": "send_group_msg", "params": {"group_id": 10001, "message": "正在发送JM350234，请稍候..."},
+            "echo": "1700000000.123-42"}
+
+    codecs = {"json": (json.loads, lambda obj: json.dumps(obj, ensure_ascii=False, separators=(',', ':')))}
+    if bot.orjson is not None:
+        codecs["orjson"] = (bot.orjson.loads, lambda obj: bot.orjson.dumps(obj).decode('utf-8'))
+    active = "orjson" if bot.json_loads is not json.loads else "json"
+
+    results = {}
+    print(f"\n{'编解码':<10}{'解码(us/帧)':>14}{'编码(us/帧)':>14}")
+    for name, (loads, dumps) in codecs.items():
+        decode = timeit.timeit(lambda: loads(event), number=frames) / frames * 1e6
+        encode = timeit.timeit(lambda: dumps(call), number=frames) / frames * 1e6
+        results[name] = {"decode_us": decode, "encode_us": encode}
+        mark = " *" if name == active else ""
+        print(f"{name:<10}{decode:>14.2f}{encode:>14.2f}{mark}")
+    print(f"\n帧大小 {len(event.encode('utf-8'))} 字节，* 为机器人当前使用的编解码")
+    return results
+
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.size = tuple(int(v) for v in args.size.lower().split('x'))
+        self.formats = parse_formats(args.formats)
+        self.work_dir = tempfile.mkdtemp(prefix="jm_bench_")
+        self.source_dir = os.path.join(self.work_dir, "source")
+        self.results = {}
+        # 日志、状态数据库和下载目录都放在临时目录里，跑完一起删除
+        bot.STORAGE_BACKEND = 'sqlite'
+        bot.init(self.work_dir)
+
+    def record(self, stage: str, seconds: float, items: int, size: int, peak_rss: int):
+        result = self.results.setdefault(stage, {"seconds": [], "items": 0, "bytes": 0, "peak_rss": 0})
+        result["seconds"].append(seconds)
+        result["items"] += items
+        result["bytes"] += size
+        result["peak_rss"] = max(result["peak_rss"], peak_rss)
+
+    def measure(self, stage: str, func, items: int, size_of=None):
+        with PeakRss() as rss:
+            start = time.perf_counter()
+            value = func()
+            seconds = time.perf_counter() - start
+        size = size_of(value) if size_of else 0
+        self.record(stage, seconds, items, size, rss.peak)
+        return value
+
+    async def measure_async(self, stage: str, coro_func, items: int, size: int = 0):
+        with PeakRss() as rss:
+            start = time.perf_counter()
+            value = await coro_func()
+            seconds = time.perf_counter() - start
+        self.record(stage, seconds, items, size, rss.peak)
+        return value
+
+    def download(self, mirror_domain: str, target_dir: str, pages: list) -> int:
+        """多线程从假镜像取图，和jmcomic一样每张图都经过bot.GOVERNOR"""
+        os.makedirs(target_dir, exist_ok=True)
+
+        def fetch(name):
+            url = f"http://{mirror_domain}/media/photos/bench/{name}"
+            with bot.GOVERNOR.slot():
+                try:
+                    resp = urllib.request.urlopen(url)
+                except urllib.error.HTTPError as e:
+                    # 429/5xx同样要交给闸门降速，和jmcomic的图片下载一致
+                    bot.GOVERNOR.record(e.code)
+                    raise
+                with resp:
+                    data = resp.read()
+                    bot.GOVERNOR.record(resp.status)
+                bot.GOVERNOR.consume_bytes(len(data))
+            with open(os.path.join(target_dir, name), 'wb') as f:
+                f.write(data)
+            return len(data)
+
+        with ThreadPoolExecutor(self.args.threads) as pool:
+            return sum(pool.map(fetch, pages))
+
+    async def run(self):
+        args = self.args
+        print(f"生成合成本子: {args.pages}页 {args.size} {args.formats}")
+        source_bytes = generate_album(os.path.join(self.source_dir, "album"), args.pages, self.size, self.formats)
+        pages = sorted(os.listdir(os.path.join(self.source_dir, "album")))
+        print(f"合成本子大小: {source_bytes / 1024 / 1024:.1f}MB")
+
+        mirror = FakeMirror()
+        domain = mirror.add_domain(args.mirror_port, latency=args.mirror_latency)
+        with open(os.path.join(self.source_dir, "album", pages[0]), 'rb') as f:
+            mirror.set_image(f.read())
+        await mirror.start()
+
+        onebot = FakeOneBot(port=args.onebot_port, latency=args.onebot_latency)
+        await onebot.start()
+        session = ClientSession()
+        ws = await session.ws_connect(f"ws://127.0.0.1:{args.onebot_port}")
+        conn = bot.WebSocketConnection("bench", ws)
+        bot.register_connection(conn, onebot.self_id)
+        reader = asyncio.create_task(bot.serve_websocket(ws, conn))
+        loop = asyncio.get_running_loop()
+
+        try:
+            for i in range(args.repeat):
+                run_dir = os.path.join(self.work_dir, f"run{i}")
+                download_dir = os.path.join(run_dir, "download")
+                os.makedirs(run_dir)
+
+                await self.measure_async(
+                    "download",
+                    lambda: loop.run_in_executor(None, self.download, domain, os.path.join(download_dir, "album"), pages),
+                    len(pages), len(mirror.image) * len(pages)
+                )
+                # 下载阶段只取同一张图，后续阶段使用真实的合成页面
+                shutil.rmtree(download_dir)
+                shutil.copytree(self.source_dir, download_dir)
+
+                self.measure(
+                    "render_pdf",
+                    lambda: bot.build_pdf("bench", download_dir, os.path.join(run_dir, "bench.pdf")),
+                    len(pages), lambda p: os.path.getsize(p)
+                )
+                zip_path = self.measure(
+                    "package_zip",
+                    lambda: bot.build_zip("bench", download_dir, os.path.join(run_dir, "bench.zip"), run_dir),
+                    len(pages), lambda p: os.path.getsize(p)
+                )
+                await self.measure_async(
+                    "upload",
+                    lambda: bot.upload_group_file(args.group_id, zip_path, "bench.zip"),
+                    1, os.path.getsize(zip_path)
+                )
+                for _ in range(args.messages):
+                    await self.measure_async(
+                        "message",
+                        lambda: bot.send_group_message(args.group_id, "bench"),
+                        1
+                    )
+                shutil.rmtree(run_dir)
+                print(f"第 {i + 1}/{args.repeat} 轮完成")
+        finally:
+            reader.cancel()
+            await ws.close()
+            await session.close()
+            await onebot.stop()
+            await mirror.stop()
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def report(self) -> dict:
+        summary = {
+            "params": vars(self.args),
+            "python": sys.version.split()[0],
+            "stages": {}
+        }
+        if psutil is None:
+            print("\n未安装psutil，不统计峰值RSS")
+        print(f"\n{'阶段':<12}{'次数':>6}{'p50(ms)':>10}{'p95(ms)':>10}{'条/秒':>10}{'MB/秒':>10}{'峰值RSS(MB)':>14}")
+        for stage, result in self.results.items():
+            seconds = result["seconds"]
+            total = sum(seconds)
+            stats = {
+                "runs": len(seconds),
+                "p50_ms": percentile(seconds, 50) * 1000,
+                "p95_ms": percentile(seconds, 95) * 1000,
+                "items_per_sec": result["items"] / total if total else 0,
+                "mb_per_sec": result["bytes"] / 1024 / 1024 / total if total else 0,
+                "peak_rss_mb": result["peak_rss"] / 1024 / 1024
+            }
+            summary["stages"][stage] = stats
+            print(f"{stage:<12}{stats['runs']:>6}{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}"
+                  f"{stats['items_per_sec']:>10.1f}{stats['mb_per_sec']:>10.2f}{stats['peak_rss_mb']:>14.1f}")
+        return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JM机器人全流程性能基准")
+    parser.add_argument("--pages", type=int, default=40, help="合成本子的页数")
+    parser.add_argument("--size", default="1000x1400", help="页面分辨率，宽x高")
+    parser.add_argument("--formats", default="jpg=8,png=1,webp=1", help="图片格式及比例")
+    parser.add_argument("--repeat", type=int, default=3, help="重复轮数")
+    parser.add_argument("--messages", type=int, default=20, help="每轮测量多少次消息发送")
+    parser.add_argument("--threads", type=int, default=8, help="下载阶段线程数")
+    parser.add_argument("--mirror-port", type=int, default=18090)
+    parser.add_argument("--mirror-latency", type=float, default=0.0, help="假镜像每张图的延迟（秒）")
+    parser.add_argument("--onebot-port", type=int, default=18091)
+    parser.add_argument("--onebot-latency", type=float, default=0.0, help="假OneBot每次调用的回复延迟（秒）")
+    parser.add_argument("--group-id", type=int, default=10001)
+    parser.add_argument("--json", help="把结果保存为JSON文件")
+    parser.add_argument("--codec", action="store_true", help="只测JSON编解码的每帧耗时")
+    parser.add_argument("--frames", type=int, default=20000, help="编解码测试的帧数")
+    args = parser.parse_args()
+
+    if args.codec:
+        summary = {"params": vars(args), "python": sys.version.split()[0], "codec": bench_codec(args.frames)}
+    else:
+        bench = Bench(args)
+        asyncio.run(bench.run())
+        summary = bench.report()
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        print(f"\n结果已保存到 {args.json}")
+
+
+if __name__ == '__main__':
+    main()
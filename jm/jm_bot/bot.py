@@ -23,8 +23,7 @@ def check_and_install_dependencies():
         'aiohttp': 'aiohttp',
         'pyyaml': 'yaml',
         'pillow': 'PIL',
-        'pyzipper': 'pyzipper',
-        'psutil': 'psutil'
+        'pyzipper': 'pyzipper'
     }
     
     for package, import_name in required_packages.items():
@@ -43,9 +42,10 @@ def check_and_install_dependencies():
                 print(f"导入 {package} 失败: {e}")
                 continue
 
-check_and_install_dependencies()
+# 只在直接运行时自动安装依赖，被bench.py、loadtest.py或测试导入时不改动当前环境
+if __name__ == '__main__':
+    check_and_install_dependencies()
 
-import psutil
 import re
 import random
 import string
@@ -61,11 +61,32 @@ import yaml
 import time
 import shutil
 import socket
-from jmcomic import JmDownloader, JmOption
+from jmcomic import JmDownloader, JmOption, DownloadControl, DownloadCancelledException, ExceptionTool
 import aiohttp
 import tempfile
+import contextvars
+import hmac
+import hashlib
+import base64
+import cProfile
+import pstats
+import io
+import tracemalloc
+import traceback
+import uuid
+import itertools
+import copy
+import threading
+from contextlib import contextmanager, suppress
+from collections import OrderedDict
+from functools import partial
 from PIL import Image
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 def load_config() -> dict:
     try:
         script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -115,45 +136,122 @@ logger.setLevel(logging.INFO)
 # 创建格式化器
 formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 
-# 根据配置决定是否输出到文件
-if CONFIG.get('log', {}).get('file_output', True):
-    log_dir = os.path.join(script_dir, "log")
-    os.makedirs(log_dir, exist_ok=True)
-    current_datetime = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
-    log_file = os.path.join(log_dir, f'bot_{current_datetime}.log')
-    
-    with open(log_file, 'a', encoding='utf-8') as f:
-        f.write(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - INFO - 程序启动\n")
-    
-    file_handler = RotatingFileHandler(
-        log_file,
-        maxBytes=10*1024*1024,
-        backupCount=5,
-        encoding='utf-8'
-    )
-    file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
-    print(f"日志文件输出已启用，日志文件保存在: {log_file}")
-else:
-    print("日志文件输出已禁用，仅输出到控制台")
+def setup_logging(log_dir: str):
+    """添加日志文件和控制台输出，由init()调用；重复调用时先移除之前的处理器"""
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+
+    # 根据配置决定是否输出到文件
+    if CONFIG.get('log', {}).get('file_output', True):
+        os.makedirs(log_dir, exist_ok=True)
+        current_datetime = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+        log_file = os.path.join(log_dir, f'bot_{current_datetime}.log')
+
+        with open(log_file, 'a', encoding='utf-8') as f:
+            f.write(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - INFO - 程序启动\n")
+
+        file_handler = RotatingFileHandler(
+            log_file,
+            maxBytes=10*1024*1024,
+            backupCount=5,
+            encoding='utf-8'
+        )
+        file_handler.setFormatter(formatter)
+        logger.addHandler(file_handler)
+        print(f"日志文件输出已启用，日志文件保存在: {log_file}")
+    else:
+        print("日志文件输出已禁用，仅输出到控制台")
+
+    # 添加控制台处理器
+    console_handler = ConsoleClearHandler()
+    console_handler.setFormatter(formatter)
+    logger.addHandler(console_handler)
+
+    logger.info("日志系统初始化完成")
+
+JM_OPTION_PATH = os.path.join(script_dir, 'jm-option.yml')
+
+def load_jm_option_data() -> dict:
+    """读取并校验jm-option.yml，返回原始配置；每个任务用它的副本构造独立的JmOption"""
+    with open(JM_OPTION_PATH, 'r', encoding='utf-8') as f:
+        data = yaml.safe_load(f) or {}
+    if not isinstance(data, dict):
+        raise ValueError("jm-option.yml 顶层必须是字典")
+    data.setdefault('filepath', JM_OPTION_PATH)
+    JmOption.construct(copy.deepcopy(data))
+    return data
+
+JM_OPTION_DATA = load_jm_option_data()
+logger.info("已加载JM下载配置")
 
-# 添加控制台处理器
-console_handler = ConsoleClearHandler()
-console_handler.setFormatter(formatter)
-logger.addHandler(console_handler)
+class JsonStateFile:
+    """原子写入的JSON状态文件
 
-logger.info("日志系统初始化完成")
+    先写临时文件并fsync再os.replace，崩溃时不会留下写了一半的文件；
+    事件循环里的save()只记下最新内容，delay秒内的多次修改合并成一次，在线程池中写盘。
+    """
 
-# 创建配置对象
-option = jmcomic.create_option_by_file('jm-option.yml')
-logger.info("已加载JM下载配置")
+    def __init__(self, path: str, delay: float = 2.0):
+        self.path = path
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.pending = None
+        self.dirty = False
+        self.flush_task = None
+
+    def write_now(self, data) -> bool:
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with self.lock:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, ensure_ascii=False)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+            return True
+        except Exception as e:
+            logger.error(f"保存状态文件失败 {self.path}: {e}")
+            with suppress(OSError):
+                os.remove(tmp_path)
+            return False
+
+    def save(self, data):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.write_now(data)
+            return
+        self.pending = data
+        self.dirty = True
+        if self.flush_task is None:
+            self.flush_task = loop.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.flush_task = None
+        if self.dirty:
+            data, self.pending, self.dirty = self.pending, None, False
+            await asyncio.get_running_loop().run_in_executor(None, self.write_now, data)
+
+    def flush(self):
+        """退出前把还没写盘的修改同步写入"""
+        if self.dirty:
+            data, self.pending, self.dirty = self.pending, None, False
+            self.write_now(data)
+
+
+ENABLED_GROUPS_STATE = JsonStateFile(
+    os.path.join(script_dir, "enabled_groups.json"),
+    CONFIG.get('storage', {}).get('flush_delay', 2)
+)
 
 def load_enabled_groups() -> Set[int]:
     try:
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        enabled_groups_file = os.path.join(script_dir, "enabled_groups.json")
-        if os.path.exists(enabled_groups_file):
-            with open(enabled_groups_file, 'r') as f:
+        if os.path.exists(ENABLED_GROUPS_STATE.path):
+            with open(ENABLED_GROUPS_STATE.path, 'r') as f:
                 groups = json.load(f)
                 return set(groups)
         else:
@@ -165,16 +263,9 @@ def load_enabled_groups() -> Set[int]:
         return set()
 
 def save_enabled_groups(groups: Set[int]) -> bool:
-    try:
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        enabled_groups_file = os.path.join(script_dir, "enabled_groups.json")
-        with open(enabled_groups_file, 'w') as f:
-            json.dump(list(groups), f)
-        logger.info("已保存启用群组列表")
-        return True
-    except Exception as e:
-        logger.error(f"保存已启用群组失败: {e}")
-        return False
+    """enabled_groups.json只是共享状态的镜像，频繁开关时合并写盘"""
+    ENABLED_GROUPS_STATE.save(sorted(groups))
+    return True
 
 logger.info("开始加载配置...")
 CONFIG = load_config()
@@ -184,19 +275,88 @@ INITIAL_RETRY_INTERVAL = 5
 MAX_RETRY_INTERVAL = 300
 MAX_RETRY_COUNT = 5
 
-ADMIN_QQ_NUMBERS = set(CONFIG.get('admin', {}).get('qq_numbers', []))
-MAX_ZIP_SIZE = CONFIG.get('files', {}).get('max_zip_size', 100) * 1024 * 1024
-CLEANUP_INTERVAL = CONFIG.get('cleanup', {}).get('interval', 3600)
-ZIP_PASSWORD = CONFIG.get('files', {}).get('password', '123456')
-COOLDOWN = CONFIG.get('download', {}).get('cooldown', 60)
-
-PDF_ENABLED = CONFIG.get('pdf', {}).get('enabled', False)
-if PDF_ENABLED:
-    logger.info("PDF模式已启用，将使用PDF发送方式")
-else:
-    logger.info("PDF模式未启用，将使用ZIP发送方式")
-
-PDF_API_URL = CONFIG.get('pdf', {}).get('api_url', '')
+# 输出格式 -> 显示名称；ezip是带密码的双层zip，其余格式不加密
+OUTPUT_FORMATS = {
+    'pdf': "PDF",
+    'cbz': "CBZ",
+    'zip': "ZIP",
+    'ezip': "加密ZIP"
+}
+FORMAT_ALIASES = {'加密': 'ezip', '加密zip': 'ezip'}
+
+def apply_config(config: dict):
+    """读取可以在运行中修改的配置项，启动时和重新加载配置时调用
+
+    只给全局变量赋值，中间没有await，对事件循环里的其他协程来说是一次性切换的。
+    任务开始时读取的值（批量并发）和已经开始下载的本子的jm-option不受影响，worker数量调小时
+    多出来的worker做完手上的任务再退出。
+    """
+    global ADMIN_QQ_NUMBERS, MAX_ZIP_SIZE, CLEANUP_INTERVAL, COOLDOWN, PDF_ENABLED, PDF_API_URL
+    global ALLOWED_FORMATS, DEFAULT_FORMAT, STORAGE_SYNC_INTERVAL, ARTIFACT_TTL, UPLOAD_REUSE, UPLOAD_REUSE_TTL
+    global PREFETCH_ENABLED, PREFETCH_QUIET_HOURS, PREFETCH_TOP_N, PREFETCH_WINDOW_DAYS, PREFETCH_MIN_REQUESTS
+    global PREFETCH_MAX_DISK, PREFETCH_MIN_FREE, PREFETCH_INTERVAL, WORKER_CONCURRENCY, WORKER_STALE_AFTER, WORKER_REBIND_AFTER
+    global BATCH_MAX_IDS, BATCH_CONCURRENCY, BATCH_BUNDLE, UPLOAD_MODE, UPLOAD_CHUNK_SIZE, UPLOAD_CONCURRENCY
+    global UPLOAD_RETRIES, UPLOAD_RETRY_INTERVAL, UPLOAD_FILE_RETENTION, DEBUG_MAX_PROFILE_SECONDS
+    global PROGRESS_INTERVAL, PROGRESS_MIN_INTERVAL, PROGRESS_SYNC_INTERVAL, RELOAD_WATCH, RELOAD_INTERVAL
+
+    ADMIN_QQ_NUMBERS = set(config.get('admin', {}).get('qq_numbers', []))
+    MAX_ZIP_SIZE = config.get('files', {}).get('max_zip_size', 100) * 1024 * 1024
+    CLEANUP_INTERVAL = config.get('cleanup', {}).get('interval', 3600)
+    COOLDOWN = config.get('download', {}).get('cooldown', 60)
+
+    PDF_ENABLED = config.get('pdf', {}).get('enabled', False)
+
+    PDF_API_URL = config.get('pdf', {}).get('api_url', '')
+
+    ALLOWED_FORMATS = [f for f in config.get('output', {}).get('formats', list(OUTPUT_FORMATS)) if f in OUTPUT_FORMATS] or list(OUTPUT_FORMATS)
+    DEFAULT_FORMAT = config.get('output', {}).get('default_format') or ('pdf' if PDF_ENABLED else 'ezip')
+    if DEFAULT_FORMAT not in OUTPUT_FORMATS:
+        logger.warning(f"未知的默认格式 {DEFAULT_FORMAT}，改用pdf")
+        DEFAULT_FORMAT = 'pdf'
+
+    STORAGE_SYNC_INTERVAL = config.get('storage', {}).get('sync_interval', 5)
+    ARTIFACT_TTL = config.get('storage', {}).get('artifact_ttl', 24 * 60 * 60)
+    UPLOAD_REUSE = config.get('upload', {}).get('reuse', True)
+    UPLOAD_REUSE_TTL = config.get('upload', {}).get('reuse_ttl', 3 * 24 * 60 * 60)
+
+    PREFETCH_ENABLED = config.get('prefetch', {}).get('enabled', False)
+    PREFETCH_QUIET_HOURS = config.get('prefetch', {}).get('quiet_hours', "03:00-07:00")
+    PREFETCH_TOP_N = config.get('prefetch', {}).get('top_n', 20)
+    PREFETCH_WINDOW_DAYS = config.get('prefetch', {}).get('window_days', 7)
+    PREFETCH_MIN_REQUESTS = config.get('prefetch', {}).get('min_requests', 2)
+    PREFETCH_MAX_DISK = config.get('prefetch', {}).get('max_disk_usage', 5120) * 1024 * 1024
+    PREFETCH_MIN_FREE = config.get('prefetch', {}).get('min_free_disk', 2048) * 1024 * 1024
+    PREFETCH_INTERVAL = config.get('prefetch', {}).get('check_interval', 600)
+
+    WORKER_CONCURRENCY = config.get('worker', {}).get('concurrency', 1)
+    WORKER_STALE_AFTER = config.get('worker', {}).get('stale_after', 300)
+    WORKER_REBIND_AFTER = config.get('worker', {}).get('rebind_after', 600)
+
+    BATCH_MAX_IDS = config.get('batch', {}).get('max_ids', 5)
+    BATCH_CONCURRENCY = config.get('batch', {}).get('concurrency', 2)
+    BATCH_BUNDLE = config.get('batch', {}).get('bundle', True)
+
+    UPLOAD_MODE = config.get('upload', {}).get('mode', 'stream')
+    UPLOAD_CHUNK_SIZE = config.get('upload', {}).get('chunk_size', 256) * 1024
+    UPLOAD_CONCURRENCY = config.get('upload', {}).get('concurrency', 4)
+    UPLOAD_RETRIES = config.get('upload', {}).get('retries', 5)
+    UPLOAD_RETRY_INTERVAL = config.get('upload', {}).get('retry_interval', 2)
+    UPLOAD_FILE_RETENTION = config.get('upload', {}).get('file_retention', 600)
+
+    DEBUG_MAX_PROFILE_SECONDS = config.get('debug', {}).get('max_profile_seconds', 300)
+
+    PROGRESS_INTERVAL = config.get('progress', {}).get('interval', 30)
+    PROGRESS_MIN_INTERVAL = config.get('progress', {}).get('min_interval', 10)
+    PROGRESS_SYNC_INTERVAL = config.get('progress', {}).get('sync_interval', 5)
+
+    RELOAD_WATCH = config.get('reload', {}).get('watch', True)
+    RELOAD_INTERVAL = config.get('reload', {}).get('interval', 5)
+
+apply_config(CONFIG)
+
+# 密码只在启动时读取：已缓存和已上传的加密zip都用旧密码，运行中不能切换
+ZIP_PASSWORD = str(CONFIG.get('files', {}).get('password', '123456'))
+ZIP_PASSWORD_TAG = hashlib.sha256(ZIP_PASSWORD.encode('utf-8')).hexdigest()[:8]
 
 SERVER_HOST = CONFIG.get('server', {}).get('host', '127.0.0.1')
 SERVER_PORT = CONFIG.get('server', {}).get('port', 8080)
@@ -204,70 +364,907 @@ SERVER_PORT = CONFIG.get('server', {}).get('port', 8080)
 ONEBOT_HOST = CONFIG.get('onebot', {}).get('host', '127.0.0.1')
 ONEBOT_PORT = CONFIG.get('onebot', {}).get('port', 5700)
 ONEBOT_ACCESS_TOKEN = CONFIG.get('onebot', {}).get('access_token', '')
+ONEBOT_TRANSPORTS = set(CONFIG.get('onebot', {}).get('transports', ['ws']) or ['ws'])
+ONEBOT_ACCOUNTS = CONFIG.get('onebot', {}).get('accounts', []) or []
+ONEBOT_HTTP_API = {str(k): v for k, v in (CONFIG.get('onebot', {}).get('http_api', {}) or {}).items()}
+ONEBOT_SECRET = CONFIG.get('onebot', {}).get('secret', '')
+ONEBOT_API_TIMEOUT = CONFIG.get('onebot', {}).get('api_timeout', 120)
+ONEBOT_JSON_CODEC = CONFIG.get('onebot', {}).get('json_codec', 'auto')
+
+# 每条事件帧和API调用都要编解码JSON，装了orjson就用它，否则退回标准库
+if orjson is not None and ONEBOT_JSON_CODEC != 'json':
+    json_loads = orjson.loads
+
+    def json_dumps(obj) -> str:
+        return orjson.dumps(obj).decode('utf-8')
+else:
+    json_loads = json.loads
+    json_dumps = partial(json.dumps, ensure_ascii=False, separators=(',', ':'))
 
+# 数据目录，init()传入其他目录时一起改到那里，并负责创建
 DOWNLOAD_DIR = os.path.join(script_dir, "downloads")
 ZIP_DIR = os.path.join(script_dir, "zips")
 PDF_DIR = os.path.join(script_dir, "pdf")
 
-os.makedirs(DOWNLOAD_DIR, exist_ok=True)
-os.makedirs(ZIP_DIR, exist_ok=True)
-os.makedirs(PDF_DIR, exist_ok=True)
-
-ws_client = None
 ADMIN_IDS = set()
-GROUP_COOLDOWNS = {}
 
-logger.info("开始加载已启用群组...")
-ENABLED_GROUPS = load_enabled_groups()
-logger.info(f"已加载 {len(ENABLED_GROUPS)} 个已启用群组")
+# 已连接的OneBot账号: self_id -> OneBotConnection
+BOT_CONNECTIONS = {}
+# 群号 -> 在该群内的账号self_id集合，用于在多个账号之间分摊发送
+GROUP_ACCOUNTS = {}
+# 最近处理过的事件，多个账号同在一个群时同一条消息会收到多次
+RECENT_EVENTS = OrderedDict()
+RECENT_EVENTS_LIMIT = 4096
+# 当前事件来自哪个账号，回复时优先使用同一账号
+current_self_id = contextvars.ContextVar('current_self_id', default=None)
+# 正在处理的事件任务，防止被垃圾回收
+EVENT_TASKS = set()
+# 所有命令都以此开头，消息帧里没有这个字符就不可能是命令
+COMMAND_PREFIX = '/'
+
+STORAGE_BACKEND = CONFIG.get('storage', {}).get('backend', 'sqlite')
+STORAGE_DB_PATH = os.path.join(script_dir, CONFIG.get('storage', {}).get('sqlite_path', 'state.db'))
+STORAGE_REDIS_URL = CONFIG.get('storage', {}).get('redis_url', 'redis://127.0.0.1:6379/0')
+
+WORKER_ID = str(CONFIG.get('worker', {}).get('id') or f"{socket.gethostname()}-{os.getpid()}")
+
+
+class StateBackend:
+    """多个机器人进程共享的状态：已启用群组、冷却、任务队列和成品文件索引"""
+
+    def get_enabled_groups(self) -> Set[int]:
+        raise NotImplementedError
+
+    def set_group_enabled(self, group_id: int, enabled: bool) -> None:
+        raise NotImplementedError
+
+    def get_group_format(self, group_id: int) -> Optional[str]:
+        """群的默认输出格式，没有设置返回None"""
+        raise NotImplementedError
+
+    def set_group_format(self, group_id: int, fmt: Optional[str]) -> None:
+        raise NotImplementedError
+
+    def get_cooldown(self, group_id: int) -> float:
+        """返回冷却结束的时间戳，没有冷却返回0"""
+        raise NotImplementedError
+
+    def set_cooldown(self, group_id: int, until: float) -> None:
+        raise NotImplementedError
+
+    def enqueue_job(self, job: dict) -> int:
+        raise NotImplementedError
+
+    def claim_job(self, worker_id: str, self_ids) -> Optional[dict]:
+        """领取一个任务；同一成品正在被其他进程生成时不会被领取，避免重复下载"""
+        raise NotImplementedError
+
+    def heartbeat(self, worker_id: str) -> None:
+        """为本进程领取的任务续期，同时记录本进程仍然在线"""
+        raise NotImplementedError
+
+    def live_workers(self, since: float) -> Set[str]:
+        """返回 since 之后有过心跳的进程，它们的任务目录不会被当作残留清理"""
+        raise NotImplementedError
+
+    def finish_job(self, job_id: int) -> None:
+        raise NotImplementedError
+
+    def requeue_job(self, job_id: int) -> None:
+        """把领取后没有做完的任务放回队列，进程退出时调用"""
+        raise NotImplementedError
+
+    def update_progress(self, job_id: int, progress: dict) -> None:
+        raise NotImplementedError
+
+    def list_jobs(self, group_id: int) -> list:
+        """返回某个群排队中和执行中的任务，附带最近一次同步的进度"""
+        raise NotImplementedError
+
+    def get_artifact(self, key: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    def put_artifact(self, key: str, path: str, size: int) -> None:
+        raise NotImplementedError
+
+    def remove_artifact(self, key: str) -> None:
+        raise NotImplementedError
+
+    def list_artifacts(self) -> list:
+        raise NotImplementedError
+
+    def lease_artifact(self, key: str, job_id: int) -> None:
+        """登记任务正在上传或打包某个成品，任何进程的过期清理都会跳过它"""
+        raise NotImplementedError
+
+    def release_leases(self, job_id: int) -> None:
+        """任务结束时释放它登记的所有成品租约"""
+        raise NotImplementedError
+
+    def leased_artifacts(self) -> Set[str]:
+        raise NotImplementedError
+
+    def get_uploads(self, key: str) -> list:
+        """某个成品已上传到各群的记录，最近上传的在前"""
+        raise NotImplementedError
+
+    def put_upload(self, key: str, record: dict) -> None:
+        raise NotImplementedError
+
+    def remove_upload(self, key: str, group_id: int) -> None:
+        raise NotImplementedError
+
+    def record_requests(self, jm_ids: list, fmt: str, now: float) -> None:
+        """按天累计每个本子被请求的次数，供预取挑选热门本子"""
+        raise NotImplementedError
+
+    def top_requests(self, since: float, limit: int) -> list:
+        """返回 since 之后请求最多的 [(jm_id, 格式, 次数)]，按次数从多到少"""
+        raise NotImplementedError
+
+    def prune(self, now: float) -> None:
+        """清理过期冷却和失联进程，把心跳超时的任务放回队列，释放不在执行中的任务留下的成品租约，
+        指定账号的任务排队超过rebind_after秒后改为任何账号都可以领取"""
+        raise NotImplementedError
+
+
+class SqliteBackend(StateBackend):
+    """默认实现，WAL模式下同一台机器上的多个进程可以并发读写"""
+
+    def __init__(self, path: str):
+        import sqlite3
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS enabled_groups (group_id INTEGER PRIMARY KEY);
+            CREATE TABLE IF NOT EXISTS cooldowns (group_id INTEGER PRIMARY KEY, until REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS group_formats (group_id INTEGER PRIMARY KEY, format TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                key TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                self_id INTEGER,
+                status TEXT NOT NULL DEFAULT 'queued',
+                worker TEXT,
+                heartbeat REAL
+            );
+            CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status, id);
+            CREATE TABLE IF NOT EXISTS job_progress (job_id INTEGER PRIMARY KEY, group_id INTEGER NOT NULL, progress TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS artifacts (key TEXT PRIMARY KEY, path TEXT NOT NULL, size INTEGER NOT NULL, created REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS artifact_leases (key TEXT NOT NULL, job_id INTEGER NOT NULL, PRIMARY KEY (key, job_id));
+            CREATE TABLE IF NOT EXISTS uploads (
+                key TEXT NOT NULL,
+                group_id INTEGER NOT NULL,
+                payload TEXT NOT NULL,
+                created REAL NOT NULL,
+                PRIMARY KEY (key, group_id)
+            );
+            CREATE TABLE IF NOT EXISTS request_stats (
+                jm_id TEXT NOT NULL,
+                format TEXT NOT NULL,
+                day INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (jm_id, format, day)
+            );
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS workers (worker TEXT PRIMARY KEY, seen REAL NOT NULL);
+        """)
+
+    def _execute(self, sql: str, params=()):
+        with self.lock:
+            return self.db.execute(sql, params).fetchall()
+
+    def get_enabled_groups(self) -> Set[int]:
+        return {row[0] for row in self._execute("SELECT group_id FROM enabled_groups")}
+
+    def set_group_enabled(self, group_id: int, enabled: bool) -> None:
+        if enabled:
+            self._execute("INSERT OR IGNORE INTO enabled_groups (group_id) VALUES (?)", (group_id,))
+        else:
+            self._execute("DELETE FROM enabled_groups WHERE group_id = ?", (group_id,))
+
+    def get_group_format(self, group_id: int) -> Optional[str]:
+        rows = self._execute("SELECT format FROM group_formats WHERE group_id = ?", (group_id,))
+        return rows[0][0] if rows else None
+
+    def set_group_format(self, group_id: int, fmt: Optional[str]) -> None:
+        if fmt:
+            self._execute("INSERT OR REPLACE INTO group_formats (group_id, format) VALUES (?, ?)", (group_id, fmt))
+        else:
+            self._execute("DELETE FROM group_formats WHERE group_id = ?", (group_id,))
+
+    def get_cooldown(self, group_id: int) -> float:
+        rows = self._execute("SELECT until FROM cooldowns WHERE group_id = ?", (group_id,))
+        return rows[0][0] if rows else 0
+
+    def set_cooldown(self, group_id: int, until: float) -> None:
+        self._execute("INSERT OR REPLACE INTO cooldowns (group_id, until) VALUES (?, ?)", (group_id, until))
+
+    def enqueue_job(self, job: dict) -> int:
+        with self.lock:
+            cursor = self.db.execute(
+                "INSERT INTO jobs (key, payload, self_id) VALUES (?, ?, ?)",
+                (job['key'], json.dumps(job), job.get('self_id'))
+            )
+            return cursor.lastrowid
+
+    def claim_job(self, worker_id: str, self_ids) -> Optional[dict]:
+        self_ids = list(self_ids)
+        placeholders = ','.join('?' * len(self_ids))
+        account_filter = f"(self_id IS NULL OR self_id IN ({placeholders}))" if self_ids else "self_id IS NULL"
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.db.execute(f"""
+                    SELECT id, payload FROM jobs
+                    WHERE status = 'queued' AND {account_filter}
+                      AND key NOT IN (SELECT key FROM jobs WHERE status = 'running')
+                    ORDER BY id LIMIT 1
+                """, self_ids).fetchone()
+                if row is not None:
+                    self.db.execute(
+                        "UPDATE jobs SET status = 'running', worker = ?, heartbeat = ? WHERE id = ?",
+                        (worker_id, time.time(), row[0])
+                    )
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        job = json.loads(row[1])
+        job['id'] = row[0]
+        return job
+
+    def heartbeat(self, worker_id: str) -> None:
+        now = time.time()
+        self._execute("UPDATE jobs SET heartbeat = ? WHERE worker = ? AND status = 'running'", (now, worker_id))
+        self._execute("INSERT OR REPLACE INTO workers (worker, seen) VALUES (?, ?)", (worker_id, now))
+
+    def live_workers(self, since: float) -> Set[str]:
+        return {row[0] for row in self._execute("SELECT worker FROM workers WHERE seen >= ?", (since,))}
+
+    def finish_job(self, job_id: int) -> None:
+        self._execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+        self._execute("DELETE FROM job_progress WHERE job_id = ?", (job_id,))
+
+    def requeue_job(self, job_id: int) -> None:
+        self._execute("UPDATE jobs SET status = 'queued', worker = NULL, heartbeat = NULL WHERE id = ?", (job_id,))
+        self._execute("DELETE FROM job_progress WHERE job_id = ?", (job_id,))
+
+    def update_progress(self, job_id: int, progress: dict) -> None:
+        self._execute(
+            "INSERT OR REPLACE INTO job_progress (job_id, group_id, progress) VALUES (?, ?, ?)",
+            (job_id, progress['group_id'], json.dumps(progress))
+        )
+
+    def list_jobs(self, group_id: int) -> list:
+        jobs = []
+        for job_id, payload, status, progress in self._execute("""
+            SELECT jobs.id, jobs.payload, jobs.status, job_progress.progress FROM jobs
+            LEFT JOIN job_progress ON job_progress.job_id = jobs.id
+            ORDER BY jobs.id
+        """):
+            job = json.loads(payload)
+            if job['group_id'] != group_id:
+                continue
+            job.update(id=job_id, status=status, progress=json.loads(progress) if progress else None)
+            jobs.append(job)
+        return jobs
+
+    def get_artifact(self, key: str) -> Optional[dict]:
+        rows = self._execute("SELECT path, size, created FROM artifacts WHERE key = ?", (key,))
+        if not rows:
+            return None
+        return {"key": key, "path": rows[0][0], "size": rows[0][1], "created": rows[0][2]}
+
+    def put_artifact(self, key: str, path: str, size: int) -> None:
+        self._execute(
+            "INSERT OR REPLACE INTO artifacts (key, path, size, created) VALUES (?, ?, ?, ?)",
+            (key, path, size, time.time())
+        )
+
+    def remove_artifact(self, key: str) -> None:
+        self._execute("DELETE FROM artifacts WHERE key = ?", (key,))
+
+    def list_artifacts(self) -> list:
+        return [
+            {"key": row[0], "path": row[1], "size": row[2], "created": row[3]}
+            for row in self._execute("SELECT key, path, size, created FROM artifacts")
+        ]
+
+    def lease_artifact(self, key: str, job_id: int) -> None:
+        self._execute("INSERT OR IGNORE INTO artifact_leases (key, job_id) VALUES (?, ?)", (key, job_id))
+
+    def release_leases(self, job_id: int) -> None:
+        self._execute("DELETE FROM artifact_leases WHERE job_id = ?", (job_id,))
+
+    def leased_artifacts(self) -> Set[str]:
+        return {row[0] for row in self._execute("SELECT DISTINCT key FROM artifact_leases")}
+
+    def get_uploads(self, key: str) -> list:
+        return [
+            json.loads(row[0])
+            for row in self._execute("SELECT payload FROM uploads WHERE key = ? ORDER BY created DESC", (key,))
+        ]
+
+    def put_upload(self, key: str, record: dict) -> None:
+        self._execute(
+            "INSERT OR REPLACE INTO uploads (key, group_id, payload, created) VALUES (?, ?, ?, ?)",
+            (key, record['group_id'], json.dumps(record), record['time'])
+        )
+
+    def remove_upload(self, key: str, group_id: int) -> None:
+        self._execute("DELETE FROM uploads WHERE key = ? AND group_id = ?", (key, group_id))
+
+    def record_requests(self, jm_ids: list, fmt: str, now: float) -> None:
+        day = int(now // 86400)
+        with self.lock:
+            self.db.executemany("""
+                INSERT INTO request_stats (jm_id, format, day, count) VALUES (?, ?, ?, 1)
+                ON CONFLICT (jm_id, format, day) DO UPDATE SET count = count + 1
+            """, [(jm_id, fmt, day) for jm_id in jm_ids])
+
+    def top_requests(self, since: float, limit: int) -> list:
+        return [tuple(row) for row in self._execute("""
+            SELECT jm_id, format, SUM(count) AS total FROM request_stats
+            WHERE day >= ? GROUP BY jm_id, format ORDER BY total DESC LIMIT ?
+        """, (int(since // 86400), limit))]
+
+    def prune(self, now: float) -> None:
+        self._execute("DELETE FROM cooldowns WHERE until < ?", (now,))
+        self._execute("DELETE FROM uploads WHERE created < ?", (now - UPLOAD_REUSE_TTL,))
+        self._execute("DELETE FROM request_stats WHERE day < ?", (int(now // 86400) - PREFETCH_WINDOW_DAYS,))
+        self._execute("DELETE FROM workers WHERE seen < ?", (now - WORKER_STALE_AFTER,))
+        self._execute(
+            "UPDATE jobs SET status = 'queued', worker = NULL WHERE status = 'running' AND heartbeat < ?",
+            (now - WORKER_STALE_AFTER,)
+        )
+        # 进程崩溃或任务被放回队列时没来得及释放的租约
+        self._execute("DELETE FROM artifact_leases WHERE job_id NOT IN (SELECT id FROM jobs WHERE status = 'running')")
+        for job_id, payload in self._execute("SELECT id, payload FROM jobs WHERE status = 'queued' AND self_id IS NOT NULL"):
+            job = json.loads(payload)
+            if job.get('created', now) < now - WORKER_REBIND_AFTER:
+                job['self_id'] = None
+                self._execute(
+                    "UPDATE jobs SET self_id = NULL, payload = ? WHERE id = ? AND status = 'queued'",
+                    (json.dumps(job), job_id)
+                )
+
+    def migrated(self, name: str) -> bool:
+        rows = self._execute("SELECT value FROM meta WHERE key = ?", (f"migrated:{name}",))
+        if rows:
+            return True
+        self._execute("INSERT OR IGNORE INTO meta (key, value) VALUES (?, ?)", (f"migrated:{name}", str(time.time())))
+        return False
+
+
+class RedisBackend(StateBackend):
+    """Redis实现，适合多台机器上的进程共享状态，需要安装redis包"""
+
+    def __init__(self, url: str):
+        import redis
+        self.redis = redis.Redis.from_url(url, decode_responses=True)
+        self.prefix = "jm_bot:"
+
+    def _key(self, *parts) -> str:
+        return self.prefix + ":".join(str(p) for p in parts)
+
+    def get_enabled_groups(self) -> Set[int]:
+        return {int(g) for g in self.redis.smembers(self._key("enabled_groups"))}
+
+    def set_group_enabled(self, group_id: int, enabled: bool) -> None:
+        if enabled:
+            self.redis.sadd(self._key("enabled_groups"), group_id)
+        else:
+            self.redis.srem(self._key("enabled_groups"), group_id)
+
+    def get_group_format(self, group_id: int) -> Optional[str]:
+        return self.redis.hget(self._key("group_formats"), group_id)
+
+    def set_group_format(self, group_id: int, fmt: Optional[str]) -> None:
+        if fmt:
+            self.redis.hset(self._key("group_formats"), group_id, fmt)
+        else:
+            self.redis.hdel(self._key("group_formats"), group_id)
+
+    def get_cooldown(self, group_id: int) -> float:
+        return float(self.redis.get(self._key("cooldown", group_id)) or 0)
+
+    def set_cooldown(self, group_id: int, until: float) -> None:
+        ttl = max(1, int(until - time.time()) + 1)
+        self.redis.set(self._key("cooldown", group_id), until, ex=ttl)
+
+    def enqueue_job(self, job: dict) -> int:
+        job_id = self.redis.incr(self._key("job_seq"))
+        job = dict(job, id=job_id)
+        self.redis.hset(self._key("jobs"), job_id, json.dumps(job))
+        self.redis.rpush(self._key("queue"), job_id)
+        return job_id
+
+    def claim_job(self, worker_id: str, self_ids) -> Optional[dict]:
+        self_ids = set(self_ids)
+        for job_id in self.redis.lrange(self._key("queue"), 0, -1):
+            payload = self.redis.hget(self._key("jobs"), job_id)
+            if payload is None:
+                self.redis.lrem(self._key("queue"), 1, job_id)
+                continue
+            job = json.loads(payload)
+            if job.get('self_id') is not None and job['self_id'] not in self_ids:
+                continue
+            # 同一成品同时只允许一个进程生成
+            if not self.redis.set(self._key("running", job['key']), worker_id, nx=True, ex=WORKER_STALE_AFTER):
+                continue
+            if self.redis.lrem(self._key("queue"), 1, job_id) == 0:
+                self.redis.delete(self._key("running", job['key']))
+                continue
+            self.redis.hset(self._key("claims", worker_id), job_id, job['key'])
+            return job
+        return None
 
-logger.info(f"管理员QQ号: {ADMIN_QQ_NUMBERS}")
-logger.info(f"最大文件大小: {MAX_ZIP_SIZE/1024/1024}MB")
-logger.info(f"清理间隔: {CLEANUP_INTERVAL}秒")
-logger.info(f"ZIP密码: {ZIP_PASSWORD}")
-logger.info(f"下载CD时间: {COOLDOWN}秒")
-logger.info(f"PDF模式: {'启用' if PDF_ENABLED else '禁用'}")
+    def heartbeat(self, worker_id: str) -> None:
+        for key in self.redis.hvals(self._key("claims", worker_id)):
+            self.redis.expire(self._key("running", key), WORKER_STALE_AFTER)
+        self.redis.set(self._key("worker", worker_id), time.time(), ex=int(WORKER_STALE_AFTER))
+
+    def live_workers(self, since: float) -> Set[str]:
+        # 在线记录的过期时间就是stale_after，没过期的都算在线
+        prefix = self._key("worker", "")
+        return {key[len(prefix):] for key in self.redis.scan_iter(prefix + "*")}
+
+    def finish_job(self, job_id: int) -> None:
+        payload = self.redis.hget(self._key("jobs"), job_id)
+        self.redis.hdel(self._key("jobs"), job_id)
+        self.redis.hdel(self._key("progress"), job_id)
+        self.redis.hdel(self._key("claims", WORKER_ID), job_id)
+        if payload is not None:
+            self.redis.delete(self._key("running", json.loads(payload)['key']))
+
+    def requeue_job(self, job_id: int) -> None:
+        payload = self.redis.hget(self._key("jobs"), job_id)
+        self.redis.hdel(self._key("progress"), job_id)
+        self.redis.hdel(self._key("claims", WORKER_ID), job_id)
+        if payload is not None:
+            self.redis.delete(self._key("running", json.loads(payload)['key']))
+            # 放回队首，比之后提交的任务先处理
+            self.redis.lpush(self._key("queue"), job_id)
+
+    def update_progress(self, job_id: int, progress: dict) -> None:
+        self.redis.hset(self._key("progress"), job_id, json.dumps(progress))
+
+    def list_jobs(self, group_id: int) -> list:
+        queued = set(self.redis.lrange(self._key("queue"), 0, -1))
+        jobs = []
+        for job_id, payload in sorted(self.redis.hgetall(self._key("jobs")).items(), key=lambda item: int(item[0])):
+            job = json.loads(payload)
+            if job['group_id'] != group_id:
+                continue
+            progress = self.redis.hget(self._key("progress"), job_id)
+            job.update(
+                id=int(job_id),
+                status='queued' if job_id in queued else 'running',
+                progress=json.loads(progress) if progress else None
+            )
+            jobs.append(job)
+        return jobs
+
+    def get_artifact(self, key: str) -> Optional[dict]:
+        payload = self.redis.hget(self._key("artifacts"), key)
+        return json.loads(payload) if payload else None
+
+    def put_artifact(self, key: str, path: str, size: int) -> None:
+        self.redis.hset(self._key("artifacts"), key, json.dumps({"key": key, "path": path, "size": size, "created": time.time()}))
+
+    def remove_artifact(self, key: str) -> None:
+        self.redis.hdel(self._key("artifacts"), key)
+
+    def list_artifacts(self) -> list:
+        return [json.loads(v) for v in self.redis.hvals(self._key("artifacts"))]
+
+    def lease_artifact(self, key: str, job_id: int) -> None:
+        self.redis.sadd(self._key("leases", job_id), key)
+
+    def release_leases(self, job_id: int) -> None:
+        self.redis.delete(self._key("leases", job_id))
+
+    def leased_artifacts(self) -> Set[str]:
+        keys = set()
+        for leases_key in self.redis.scan_iter(self._key("leases", "*")):
+            keys |= self.redis.smembers(leases_key)
+        return keys
+
+    def get_uploads(self, key: str) -> list:
+        records = [json.loads(v) for v in self.redis.hvals(self._key("uploads", key))]
+        return sorted(records, key=lambda r: r['time'], reverse=True)
+
+    def put_upload(self, key: str, record: dict) -> None:
+        self.redis.hset(self._key("uploads", key), record['group_id'], json.dumps(record))
+        self.redis.expire(self._key("uploads", key), int(UPLOAD_REUSE_TTL))
+
+    def remove_upload(self, key: str, group_id: int) -> None:
+        self.redis.hdel(self._key("uploads", key), group_id)
+
+    def record_requests(self, jm_ids: list, fmt: str, now: float) -> None:
+        key = self._key("requests", int(now // 86400))
+        for jm_id in jm_ids:
+            self.redis.zincrby(key, 1, f"{jm_id}.{fmt}")
+        self.redis.expire(key, (PREFETCH_WINDOW_DAYS + 1) * 86400)
+
+    def top_requests(self, since: float, limit: int) -> list:
+        days = range(int(since // 86400), int(time.time() // 86400) + 1)
+        totals = {}
+        for day in days:
+            for member, score in self.redis.zrange(self._key("requests", day), 0, -1, withscores=True):
+                totals[member] = totals.get(member, 0) + int(score)
+        ranked = sorted(totals.items(), key=lambda item: item[1], reverse=True)[:limit]
+        return [(*member.rsplit('.', 1), count) for member, count in ranked]
+
+    def prune(self, now: float) -> None:
+        # 冷却依靠键过期；领取后进程失联的任务在running锁过期后重新入队
+        running = set()
+        for claims_key in self.redis.scan_iter(self._key("claims", "*")):
+            for job_id, key in self.redis.hgetall(claims_key).items():
+                if not self.redis.exists(self._key("running", key)):
+                    self.redis.hdel(claims_key, job_id)
+                    if self.redis.hexists(self._key("jobs"), job_id):
+                        self.redis.rpush(self._key("queue"), job_id)
+                else:
+                    running.add(job_id)
+        # 进程崩溃或任务被放回队列时没来得及释放的租约
+        prefix = self._key("leases", "")
+        for leases_key in self.redis.scan_iter(prefix + "*"):
+            if leases_key[len(prefix):] not in running:
+                self.redis.delete(leases_key)
+        for job_id in self.redis.lrange(self._key("queue"), 0, -1):
+            payload = self.redis.hget(self._key("jobs"), job_id)
+            if payload is None:
+                continue
+            job = json.loads(payload)
+            if job.get('self_id') is not None and job.get('created', now) < now - WORKER_REBIND_AFTER:
+                job['self_id'] = None
+                self.redis.hset(self._key("jobs"), job_id, json.dumps(job))
+
+    def migrated(self, name: str) -> bool:
+        return not self.redis.set(self._key("migrated", name), time.time(), nx=True)
+
+
+def create_backend() -> StateBackend:
+    if STORAGE_BACKEND == 'redis':
+        logger.info(f"使用Redis共享状态: {STORAGE_REDIS_URL}")
+        return RedisBackend(STORAGE_REDIS_URL)
+    logger.info(f"使用SQLite共享状态: {STORAGE_DB_PATH}")
+    return SqliteBackend(STORAGE_DB_PATH)
+
+
+# 由init()创建
+BACKEND = None
+ENABLED_GROUPS = set()
+
+# 本进程内的任务被放入队列时唤醒worker，其他进程放入的任务靠轮询发现
+JOB_AVAILABLE = asyncio.Event()
+# worker序号 -> 协程任务，调小worker数量时序号超出的worker做完手上的任务后退出
+WORKER_TASKS = {}
+# 本进程内正在生成的成品: key -> Future
+ARTIFACT_BUILDS = {}
+
+async def run_backend(func, *args):
+    """后端调用可能因其他进程持锁而等待，放到线程池里执行避免阻塞事件循环"""
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+def load_shared_state():
+    """打开共享状态后端，迁移旧数据并加载已启用群组，由init()调用"""
+    global BACKEND, ENABLED_GROUPS
+    BACKEND = create_backend()
+    # 先登记在线，其他进程的清理任务不会把本进程刚建的任务目录当作残留
+    BACKEND.heartbeat(WORKER_ID)
+    logger.info("开始加载已启用群组...")
+    if not BACKEND.migrated('enabled_groups.json'):
+        for group in load_enabled_groups():
+            BACKEND.set_group_enabled(group, True)
+    ENABLED_GROUPS = BACKEND.get_enabled_groups()
+    # 旧版本的zip成品是加密的，现在加密zip改名为ezip，旧索引不能再当作普通zip复用
+    if not BACKEND.migrated('artifact_formats'):
+        for artifact in BACKEND.list_artifacts():
+            if artifact['key'].endswith('.zip'):
+                BACKEND.remove_artifact(artifact['key'])
+    logger.info(f"已加载 {len(ENABLED_GROUPS)} 个已启用群组")
+
+    logger.info(f"管理员QQ号: {ADMIN_QQ_NUMBERS}")
+    logger.info(f"最大文件大小: {MAX_ZIP_SIZE/1024/1024}MB")
+    logger.info(f"清理间隔: {CLEANUP_INTERVAL}秒")
+    logger.info(f"ZIP密码: {ZIP_PASSWORD}")
+    logger.info(f"下载CD时间: {COOLDOWN}秒")
+    logger.info(f"默认输出格式: {OUTPUT_FORMATS[DEFAULT_FORMAT]}，可选: {'、'.join(ALLOWED_FORMATS)}")
 
 def is_admin(user_id: int) -> bool:
     return user_id in ADMIN_QQ_NUMBERS
 
-async def call_onebot_api(endpoint: str, data: dict, retry_count=0) -> Optional[dict]:
-    global ws_client
+class TokenBucket:
+    """令牌桶：按rate(个/秒)补充，最多攒capacity个"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, now: float, amount: float = 1) -> float:
+        """还需要等多久才有amount个令牌，0表示现在就可以取"""
+        self.refill(now)
+        if self.tokens >= amount:
+            return 0
+        if self.rate <= 0:
+            return float('inf')
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount: float = 1):
+        self.tokens -= amount
+
+    def resize(self, rate: float, capacity: float, now: float):
+        """修改速率和容量，已攒的令牌保留但不超过新容量"""
+        self.refill(now)
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = min(self.tokens, capacity)
+
+    def is_full(self, now: float) -> bool:
+        self.refill(now)
+        return self.tokens >= self.capacity
+
+
+class RateLimiter:
+    """按用户、按群和全局三级令牌桶限流，三级都有令牌时才放行"""
+
+    def __init__(self, config: dict):
+        self.global_bucket = None
+        # 按最近使用排序，从头部淘汰已经攒满（等同于新建）的桶，每次检查均摊O(1)
+        self.users = OrderedDict()
+        self.groups = OrderedDict()
+        self.configure(config)
+
+    def configure(self, config: dict):
+        """应用新的限流配置，已有的桶按新速率继续计算，不会因为改配置而清空"""
+        now = time.monotonic()
+        self.user_limit = self._parse(config.get('user', {}))
+        self.group_limit = self._parse(config.get('group', {}))
+        for buckets, limit in ((self.users, self.user_limit), (self.groups, self.group_limit)):
+            if limit is None:
+                buckets.clear()
+                continue
+            for bucket in buckets.values():
+                bucket.resize(*limit, now)
+        global_limit = self._parse(config.get('global', {}))
+        if global_limit is None:
+            self.global_bucket = None
+        elif self.global_bucket is None:
+            self.global_bucket = TokenBucket(*global_limit, now)
+        else:
+            self.global_bucket.resize(*global_limit, now)
+        self.exempt_admins = config.get('exempt_admins', True)
+        self.max_entries = config.get('max_entries', 10000)
+
+    @staticmethod
+    def _parse(limit: dict):
+        per_minute = limit.get('per_minute', 0)
+        if not per_minute:
+            return None
+        return per_minute / 60, limit.get('burst', 1)
+
+    def _bucket(self, buckets: OrderedDict, key, limit, now: float) -> TokenBucket:
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(*limit, now)
+        else:
+            buckets.move_to_end(key)
+        return bucket
+
+    def _evict(self, buckets: OrderedDict, now: float):
+        while buckets:
+            key, bucket = next(iter(buckets.items()))
+            if len(buckets) <= self.max_entries and not bucket.is_full(now):
+                break
+            del buckets[key]
+
+    def check(self, group_id: int, user_id: int, now: Optional[float] = None, amount: int = 1):
+        """返回 (需要等待的秒数, 被哪一级限制)，等待0秒表示已放行并扣除令牌"""
+        if self.exempt_admins and is_admin(user_id):
+            return 0, None
+        now = time.monotonic() if now is None else now
+        
+        buckets = []
+        if self.user_limit:
+            buckets.append(('user', self._bucket(self.users, user_id, self.user_limit, now)))
+        if self.group_limit:
+            buckets.append(('group', self._bucket(self.groups, group_id, self.group_limit, now)))
+        if self.global_bucket:
+            buckets.append(('global', self.global_bucket))
+        
+        wait, scope = 0, None
+        # 超过桶容量的请求按容量计算，否则永远无法放行
+        for name, bucket in buckets:
+            bucket_wait = bucket.wait_time(now, min(amount, bucket.capacity))
+            if bucket_wait > wait:
+                wait, scope = bucket_wait, name
+        
+        if wait == 0:
+            for _, bucket in buckets:
+                bucket.take(min(amount, bucket.capacity))
+        
+        self._evict(self.users, now)
+        self._evict(self.groups, now)
+        return wait, scope
+
+
+RATE_LIMITER = RateLimiter(CONFIG.get('ratelimit', {}))
+
+def format_wait_time(remaining_time: int) -> str:
+    hours = remaining_time // 3600
+    minutes = (remaining_time % 3600) // 60
+    seconds = remaining_time % 60
+    
+    time_msg = []
+    if hours > 0:
+        time_msg.append(f"{hours}小时")
+    if minutes > 0:
+        time_msg.append(f"{minutes}分钟")
+    if seconds > 0:
+        time_msg.append(f"{seconds}秒")
     
-    if ws_client is None:
-        logger.error("WebSocket未连接，无法发送消息")
+    return "".join(time_msg)
+
+class OneBotConnection:
+    """一个OneBot账号的API调用通道"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.self_id = None
+        self.inflight = 0
+
+    @property
+    def connected(self) -> bool:
+        return True
+
+    async def call(self, action: str, params: dict) -> Optional[dict]:
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class WebSocketConnection(OneBotConnection):
+    """正向与反向WebSocket共用，响应按echo分发给等待中的调用"""
+
+    _echo_counter = itertools.count()
+
+    def __init__(self, name: str, ws):
+        super().__init__(name)
+        self.ws = ws
+        self.pending = {}
+
+    @property
+    def connected(self) -> bool:
+        return not self.ws.closed
+
+    async def call(self, action: str, params: dict) -> Optional[dict]:
+        echo = f"{time.time()}-{next(self._echo_counter)}"
+        future = asyncio.get_running_loop().create_future()
+        self.pending[echo] = future
+        self.inflight += 1
+        try:
+            api_data = {
+                "action": action,
+                "params": params,
+                "echo": echo
+            }
+            await self.ws.send_str(json_dumps(api_data))
+            logger.debug(f"已发送API调用: {api_data}")
+            return await asyncio.wait_for(future, ONEBOT_API_TIMEOUT)
+        finally:
+            self.pending.pop(echo, None)
+            self.inflight -= 1
+
+    def resolve(self, data: dict):
+        future = self.pending.pop(str(data.get("echo")), None)
+        if future is not None and not future.done():
+            future.set_result(data)
+
+    def close(self):
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError(f"{self.name} 连接已断开"))
+        self.pending.clear()
+
+
+class HttpConnection(OneBotConnection):
+    """通过HTTP API调用OneBot动作"""
+
+    def __init__(self, name: str, api_url: str, access_token: str = ''):
+        super().__init__(name)
+        self.api_url = api_url.rstrip('/')
+        self.access_token = access_token
+        self.session = None
+
+    async def call(self, action: str, params: dict) -> Optional[dict]:
+        if self.session is None or self.session.closed:
+            self.session = ClientSession(timeout=ClientTimeout(total=ONEBOT_API_TIMEOUT))
+        headers = {"Content-Type": "application/json"}
+        if self.access_token:
+            headers["Authorization"] = f"Bearer {self.access_token}"
+        self.inflight += 1
+        try:
+            async with self.session.post(f"{self.api_url}/{action}", data=json_dumps(params), headers=headers) as resp:
+                return await resp.json(loads=json_loads, content_type=None)
+        finally:
+            self.inflight -= 1
+
+
+def register_connection(conn: OneBotConnection, self_id) -> None:
+    if self_id is None:
+        return
+    self_id = int(self_id)
+    if BOT_CONNECTIONS.get(self_id) is not conn:
+        conn.self_id = self_id
+        BOT_CONNECTIONS[self_id] = conn
+        logger.info(f"OneBot账号 {self_id} 已接入 ({conn.name})")
+
+
+def unregister_connection(conn: OneBotConnection) -> None:
+    conn.close()
+    if conn.self_id is not None and BOT_CONNECTIONS.get(conn.self_id) is conn:
+        del BOT_CONNECTIONS[conn.self_id]
+        logger.info(f"OneBot账号 {conn.self_id} 已断开 ({conn.name})")
+
+
+def pick_connection(group_id=None) -> Optional[OneBotConnection]:
+    """优先选同群账号中负载最低的，其次是收到事件的账号，最后任选一个"""
+    candidates = []
+    if group_id is not None:
+        candidates = [BOT_CONNECTIONS[s] for s in GROUP_ACCOUNTS.get(group_id, ()) if s in BOT_CONNECTIONS]
+    if not candidates:
+        conn = BOT_CONNECTIONS.get(current_self_id.get())
+        if conn is not None:
+            return conn
+        candidates = list(BOT_CONNECTIONS.values())
+    candidates = [c for c in candidates if c.connected]
+    if not candidates:
+        return None
+    return min(candidates, key=lambda c: c.inflight)
+
+
+async def call_onebot_api(endpoint: str, data: dict, retry_count=0) -> Optional[dict]:
+    params = data.get("params", {})
+    conn = pick_connection(params.get("group_id"))
+    if conn is None:
+        logger.error("没有可用的OneBot连接，无法发送消息")
         return None
     
     retry_interval = min(INITIAL_RETRY_INTERVAL * (2 ** retry_count), MAX_RETRY_INTERVAL)
     
     try:
-        api_data = {
-            "action": endpoint,
-            "params": data.get("params", {}),
-            "echo": str(time.time())
-        }
-        
-        await ws_client.send_json(api_data)
-        logger.debug(f"已发送API调用: {api_data}")
-        
-        async for msg in ws_client:
-            if msg.type == WSMsgType.TEXT:
-                try:
-                    result = json.loads(msg.data)
-                    if result.get("echo") == api_data["echo"]:
-                        if result.get("status") == "failed":
-                            logger.error(f"OneBot API调用失败: {result.get('msg', '未知错误')}")
-                            return None
-                        return result
-                except json.JSONDecodeError as e:
-                    logger.error(f"解析API响应失败: {e}")
-                    return None
-            elif msg.type in (WSMsgType.CLOSED, WSMsgType.ERROR):
-                logger.error(f"WebSocket连接错误: {msg.data}")
-                return None
+        result = await conn.call(endpoint, params)
+        if result is None:
+            logger.error("解析API响应失败")
+            return None
+        if result.get("status") == "failed":
+            logger.error(f"OneBot API调用失败: {result.get('msg', result.get('wording', '未知错误'))}")
+            return None
+        return result
                 
     except Exception as e:
-        logger.error(f"调用OneBot API失败: {e}")
+        logger.error(f"调用OneBot API失败: {e!r}")
+        if retry_count >= MAX_RETRY_COUNT:
+            logger.error(f"OneBot API调用已重试 {MAX_RETRY_COUNT} 次，放弃")
+            return None
         logger.info(f"将在 {retry_interval} 秒后重试...")
         await asyncio.sleep(retry_interval)
         return await call_onebot_api(endpoint, data, retry_count + 1)
@@ -283,16 +1280,102 @@ async def send_group_message(group_id: int, message: str) -> bool:
     result = await call_onebot_api("send_msg", data)
     return result is not None
 
+DEBUG_REPORT_DIR = os.path.join(script_dir, CONFIG.get('debug', {}).get('report_dir', 'reports'))
+# 同一时间只允许一个cProfile
+PROFILE_LOCK = asyncio.Lock()
+# 上一次的内存快照，用于和本次对比
+MEMORY_SNAPSHOT = None
+
+def write_report(kind: str, text: str) -> str:
+    os.makedirs(DEBUG_REPORT_DIR, exist_ok=True)
+    path = os.path.join(DEBUG_REPORT_DIR, f"{kind}_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.txt")
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    return path
+
+def short_location(filename: str, lineno: int, name: str = '') -> str:
+    location = f"{os.path.basename(filename)}:{lineno}"
+    return f"{location}({name})" if name else location
+
+async def profile_event_loop(seconds: int):
+    """对事件循环线程做cProfile，返回 (报告路径, 自身耗时最多的几个函数)；下载和生成在线程池里，不在统计范围内"""
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.disable()
+    
+    stream = io.StringIO()
+    stats = pstats.Stats(profiler, stream=stream).sort_stats('cumulative')
+    stats.print_stats(60)
+    stats.sort_stats('tottime').print_stats(30)
+    path = write_report("profile", stream.getvalue())
+    profiler.dump_stats(path[:-len('.txt')] + '.prof')
+    
+    top = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:5]
+    lines = [f"{short_location(*func)} {tt*1000:.0f}ms/{nc}次" for func, (_, nc, tt, _, _) in top]
+    return path, lines
+
+def memory_snapshot():
+    """第一次调用开始追踪；之后每次返回 (报告路径, 占用最多的几行, 当前/峰值)，并与上一次快照对比"""
+    global MEMORY_SNAPSHOT
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(25)
+        MEMORY_SNAPSHOT = None
+        return None
+    
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ))
+    current, peak = tracemalloc.get_traced_memory()
+    top = snapshot.statistics('lineno')
+    report = [f"当前 {current/1024/1024:.1f}MB，峰值 {peak/1024/1024:.1f}MB", "", "占用最多的代码行："]
+    report += [str(stat) for stat in top[:40]]
+    if MEMORY_SNAPSHOT is not None:
+        report += ["", "与上次快照相比增长最多："]
+        report += [str(stat) for stat in snapshot.compare_to(MEMORY_SNAPSHOT, 'lineno')[:40]]
+    MEMORY_SNAPSHOT = snapshot
+    path = write_report("memory", "\n".join(report))
+    
+    lines = [f"{short_location(stat.traceback[0].filename, stat.traceback[0].lineno)} {stat.size/1024:.0f}KB" for stat in top[:5]]
+    return path, lines, current, peak
+
+def dump_tasks():
+    """列出所有asyncio任务当前停在哪一行、各任务进度和所有线程的调用栈，返回 (报告路径, 按协程统计的任务数)"""
+    report = ["asyncio任务："]
+    counts = {}
+    for task in asyncio.all_tasks():
+        coro = task.get_coro()
+        name = getattr(coro, '__qualname__', repr(coro))
+        counts[name] = counts.get(name, 0) + 1
+        stack = task.get_stack(limit=1)
+        location = short_location(stack[-1].f_code.co_filename, stack[-1].f_lineno) if stack else "-"
+        report.append(f"{task.get_name()} {name} @ {location}")
+    
+    report += ["", "本进程任务进度："]
+    report += [f"任务 {job_id}: {progress.describe()}" for job_id, progress in JOB_PROGRESS.items()] or ["无"]
+    
+    report += ["", "线程："]
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    for ident, frame in sys._current_frames().items():
+        report.append(f"--- {names.get(ident, ident)}")
+        report.append(''.join(traceback.format_stack(frame)))
+    return write_report("tasks", "\n".join(report)), counts
+
 async def handle_admin_command(command: str, group_id: int, user_id: int):
     if not is_admin(user_id):
         await send_group_message(group_id, "抱歉，您没有权限执行此命令。")
         return
     
+    args = command.split()
     if command == "/启用jm":
         if group_id in ENABLED_GROUPS:
             await send_group_message(group_id, "本群已启用JM下载功能。")
             return
         
+        await run_backend(BACKEND.set_group_enabled, group_id, True)
         ENABLED_GROUPS.add(group_id)
         save_enabled_groups(ENABLED_GROUPS)
         await send_group_message(group_id, "已在本群启用JM下载功能。")
@@ -301,48 +1384,335 @@ async def handle_admin_command(command: str, group_id: int, user_id: int):
             await send_group_message(group_id, "本群未启用JM下载功能。")
             return
         
-        ENABLED_GROUPS.remove(group_id)
+        await run_backend(BACKEND.set_group_enabled, group_id, False)
+        ENABLED_GROUPS.discard(group_id)
         save_enabled_groups(ENABLED_GROUPS)
         await send_group_message(group_id, "已在本群禁用JM下载功能。")
-
-async def handle_help_command(group_id: int, user_id: int):
+    elif command == "/jm限速":
+        stats = GOVERNOR.stats()
+        bandwidth = f"{stats['bytes_per_second']/1024/1024:.1f}MB/s" if stats['bytes_per_second'] else "不限"
+        await send_group_message(group_id, f"""下载闸门状态：
+图片并发: {stats['active']}/{stats['limit']}（上限 {stats['max_concurrency']}）
+带宽上限: {bandwidth}
+被限流次数: {stats['throttled']}
+剩余暂停: {stats['paused']:.0f}秒""")
+    elif command == "/jm域名":
+        report = DOMAIN_HEALTH.report()
+        if not report:
+            await send_group_message(group_id, "还没有域名探测结果。")
+            return
+        lines = [
+            f"{domain}: {score['latency']*1000:.0f}ms, 错误率 {score['error_rate']:.0%}"
+            for domain, score in report
+        ]
+        await send_group_message(group_id, "域名健康度（从快到慢）：\n" + "\n".join(lines))
+    elif args[0] == "/jm性能":
+        if PROFILE_LOCK.locked():
+            await send_group_message(group_id, "已有性能分析正在进行。")
+            return
+        seconds = int(args[1]) if len(args) > 1 and args[1].isdigit() else 30
+        seconds = max(1, min(seconds, DEBUG_MAX_PROFILE_SECONDS))
+        async with PROFILE_LOCK:
+            await send_group_message(group_id, f"开始性能分析，{seconds}秒后回复结果。")
+            path, lines = await profile_event_loop(seconds)
+        logger.info(f"性能分析报告已保存: {path}")
+        await send_group_message(group_id, f"性能分析完成（自身耗时最多）：\n" + "\n".join(lines) + f"\n报告: {path}")
+    elif args[0] == "/jm内存":
+        if len(args) > 1 and args[1] == "停止":
+            tracemalloc.stop()
+            await send_group_message(group_id, "已停止内存追踪。")
+            return
+        result = memory_snapshot()
+        if result is None:
+            await send_group_message(group_id, "已开始内存追踪，稍后再次发送 /jm内存 获取快照。")
+            return
+        path, lines, current, peak = result
+        logger.info(f"内存快照已保存: {path}")
+        await send_group_message(group_id, f"""内存快照：当前 {current/1024/1024:.1f}MB，峰值 {peak/1024/1024:.1f}MB
+占用最多：
+""" + "\n".join(lines) + f"\n报告: {path}")
+    elif command == "/jm重载":
+        try:
+            restart = await reload_config()
+        except Exception as e:
+            logger.error(f"重新加载配置失败，继续使用原配置: {e}")
+            await send_group_message(group_id, f"配置有误，未生效：{e}")
+            return
+        text = "配置已重新加载，正在进行的任务不会中断，新任务使用新配置。"
+        if restart:
+            text += f"\n以下配置需要重启后生效：{'、'.join(restart)}"
+        await send_group_message(group_id, text)
+    elif command == "/jm任务":
+        path, counts = dump_tasks()
+        logger.info(f"任务列表已保存: {path}")
+        lines = [f"{name} ×{count}" for name, count in sorted(counts.items(), key=lambda item: -item[1])[:8]]
+        jobs = [f"任务 {job_id}: {progress.describe()}" for job_id, progress in JOB_PROGRESS.items()]
+        await send_group_message(group_id, f"asyncio任务 {sum(counts.values())} 个：\n" + "\n".join(lines + jobs) + f"\n报告: {path}")
+
+async def handle_help_command(command: str, group_id: int, user_id: int):
     help_text = """可用命令：
 /jm <JM号> - 下载指定JM号的漫画
+/jm <JM号> <JM号> ... - 一次下载多个，合并发送
+/jm <JM号> <格式> - 指定格式，可选 {formats}
+/jm状态 - 查看本群下载任务进度
 /帮助 - 显示此帮助信息"""
 
     admin_help = """
 管理员命令：
 /启用jm - 在本群启用JM下载功能
-/禁用jm - 在本群禁用JM下载功能"""
-
+/禁用jm - 在本群禁用JM下载功能
+/jm限速 - 查看下载并发和带宽限制
+/jm域名 - 查看镜像域名健康度
+/jm格式 <格式> - 设置本群默认格式，/jm格式 默认 恢复全局设置
+/jm性能 [秒数] - 对事件循环做性能分析，默认30秒
+/jm内存 - 开始内存追踪/获取内存快照，/jm内存 停止 结束追踪
+/jm任务 - 列出所有异步任务、任务进度和线程调用栈
+/jm重载 - 重新加载config.yml和jm-option.yml"""
+
+    help_text = help_text.format(formats='、'.join(ALLOWED_FORMATS))
     if is_admin(user_id):
         help_text += admin_help
 
     await send_group_message(group_id, help_text)
 
-def all2PDF(input_folder, pdfpath, pdfname):
-    start_time = time.time()
-    paht = input_folder
-    zimulu = []
-    image = []
-    sources = []
+class JobCancelled(Exception):
+    pass
+
+
+class JobProgress:
+    """任务进度，由jmcomic下载线程、生成线程和上传协程更新
+
+    control是任务的取消信号：jmcomic在下载各环节检查它，生成文件时每页检查一次。
+    批量任务的每个本子由album()各建一个子进度，阶段、页数和取消信号各自独立，
+    任务本身在子进度工作期间处于prepare阶段；取消任务时所有子进度一起取消。
+    """
+
+    STAGES = {
+        'queued': "排队中",
+        'prepare': "准备文件中",
+        'shared': "等待其他任务生成中",
+        'space': "等待磁盘空间中",
+        'download': "下载中",
+        'render': "生成文件中",
+        'save': "保存文件中",
+        'upload': "上传中",
+        'done': "已完成"
+    }
+
+    def __init__(self, job: dict):
+        self.job_id = job['id']
+        self.jm_ids = job['jm_ids']
+        self.group_id = job['group_id']
+        self.stage = 'queued'
+        self.pages_done = 0
+        self.pages_total = 0
+        self.render_done = 0
+        self.render_total = 0
+        self.started = time.time()
+        self.stage_started = self.started
+        self.control = DownloadControl()
+        self.cancel_reason = None
+        self.cancelled_at = None
+        # 本子号 -> 子进度，只有批量处理的任务才有
+        self.albums = {}
+
+    def album(self, jm_id: str) -> 'JobProgress':
+        album = self.albums[jm_id] = JobProgress({"id": self.job_id, "jm_ids": [jm_id], "group_id": self.group_id})
+        if self.cancel_reason is not None:
+            album.cancel(self.cancel_reason)
+        return album
+
+    def set_stage(self, stage: str):
+        if stage != self.stage:
+            self.stage = stage
+            self.stage_started = time.time()
+            logger.info(f"任务 {self.job_id} JM{'、'.join(self.jm_ids)} 进入阶段: {self.STAGES[stage]}")
+
+    def stages(self) -> tuple:
+        """各本子当前的阶段，进度汇报据此判断阶段有没有变化"""
+        if self.stage == 'prepare' and self.albums:
+            return tuple(album.stage for album in self.albums.values())
+        return (self.stage,)
+
+    def cancel(self, reason: str):
+        if self.control.cancel(reason):
+            self.cancel_reason = reason
+            self.cancelled_at = time.time()
+            # 正在等待临时空间的任务也要马上醒来退出
+            SCRATCH.wake()
+        for album in list(self.albums.values()):
+            album.cancel(reason)
+
+    def raise_if_cancelled(self):
+        if self.control.is_cancelled:
+            raise JobCancelled(self.cancel_reason)
+
+    def summary(self) -> str:
+        if self.stage == 'prepare' and self.albums:
+            return "；".join(album.summary() for album in self.albums.values())
+        text = f"JM{'、'.join(self.jm_ids)} {self.STAGES[self.stage]}"
+        if self.stage == 'download' and self.pages_total:
+            text += f" {self.pages_done}/{self.pages_total}页（{self.pages_done * 100 // self.pages_total}%）"
+        elif self.stage == 'render' and self.render_total:
+            text += f" {self.render_done * 100 // self.render_total}%"
+        return text
+
+    @staticmethod
+    def elapsed(started: float) -> str:
+        return f"，已用时 {format_wait_time(int(time.time() - started)) or '0秒'}"
+
+    def describe(self) -> str:
+        return self.summary() + self.elapsed(self.started)
+
+    def to_dict(self) -> dict:
+        units = list(self.albums.values()) or [self]
+        return {
+            "stage": self.stage,
+            "pages_done": sum(unit.pages_done for unit in units),
+            "pages_total": sum(unit.pages_total for unit in units),
+            "render_done": sum(unit.render_done for unit in units),
+            "render_total": sum(unit.render_total for unit in units),
+            "started": self.started,
+            # 不含已用时，进度没有变化时快照也不变，查询时再按started补上
+            "text": self.summary()
+        }
+
+
+# 本进程正在执行的任务: 任务id -> JobProgress
+JOB_PROGRESS = {}
+
+
+class JobWatchdog:
+    """检查本进程的任务是否超时或卡住，超时的任务先协作取消，不响应的再强制回收worker
+
+    每个阶段有自己的期限（任务本身的上传阶段按本子数放宽），批量任务的每个本子单独计时，
+    一个本子卡住只取消这个本子；下载和生成阶段超过stall_timeout秒没有新的页面
+    完成视为卡住，等待磁盘空间和保存文件没有页面进度，不做这项检查。取消后jmcomic和生成循环会在下一个检查点退出并清理任务文件；卡在网络请求或
+    单张图片里的线程过了grace秒还没退出时，取消worker上的任务协程，worker继续领取下一个任务，
+    卡住的线程在后台自行结束。
+    """
+
+    def __init__(self, config: dict):
+        # 任务id -> 执行process_job的协程任务
+        self.tasks = {}
+        self.recycled = set()
+        # 任务或本子的JobProgress -> ((阶段, 已下载页数, 已生成页数), 上次变化时间)
+        self.advances = {}
+        self.configure(config)
+
+    def configure(self, config: dict):
+        self.timeouts = {
+            'queued': config.get('queued_timeout', 300),
+            'shared': config.get('shared_timeout', 3600),
+            'download': config.get('download_timeout', 1800),
+            'render': config.get('render_timeout', 600),
+            'save': config.get('save_timeout', 600),
+            'upload': config.get('upload_timeout', 900)
+        }
+        self.stall_timeout = config.get('stall_timeout', 180)
+        self.grace = config.get('grace', 30)
+        self.interval = config.get('check_interval', 10)
+
+    def overdue(self, progress: JobProgress, now: float) -> Optional[str]:
+        # 换阶段也算有进展，等完磁盘空间回到下载阶段时重新计时
+        counts = (progress.stage, progress.pages_done, progress.render_done)
+        last = self.advances.get(progress)
+        if last is None or last[0] != counts:
+            self.advances[progress] = (counts, now)
+            last_advance = now
+        else:
+            last_advance = last[1]
+
+        timeout = self.timeouts.get(progress.stage, 0)
+        if timeout and now - progress.stage_started > timeout * len(progress.jm_ids):
+            return f"{JobProgress.STAGES[progress.stage][:-1]}超时"
+        if progress.stage in ('download', 'render') and self.stall_timeout and now - last_advance > self.stall_timeout:
+            return f"{format_wait_time(int(now - last_advance))}没有进度"
+        return None
 
-    for root, _, files in os.walk(paht):
-        for file in files:
-            if file.lower().endswith(('.jpg', '.jpeg', '.png', '.webp', '.gif', '.bmp', '.tiff', '.tif', '.heic', '.heif')):
-                image.append(os.path.join(root, file))
+    def check(self, now: float):
+        for unit in list(self.advances):
+            if unit.stage == 'done' or JOB_PROGRESS.get(unit.job_id) is None:
+                del self.advances[unit]
+        for job_id, progress in list(JOB_PROGRESS.items()):
+            task = self.tasks.get(job_id)
+            # 已经结束的本子不再计时，被取消后已退出的本子也不会拖累同一任务里的其他本子
+            for unit in [progress] + [album for album in progress.albums.values() if album.stage != 'done']:
+                name = f"任务 {job_id}" if unit is progress else f"任务 {job_id} 的JM{unit.jm_ids[0]}"
+                if unit.cancel_reason is None:
+                    reason = self.overdue(unit, now)
+                    if reason:
+                        logger.warning(f"{name} {reason}，取消{'任务' if unit is progress else '该本子'}")
+                        unit.cancel(reason)
+                elif task is not None and not task.done() and now - unit.cancelled_at > self.grace:
+                    logger.error(f"{name} 取消后 {self.grace} 秒仍未退出，回收worker")
+                    progress.cancel(unit.cancel_reason)
+                    self.recycled.add(job_id)
+                    task.cancel()
+                    break
+
+    async def run(self):
+        while True:
+            try:
+                self.check(time.time())
+            except Exception as e:
+                logger.error(f"任务看门狗检查失败: {e}")
+            await asyncio.sleep(self.interval)
+
+
+WATCHDOG = JobWatchdog(CONFIG.get('watchdog', {}))
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.gif', '.bmp', '.tiff', '.tif', '.heic', '.heif')
+
+def natural_key(name: str) -> list:
+    """自然排序，2.jpg 排在 10.jpg 前面"""
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', name)]
+
+def scan_pages(download_dir: str, photo_dirs: Optional[list] = None) -> list:
+    """用os.scandir扫描一遍下载目录，返回排好序的页面清单，PDF和zip共用
+
+    photo_dirs 是jmcomic按章节顺序给出的图片目录，章节按它排序，不在其中的目录排在后面；
+    同一目录内按文件名自然排序。
+    """
+    dir_pages = {}
+    stack = [download_dir]
+    while stack:
+        current = stack.pop()
+        with os.scandir(current) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                    dir_pages.setdefault(current, []).append(entry.name)
+    
+    photo_order = {os.path.normpath(d): i for i, d in enumerate(photo_dirs or [])}
+    def dir_key(path):
+        return photo_order.get(os.path.normpath(path), len(photo_order)), natural_key(os.path.relpath(path, download_dir))
+    
+    pages = []
+    for directory in sorted(dir_pages, key=dir_key):
+        pages.extend(os.path.join(directory, name) for name in sorted(dir_pages[directory], key=natural_key))
+    return pages
 
-    image.sort()
+def all2PDF(pages: list, pdfpath, pdfname, progress: Optional[JobProgress] = None):
+    start_time = time.time()
+    sources = []
 
-    if not image:
+    if not pages:
         logger.error("未找到任何图片文件")
         return
 
-    output = Image.open(image[0])
+    if progress is not None:
+        progress.render_total += len(pages)
+
+    output = Image.open(pages[0])
     if output.mode != "RGB":
         output = output.convert("RGB")
+    # 第一页也算进度，否则生成进度永远到不了100%
+    if progress is not None:
+        progress.render_done += 1
 
-    for file in image[1:]:
+    for file in pages[1:]:
         try:
             img_file = Image.open(file)
             if img_file.mode != "RGB":
@@ -351,11 +1721,19 @@ def all2PDF(input_folder, pdfpath, pdfname):
         except Exception as e:
             logger.error(f"处理图片失败 {file}: {e}")
             continue
+        finally:
+            if progress is not None:
+                progress.render_done += 1
+        if progress is not None:
+            progress.raise_if_cancelled()
 
     pdf_file_path = os.path.join(pdfpath, pdfname)
     if not pdf_file_path.endswith(".pdf"):
         pdf_file_path = pdf_file_path + ".pdf"
 
+    # 大本子的保存要很久，期间没有页面进度，也不能中途取消
+    if progress is not None:
+        progress.set_stage('save')
     try:
         output.save(pdf_file_path, "pdf", save_all=True, append_images=sources)
         end_time = time.time()
@@ -365,423 +1743,871 @@ def all2PDF(input_folder, pdfpath, pdfname):
         logger.error(f"保存PDF失败: {e}")
         raise
 
-async def download_pdf(jm_id: str, user_id: str) -> Optional[str]:
-    if not PDF_ENABLED:
+class DownloadGovernor:
+    """所有任务共用的图片下载闸门：限制总并发和总速率，镜像站返回429/5xx时自动降速
+
+    jmcomic在自己的线程池里下载图片，所以这里用线程锁而不是asyncio原语。
+    """
+
+    def __init__(self, config: dict):
+        self.max_concurrency = 0
+        self.limit = 0
+        self.active = 0
+        self.successes = 0
+        self.throttled = 0
+        self.backoff = 0
+        self.paused_until = 0
+        self.condition = threading.Condition()
+        self.bandwidth = None
+        self.configure(config)
+
+    def configure(self, config: dict):
+        """应用新的并发和带宽上限；没有被限流时并发直接跟随新上限，限流中的保持降速状态"""
+        with self.condition:
+            throttled = self.limit < self.max_concurrency
+            self.max_concurrency = config.get('max_concurrency', 16)
+            self.min_concurrency = config.get('min_concurrency', 2)
+            self.bytes_per_second = config.get('bytes_per_second', 0)
+            self.recover_after = config.get('recover_after', 50)
+            self.max_backoff = config.get('max_backoff', 60)
+            if throttled:
+                self.limit = max(self.min_concurrency, min(self.limit, self.max_concurrency))
+            else:
+                self.limit = self.max_concurrency
+            if not self.bytes_per_second:
+                self.bandwidth = None
+            elif self.bandwidth is None:
+                self.bandwidth = TokenBucket(self.bytes_per_second, self.bytes_per_second, time.monotonic())
+            else:
+                self.bandwidth.resize(self.bytes_per_second, self.bytes_per_second, time.monotonic())
+            self.condition.notify_all()
+
+    @contextmanager
+    def slot(self):
+        with self.condition:
+            while True:
+                pause = self.paused_until - time.monotonic()
+                if pause > 0:
+                    self.condition.wait(pause)
+                elif self.active >= self.limit:
+                    self.condition.wait()
+                else:
+                    break
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.active -= 1
+                self.condition.notify()
+
+    def consume_bytes(self, size: int):
+        """按带宽上限扣除流量，超出部分在当前线程里睡眠补齐"""
+        if self.bandwidth is None or size <= 0:
+            return
+        with self.condition:
+            self.bandwidth.refill(time.monotonic())
+            self.bandwidth.take(size)
+            deficit = -self.bandwidth.tokens
+        if deficit > 0:
+            time.sleep(deficit / self.bytes_per_second)
+
+    def record(self, status: int):
+        with self.condition:
+            if status == 429 or status >= 500:
+                # 乘性减小并暂停一段时间，连续被限流时暂停时间翻倍
+                self.throttled += 1
+                self.successes = 0
+                self.limit = max(self.min_concurrency, self.limit // 2)
+                self.backoff = min(self.max_backoff, max(1, self.backoff * 2))
+                self.paused_until = time.monotonic() + self.backoff
+                logger.warning(f"镜像站返回{status}，图片并发降为 {self.limit}，暂停 {self.backoff} 秒")
+            elif status == 200:
+                # 加性恢复
+                self.successes += 1
+                if self.successes >= self.recover_after:
+                    self.successes = 0
+                    self.backoff = 0
+                    if self.limit < self.max_concurrency:
+                        self.limit += 1
+                        self.condition.notify()
+
+    def stats(self) -> dict:
+        with self.condition:
+            return {
+                "limit": self.limit,
+                "max_concurrency": self.max_concurrency,
+                "active": self.active,
+                "bytes_per_second": self.bytes_per_second,
+                "throttled": self.throttled,
+                "paused": max(0, self.paused_until - time.monotonic())
+            }
+
+
+GOVERNOR = DownloadGovernor(CONFIG.get('governor', {}))
+
+
+def response_status(e: Exception) -> Optional[int]:
+    """取出jmcomic请求异常里附带的HTTP状态码，网络错误等没有响应的异常返回None"""
+    context = getattr(e, 'context', None) or {}
+    resp = context.get(ExceptionTool.CONTEXT_KEY_RESP)
+    if resp is None:
         return None
-        
-    try:
-        user_download_dir = os.path.join(os.getcwd(), "downloads", str(user_id))
-        if not os.path.exists(user_download_dir):
-            os.makedirs(user_download_dir)
-            
-        original_dir = os.getcwd()
-        pdf_path = None  # 初始化pdf_path变量
-        
+    status = getattr(resp, 'http_code', None)
+    if status is None:
+        status = getattr(resp, 'status_code', None)
+    return status
+
+
+class DomainHealth:
+    """后台探测jmcomic域名的延迟和错误率，任务按健康度从快到慢使用域名
+
+    jmcomic请求失败时会按列表顺序切换到下一个域名，所以排好序的列表同时提供了本子下载中途的自动切换。
+    """
+
+    def __init__(self, config: dict):
+        self.lock = threading.Lock()
+        # 域名 -> {'latency': 平滑后的延迟秒数, 'error_rate': 平滑后的错误率, 'checked': 上次探测时间}
+        self.scores = {}
+        self.configure(config)
+
+    def configure(self, config: dict):
+        self.interval = config.get('probe_interval', 300)
+        self.timeout = config.get('probe_timeout', 10)
+        self.path = config.get('probe_path', '/')
+        self.scheme = config.get('scheme', 'https')
+        self.unhealthy_error_rate = config.get('unhealthy_error_rate', 0.5)
+        self.alpha = config.get('smoothing', 0.3)
+        # 留空时下次探测重新从jm-option.yml获取
+        self.domains = list(config.get('domains', []) or [])
+
+    def observe(self, domain: str, latency: Optional[float], ok: bool):
+        with self.lock:
+            score = self.scores.get(domain)
+            if score is None:
+                score = self.scores[domain] = {
+                    "latency": latency if latency is not None else self.timeout,
+                    "error_rate": 0.0 if ok else 1.0,
+                    "checked": time.time()
+                }
+                return
+            if latency is not None:
+                score["latency"] += self.alpha * (latency - score["latency"])
+            score["error_rate"] += self.alpha * ((0.0 if ok else 1.0) - score["error_rate"])
+            score["checked"] = time.time()
+
+    def _cost(self, domain: str):
+        score = self.scores.get(domain)
+        if score is None:
+            # 没探测过的域名排在健康域名之后、故障域名之前
+            return (1, self.timeout)
+        unhealthy = score["error_rate"] >= self.unhealthy_error_rate
+        return (2 if unhealthy else 0, score["latency"] * (1 + score["error_rate"]))
+
+    def ranked(self, domains: list) -> list:
+        with self.lock:
+            return sorted(domains, key=self._cost)
+
+    def report(self) -> list:
+        with self.lock:
+            return sorted(
+                ((domain, dict(score)) for domain, score in self.scores.items()),
+                key=lambda item: self._cost(item[0])
+            )
+
+    def load_domains(self) -> list:
+        """没有在配置里指定时使用jm-option.yml对应的域名列表，可能需要联网获取，在线程池中调用"""
+        if not self.domains:
+            option = JmOption.construct(copy.deepcopy(JM_OPTION_DATA))
+            self.domains = list(option.build_jm_client().get_domain_list())
+        return self.domains
+
+    async def probe(self, session: ClientSession, domain: str):
+        start = time.monotonic()
         try:
-            os.chdir(user_download_dir)
-            logger.info(f"切换到用户下载目录: {user_download_dir}")
-            
-            # 使用绝对路径加载配置文件
-            option_path = os.path.join(original_dir, 'jm-option.yml')
-            if not os.path.exists(option_path):
-                logger.error(f"配置文件不存在: {option_path}")
-                return None
-                
-            # 使用配置文件创建下载选项
-            option = jmcomic.create_option_by_file(option_path)
-            logger.info("已加载JM下载配置")
-            
-            # 使用配置选项下载
-            jmcomic.download_album(jm_id, option)
-            logger.info(f"JM{jm_id}下载完成")
-            
-            def find_image_dir(current_dir):
-                for root, dirs, files in os.walk(current_dir):
-                    image_files = [f for f in files if f.lower().endswith(('.jpg', '.jpeg', '.png', '.webp', '.gif', '.bmp', '.tiff', '.tif', '.heic', '.heif'))]
-                    if image_files:
-                        return root
-                return None
-                
-            target_dir = find_image_dir(user_download_dir)
-            if not target_dir:
-                logger.error(f"未找到包含图片的目录")
-                return None
-                
-            logger.info(f"找到图片目录: {target_dir}")
-            
-            # 使用全局PDF_DIR
-            os.makedirs(PDF_DIR, exist_ok=True)
-            logger.info(f"PDF目录: {PDF_DIR}")
-            
-            pdf_path = os.path.join(PDF_DIR, f"{jm_id}.pdf")
-            all2PDF(target_dir, PDF_DIR, jm_id)
-            
-            if os.path.exists(pdf_path):
-                logger.info(f"PDF生成成功: {pdf_path}")
-                return pdf_path
-            else:
-                logger.error("PDF文件未生成")
-                return None
-                
+            async with session.get(f"{self.scheme}://{domain}{self.path}", allow_redirects=False) as resp:
+                await resp.read()
+                ok = resp.status < 400
         except Exception as e:
-            logger.error(f"PDF下载失败: {e}")
-            if pdf_path and os.path.exists(pdf_path):
+            logger.debug(f"探测域名 {domain} 失败: {e}")
+            self.observe(domain, None, False)
+            return
+        self.observe(domain, time.monotonic() - start, ok)
+
+    async def probe_all(self):
+        domains = await asyncio.get_running_loop().run_in_executor(None, self.load_domains)
+        async with ClientSession(timeout=ClientTimeout(total=self.timeout)) as session:
+            await asyncio.gather(*(self.probe(session, domain) for domain in domains))
+        return self.ranked(domains)
+
+    async def run(self):
+        while True:
+            try:
+                ranked = await self.probe_all()
+                logger.info(f"域名健康度排序: {ranked}")
+            except Exception as e:
+                logger.error(f"域名探测失败: {e}")
+            await asyncio.sleep(self.interval)
+
+
+DOMAIN_HEALTH = DomainHealth(CONFIG.get('mirror', {}))
+
+
+class DiskSpaceError(Exception):
+    def __init__(self, needed: int):
+        super().__init__(f"磁盘空间不足，约需 {needed / 1024 / 1024:.0f}MB")
+        self.needed = needed
+
+
+class ScratchSpace:
+    """下载临时目录的选择和磁盘空间预检
+
+    拿到本子信息后按页数估算需要的空间，按配置顺序（从快到慢）选择第一个放得下的目录。
+    本进程内已分配给其他任务但还没写完的空间记为预留，按磁盘（st_dev）合计，避免多个任务
+    同时看到同一块空闲空间。空间被预留占着时等待其他任务结束，空间本身不够时直接拒绝。
+    """
+
+    def __init__(self, config: dict):
+        self.cond = threading.Condition()
+        # st_dev -> 已预留字节数
+        self.reserved = {}
+        self.configure(config)
+
+    def configure(self, config: dict):
+        """预留按磁盘记录，换目录不影响正在下载的任务归还预留"""
+        locations = []
+        for item in config.get('dirs', []) or [{'path': DOWNLOAD_DIR}]:
+            if isinstance(item, str):
+                item = {'path': item}
+            path = os.path.join(script_dir, item['path'])
+            locations.append((path, item.get('max_album', 0) * 1024 * 1024))
+        with self.cond:
+            self.locations = locations
+            self.page_size = config.get('page_size', 600) * 1024
+            self.unknown_pages = config.get('unknown_pages', 200)
+            self.reserve = config.get('reserve', 512) * 1024 * 1024
+            self.wait = config.get('wait', 120)
+            self.cond.notify_all()
+
+    def wake(self):
+        """任务被取消时唤醒等待空间的线程，让它们检查自己是否已取消"""
+        with self.cond:
+            self.cond.notify_all()
+
+    def roots(self) -> list:
+        return [path for path, _ in self.locations]
+
+    def estimate(self, page_count: int, fmt: str) -> tuple:
+        """返回 (下载目录需要的字节数, 成品目录需要的字节数)"""
+        images = (page_count or self.unknown_pages) * self.page_size
+        # 加密zip在临时目录里还有内层zip和验证解压的副本
+        scratch = images * 3 if fmt == 'ezip' else images
+        return scratch, images
+
+    def _free(self, dev: int, path: str) -> int:
+        return shutil.disk_usage(path).free - self.reserved.get(dev, 0) - self.reserve
+
+    def _try_reserve(self, needs: list) -> Optional[list]:
+        by_dev = {}
+        for path, size in needs:
+            os.makedirs(path, exist_ok=True)
+            dev = os.stat(path).st_dev
+            by_dev[dev] = (path, by_dev.get(dev, (path, 0))[1] + size)
+        for dev, (path, size) in by_dev.items():
+            if self._free(dev, path) < size:
+                return None
+        for dev, (_, size) in by_dev.items():
+            self.reserved[dev] = self.reserved.get(dev, 0) + size
+        return [(dev, size) for dev, (_, size) in by_dev.items()]
+
+    def acquire(self, page_count: int, fmt: str, artifact_dir: str, progress: Optional['JobProgress'] = None) -> tuple:
+        """返回 (临时目录根, 预留记录)，没有目录放得下时抛出DiskSpaceError，等待期间任务被取消时抛出JobCancelled"""
+        scratch, artifact = self.estimate(page_count, fmt)
+        deadline = time.monotonic() + self.wait
+        with self.cond:
+            while True:
+                if progress is not None:
+                    progress.raise_if_cancelled()
+                for root, max_album in self.locations:
+                    if max_album and scratch > max_album:
+                        continue
+                    reservation = self._try_reserve([(root, scratch), (artifact_dir, artifact)])
+                    if reservation is not None:
+                        logger.info(f"使用临时目录 {root}，预留 {(scratch + artifact) / 1024 / 1024:.0f}MB")
+                        if progress is not None:
+                            progress.set_stage('download')
+                        return root, reservation
+                remaining = deadline - time.monotonic()
+                if not self.reserved or remaining <= 0:
+                    raise DiskSpaceError(scratch + artifact)
+                logger.info("临时目录空间被其他任务占用，等待释放")
+                # 等待期间没有页面进度，单独一个阶段，不会被看门狗当作下载卡住
+                if progress is not None:
+                    progress.set_stage('space')
+                self.cond.wait(remaining)
+
+    def release(self, reservation: list):
+        with self.cond:
+            for dev, size in reservation:
+                left = self.reserved.get(dev, 0) - size
+                if left > 0:
+                    self.reserved[dev] = left
+                else:
+                    self.reserved.pop(dev, None)
+            self.cond.notify_all()
+
+
+SCRATCH = ScratchSpace(CONFIG.get('scratch', {}))
+
+
+class ScratchClaim:
+    """一次下载占用的临时目录，由GovernedDownloader在拿到本子信息后填写"""
+
+    def __init__(self, name: str, fmt: str, artifact_dir: str):
+        self.name = name
+        self.fmt = fmt
+        self.artifact_dir = artifact_dir
+        self.root = None
+        self.reservation = None
+
+    @property
+    def job_dir(self) -> str:
+        return os.path.join(self.root, self.name)
+
+    @property
+    def download_dir(self) -> str:
+        return os.path.join(self.job_dir, "download")
+
+    def acquire(self, page_count: int, progress: Optional['JobProgress'] = None):
+        self.root, self.reservation = SCRATCH.acquire(page_count, self.fmt, self.artifact_dir, progress)
+
+    def release(self):
+        if self.reservation is not None:
+            SCRATCH.release(self.reservation)
+            self.reservation = None
+
+
+class GovernedDownloader(JmDownloader):
+    """图片请求都经过全局闸门，域名按健康度排序，下载进度写入JobProgress"""
+
+    def __init__(self, option: JmOption, progress: Optional['JobProgress'] = None,
+                 scratch: Optional[ScratchClaim] = None):
+        self.progress = progress
+        self.scratch = scratch
+        self.counted_album = False
+        # 章节序号 -> 图片目录，章节在多个线程里并行下载，生成文件时按序号排列
+        self.photo_save_dirs = {}
+        super().__init__(option)
+
+    def photo_dirs(self) -> list:
+        return [self.photo_save_dirs[index] for index in sorted(self.photo_save_dirs)]
+
+    def before_album(self, album):
+        # 图片还没开始下载，按页数选好临时目录，放不下时在这里就失败
+        if self.scratch is not None:
+            self.scratch.acquire(album.page_count, self.progress)
+            self.option.dir_rule.base_dir = self.scratch.download_dir
+            album.save_path = self.option.dir_rule.decide_album_root_dir(album)
+        super().before_album(album)
+        if self.progress is not None and album.page_count:
+            self.progress.pages_total += album.page_count
+            self.counted_album = True
+
+    def before_photo(self, photo):
+        super().before_photo(photo)
+        self.photo_save_dirs[photo.album_index] = self.option.decide_image_save_dir(photo, ensure_exists=False)
+        # 拿不到本子总页数时按章节累加
+        if self.progress is not None and not self.counted_album:
+            self.progress.pages_total += len(photo)
+
+    def after_image(self, image, img_save_path):
+        super().after_image(image, img_save_path)
+        if self.progress is not None:
+            self.progress.pages_done += 1
+
+    def create_client(self):
+        client = super().create_client()
+        client.set_domain_list(DOMAIN_HEALTH.ranked(client.get_domain_list()))
+        get_jm_image = client.get_jm_image
+        before_retry = client.before_retry
+
+        def record_retry(e, kwargs, retry_count, url):
+            # 实际下载中出错的域名也计入健康度
+            for domain in client.get_domain_list():
+                if domain in url:
+                    DOMAIN_HEALTH.observe(domain, None, False)
+                    break
+            # 非200的图片响应会被jmcomic转成异常，状态码要从异常里取出来交给闸门
+            status = response_status(e)
+            if status is not None:
+                GOVERNOR.record(status)
+            return before_retry(e, kwargs, retry_count, url)
+
+        client.before_retry = record_retry
+
+        def governed_get_jm_image(img_url):
+            with GOVERNOR.slot():
                 try:
-                    os.remove(pdf_path)
+                    resp = get_jm_image(img_url)
                 except Exception as e:
-                    logger.error(f"删除PDF文件失败: {e}")
-            return None
-            
+                    # retry_times为0时jmcomic不调用before_retry，直接抛出带响应的异常；
+                    # 重试全部失败时抛出的异常不带响应，每次失败已经在record_retry里记过
+                    status = response_status(e)
+                    if status is not None:
+                        GOVERNOR.record(status)
+                    raise
+                GOVERNOR.record(resp.http_code)
+                GOVERNOR.consume_bytes(len(resp.content))
+            return resp
+
+        client.get_jm_image = governed_get_jm_image
+        return client
+
+
+def create_jm_option(download_dir: str):
+    """每个任务使用独立的下载目录，不再切换进程工作目录，多个任务可以并行"""
+    option = JmOption.construct(copy.deepcopy(JM_OPTION_DATA))
+    option.dir_rule.base_dir = download_dir
+    # 单个任务的线程数超过全局并发上限没有意义，只会有更多线程在闸门前等待
+    option.download.threading.image = min(option.download.threading.image, GOVERNOR.max_concurrency)
+    return option
+
+@contextmanager
+def discard_on_error(path: str):
+    """生成失败或任务被取消时删掉写了一半的临时文件"""
+    try:
+        yield
+    except BaseException:
+        with suppress(OSError):
+            os.remove(path)
+        raise
+
+def build_pdf(jm_id: str, download_dir: str, pdf_path: str, progress: Optional[JobProgress] = None,
+              pages: Optional[list] = None) -> Optional[str]:
+    if pages is None:
+        pages = scan_pages(download_dir)
+    if not pages:
+        logger.error(f"未找到任何图片文件")
+        return None
+        
+    logger.info(f"共找到 {len(pages)} 页")
+    
+    # 先写临时文件再改名，其他进程不会读到写了一半的PDF
+    tmp_name = f"{jm_id}.{WORKER_ID}.tmp"
+    tmp_path = os.path.join(os.path.dirname(pdf_path), tmp_name + ".pdf")
+    with discard_on_error(tmp_path):
+        all2PDF(pages, os.path.dirname(pdf_path), tmp_name, progress)
+        # 保存期间任务被取消或worker被回收时，不留下没人登记的成品
+        if progress is not None:
+            progress.raise_if_cancelled()
+    
+    if not os.path.exists(tmp_path):
+        logger.error("PDF文件未生成")
+        return None
+    os.replace(tmp_path, pdf_path)
+    logger.info(f"PDF生成成功: {pdf_path}")
+    return pdf_path
+
+def build_zip(jm_id: str, download_dir: str, zip_path: str, work_dir: str, progress: Optional[JobProgress] = None,
+              pages: Optional[list] = None) -> Optional[str]:
+    if pages is None:
+        pages = scan_pages(download_dir)
+    inner_zip_path = os.path.join(work_dir, f"{jm_id}_inner.zip")
+    # 外层zip写在成品目录里，临时目录可能在另一块磁盘上，不能直接改名过去
+    tmp_zip_path = f"{zip_path}.{WORKER_ID}.tmp"
+    logger.info(f"开始打包JM{jm_id}")
+    
+    password = ZIP_PASSWORD
+    logger.info(f"使用固定密码: {password}")
+    
+    with zipfile.ZipFile(inner_zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        if progress is not None:
+            progress.render_total += len(pages)
+        for file_path in pages:
+            arcname = os.path.relpath(file_path, download_dir)
+            logger.info(f"正在添加文件到内层zip: {file_path}")
+            zipf.write(file_path, arcname)
+            if progress is not None:
+                progress.render_done += 1
+                progress.raise_if_cancelled()
+    logger.info(f"内层压缩包创建完成: {inner_zip_path}")
+    
+    logger.info(f"正在创建AES加密的外层压缩包: {tmp_zip_path}")
+    password_bytes = password.encode('utf-8')
+    with discard_on_error(tmp_zip_path), \
+            pyzipper.AESZipFile(tmp_zip_path, 'w', compression=pyzipper.ZIP_DEFLATED, encryption=pyzipper.WZ_AES) as zipf:
+        logger.info(f"正在设置AES加密密码: {password}")
+        zipf.setpassword(password_bytes)
+        logger.info("正在添加内层压缩包到外层zip")
+        zipf.write(inner_zip_path, f"{jm_id}.zip")
+        logger.info("外层压缩包创建完成")
+    
+    test_extract_dir = os.path.join(work_dir, "test_extract")
+    try:
+        with pyzipper.AESZipFile(tmp_zip_path) as zipf:
+            logger.info("正在验证压缩包加密")
+            zipf.setpassword(password_bytes)
+            zipf.extractall(path=test_extract_dir)
+            logger.info("压缩包AES加密验证成功")
+        shutil.rmtree(test_extract_dir)
     except Exception as e:
-        logger.error(f"PDF下载失败: {e}")
-        if pdf_path and os.path.exists(pdf_path):
-            try:
-                os.remove(pdf_path)
-            except Exception as e:
-                logger.error(f"删除PDF文件失败: {e}")
+        logger.error(f"压缩包AES加密验证失败: {e}")
+        os.remove(tmp_zip_path)
+        raise Exception("压缩包AES加密失败")
+    
+    os.replace(tmp_zip_path, zip_path)
+    logger.info(f"zip文件创建成功: {zip_path}")
+    return zip_path
+
+def comic_info(album, page_count: int) -> bytes:
+    """CBZ阅读器识别的ComicInfo.xml元数据"""
+    import xml.etree.ElementTree as ET
+    root = ET.Element('ComicInfo')
+    fields = [
+        ('Title', album.name),
+        ('Writer', album.author),
+        ('Tags', ','.join(album.tags)),
+        ('PageCount', str(page_count)),
+        ('Notes', f"JM{album.album_id}")
+    ]
+    for tag, value in fields:
+        if value:
+            ET.SubElement(root, tag).text = value
+    return ET.tostring(root, encoding='utf-8', xml_declaration=True)
+
+def build_image_zip(jm_id: str, download_dir: str, zip_path: str, progress: Optional[JobProgress] = None,
+                    pages: Optional[list] = None, album=None) -> Optional[str]:
+    """不压缩、不加密的图片包，图片本身已经压缩过，几乎不耗CPU。
+    传入album时生成CBZ：页面按顺序重命名并附带ComicInfo.xml"""
+    if pages is None:
+        pages = scan_pages(download_dir)
+    if not pages:
+        logger.error(f"未找到任何图片文件")
         return None
+    
+    if progress is not None:
+        progress.render_total += len(pages)
+    tmp_path = f"{zip_path}.{WORKER_ID}.tmp"
+    with discard_on_error(tmp_path), zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_STORED) as zipf:
+        for index, file_path in enumerate(pages, 1):
+            if album is not None:
+                arcname = f"{index:04d}{os.path.splitext(file_path)[1].lower()}"
+            else:
+                arcname = os.path.relpath(file_path, download_dir)
+            zipf.write(file_path, arcname)
+            if progress is not None:
+                progress.render_done += 1
+                progress.raise_if_cancelled()
+        if album is not None:
+            zipf.writestr('ComicInfo.xml', comic_info(album, len(pages)))
+    
+    os.replace(tmp_path, zip_path)
+    logger.info(f"{os.path.splitext(zip_path)[1][1:].upper()}文件创建成功: {zip_path}")
+    return zip_path
+
+def artifact_key(jm_id: str, fmt: str) -> str:
+    """成品和上传记录的索引键，加密zip带上密码指纹，换密码后不会复用旧密码的文件"""
+    if fmt == 'ezip':
+        return f"{jm_id}.ezip.{ZIP_PASSWORD_TAG}"
+    return f"{jm_id}.{fmt}"
+
+def artifact_path(jm_id: str, fmt: str) -> str:
+    if fmt == 'pdf':
+        return os.path.join(PDF_DIR, f"{jm_id}.pdf")
+    if fmt == 'ezip':
+        return os.path.join(ZIP_DIR, f"{jm_id}_aes_{ZIP_PASSWORD_TAG}.zip")
+    return os.path.join(ZIP_DIR, f"{jm_id}.{fmt}")
+
+def build_artifact(jm_id: str, fmt: str, job_dir: str, progress: Optional[JobProgress] = None) -> Optional[str]:
+    """下载并生成成品文件，在线程池中运行
+
+    图片下载到按空间预检选出的临时目录（job_dir相对DOWNLOAD_DIR的同名子目录），生成完就删除。
+    """
+    path = artifact_path(jm_id, fmt)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    scratch = ScratchClaim(os.path.relpath(job_dir, DOWNLOAD_DIR), fmt, os.path.dirname(path))
+    
+    if progress is not None:
+        progress.set_stage('download')
+    try:
+        album, downloader = jmcomic.download_album(jm_id, create_jm_option(os.path.join(job_dir, "download")),
+                                                   downloader=partial(GovernedDownloader, progress=progress, scratch=scratch),
+                                                   control=progress.control if progress is not None else None)
+        logger.info(f"JM{jm_id}下载完成")
+        download_dir = scratch.download_dir
+        
+        # 页面清单每个任务只扫描一次，后续生成步骤共用
+        pages = scan_pages(download_dir, downloader.photo_dirs())
         
+        if progress is not None:
+            progress.set_stage('render')
+        if fmt == 'pdf':
+            return build_pdf(jm_id, download_dir, path, progress, pages)
+        if fmt == 'cbz':
+            return build_image_zip(jm_id, download_dir, path, progress, pages, album)
+        if fmt == 'zip':
+            return build_image_zip(jm_id, download_dir, path, progress, pages)
+        return build_zip(jm_id, download_dir, path, scratch.job_dir, progress, pages)
     finally:
-        # 确保恢复到原始工作目录
+        if scratch.root is not None:
+            FILE_LEASES.remove(scratch.job_dir)
+            # 批量任务的其他本子可能还在用上一级目录，不为空时保留
+            with suppress(OSError):
+                os.rmdir(os.path.dirname(scratch.job_dir))
+        scratch.release()
+
+class FileLeases:
+    """记录本进程正在使用的成品文件和任务目录，删除时不需要扫描系统进程
+
+    上传、打包合集时持有租约；要删除的文件如果还有租约，推迟到最后一个租约释放时再删。
+    生成文件在线程池中进行，所以用线程锁保护。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.holders = {}
+        self.pending_delete = set()
+
+    def acquire(self, path: str):
+        with self.lock:
+            self.holders[path] = self.holders.get(path, 0) + 1
+
+    def release(self, path: str):
+        with self.lock:
+            count = self.holders.get(path, 0) - 1
+            if count > 0:
+                self.holders[path] = count
+                return
+            self.holders.pop(path, None)
+            if path not in self.pending_delete:
+                return
+            self.pending_delete.discard(path)
+        self._delete(path)
+
+    @contextmanager
+    def hold(self, *paths):
+        for path in paths:
+            self.acquire(path)
+        try:
+            yield
+        finally:
+            for path in paths:
+                self.release(path)
+
+    def in_use(self, path: str) -> bool:
+        with self.lock:
+            return path in self.holders
+
+    def remove(self, path: str) -> bool:
+        """删除文件或目录；正在使用时推迟删除并返回False"""
+        with self.lock:
+            if path in self.holders:
+                self.pending_delete.add(path)
+                logger.info(f"文件正在使用，释放后再删除: {path}")
+                return False
+        return self._delete(path)
+
+    @staticmethod
+    def _delete(path: str) -> bool:
         try:
-            os.chdir(original_dir)
-            logger.info(f"恢复工作目录: {original_dir}")
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+            else:
+                return True
+            logger.info(f"已删除: {path}")
+            return True
         except Exception as e:
-            logger.error(f"恢复工作目录失败: {e}")
+            logger.error(f"删除文件失败 {path}: {e}")
+            return False
 
-def release_file(file_path: str) -> bool:
-    """尝试解除文件占用"""
-    try:
-        for proc in psutil.process_iter(['pid', 'name', 'open_files']):
-            try:
-                for file in proc.open_files() or []:
-                    if file.path == file_path:
-                        logger.info(f"找到占用文件的进程: {proc.name()} (PID: {proc.pid})")
-                        proc.kill()
-                        logger.info(f"已终止进程: {proc.name()} (PID: {proc.pid})")
-                        return True
-            except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
-                continue
-        return False
-    except Exception as e:
-        logger.error(f"解除文件占用失败: {e}")
-        return False
 
-async def cleanup_user_files(user_id: str, jm_id: str):
-    try:
-        # 清理用户下载目录
-        user_download_dir = os.path.join(os.getcwd(), DOWNLOAD_DIR, str(user_id))
-        if os.path.exists(user_download_dir):
-            # 删除用户目录下的所有内容
-            for item in os.listdir(user_download_dir):
-                item_path = os.path.join(user_download_dir, item)
-                try:
-                    if os.path.isdir(item_path):
-                        shutil.rmtree(item_path)
-                    else:
-                        os.remove(item_path)
-                    logger.info(f"已删除: {item_path}")
-                except Exception as e:
-                    logger.error(f"删除文件失败 {item_path}: {e}")
+FILE_LEASES = FileLeases()
 
-        # 清理ZIP目录
-        if os.path.exists(ZIP_DIR):
-            for item in os.listdir(ZIP_DIR):
-                item_path = os.path.join(ZIP_DIR, item)
-                try:
-                    os.remove(item_path)
-                    logger.info(f"已删除: {item_path}")
-                except Exception as e:
-                    logger.error(f"删除文件失败 {item_path}: {e}")
+def remove_job_dir(job_dir: str):
+    FILE_LEASES.remove(job_dir)
 
-        # 清理PDF目录
-        if os.path.exists(PDF_DIR):
-            for item in os.listdir(PDF_DIR):
-                item_path = os.path.join(PDF_DIR, item)
-                try:
-                    os.remove(item_path)
-                    logger.info(f"已删除: {item_path}")
-                except Exception as e:
-                    logger.error(f"删除文件失败 {item_path}: {e}")
+def is_chat_frame(raw) -> bool:
+    """在解析JSON之前用原始帧做预过滤：是消息事件但全文没有命令前缀的，可以直接丢弃。
+    API响应（带echo）和元事件不会被过滤，心跳仍然用于登记连接。"""
+    if isinstance(raw, bytes):
+        return b'"message_type"' in raw and b'"echo"' not in raw and COMMAND_PREFIX.encode() not in raw
+    return '"message_type"' in raw and '"echo"' not in raw and COMMAND_PREFIX not in raw
 
-        logger.info(f"已清理所有相关文件")
-    except Exception as e:
-        logger.error(f"清理文件失败: {e}")
 
-async def handle_message(request):
-    try:
-        data = await request.json()
-        logger.info(f"收到消息: {data}")
-        
-        if data.get('post_type') != 'message' or data.get('message_type') != 'group':
-            logger.debug("不是群消息，忽略")
-            return web.Response()
-        
-        message_parts = data.get('message', [])
-        if isinstance(message_parts, list):
-            message = ''.join(part.get('data', {}).get('text', '') for part in message_parts if part.get('type') == 'text')
-        else:
-            message = str(message_parts)
-        
-        message = message.strip()
-        group_id = data.get('group_id')
-        user_id = data.get('user_id')
-        
-        logger.info(f"群 {group_id} 用户 {user_id} 发送消息: {message}")
-        
-        if message in ["/启用jm", "/禁用jm"]:
-            logger.info(f"处理管理员命令: {message}")
-            await handle_admin_command(message, group_id, user_id)
-            return web.Response()
-        
-        if message == "/帮助":
-            logger.info("处理帮助命令")
-            await handle_help_command(group_id, user_id)
-            return web.Response()
-        
-        if group_id not in ENABLED_GROUPS:
-            logger.info(f"群 {group_id} 未启用JM功能")
-            return web.Response()
-        
-        match = re.match(r'/jm\s+(\d+)', message)
-        if not match:
-            logger.debug("不是JM下载命令，忽略")
-            return
-        
-        jm_id = match.group(1)
-        logger.info(f"开始下载JM{jm_id}")
-        
-        current_time = time.time()
-        if group_id in GROUP_COOLDOWNS:
-            remaining_time = int(GROUP_COOLDOWNS[group_id] - current_time)
-            if remaining_time > 0:
-                hours = remaining_time // 3600
-                minutes = (remaining_time % 3600) // 60
-                seconds = remaining_time % 60
-                
-                time_msg = []
-                if hours > 0:
-                    time_msg.append(f"{hours}小时")
-                if minutes > 0:
-                    time_msg.append(f"{minutes}分钟")
-                if seconds > 0:
-                    time_msg.append(f"{seconds}秒")
-                
-                wait_time = "".join(time_msg)
-                logger.info(f"群 {group_id} 在CD中，剩余 {wait_time}")
-                await send_group_message(group_id, f"本群需要等待 {wait_time} 后才能再次下载。")
-                return web.Response()
-        
-        await send_group_message(group_id, f"正在发送JM{jm_id}，请稍候...")
+def is_duplicate_event(data: dict) -> bool:
+    key = (data.get('group_id'), data.get('user_id'), data.get('time'), data.get('raw_message'))
+    if key in RECENT_EVENTS:
+        return True
+    RECENT_EVENTS[key] = None
+    if len(RECENT_EVENTS) > RECENT_EVENTS_LIMIT:
+        RECENT_EVENTS.popitem(last=False)
+    return False
+
+
+async def dispatch_event(data: dict, conn: OneBotConnection):
+    """所有连接方式收到的事件都从这里进入命令处理"""
+    self_id = data.get('self_id')
+    register_connection(conn, self_id)
+    
+    if data.get('post_type') != 'message' or data.get('message_type') != 'group':
+        return
+    
+    group_id = data.get('group_id')
+    if self_id is not None and group_id is not None:
+        GROUP_ACCOUNTS.setdefault(group_id, set()).add(int(self_id))
+    
+    if is_duplicate_event(data):
+        return
+    
+    current_self_id.set(int(self_id) if self_id is not None else None)
+    await handle_message_data(data)
+
+
+def spawn_event(data: dict, conn: OneBotConnection):
+    task = asyncio.create_task(dispatch_event(data, conn))
+    EVENT_TASKS.add(task)
+    task.add_done_callback(EVENT_TASKS.discard)
+
+
+async def serve_websocket(ws, conn: WebSocketConnection):
+    """读取WebSocket帧：API响应交给等待中的调用，事件交给分发器"""
+    async for msg in ws:
+        if msg.type == WSMsgType.TEXT:
+            if is_chat_frame(msg.data):
+                continue
+            try:
+                data = json_loads(msg.data)
+            except json.JSONDecodeError as e:
+                logger.error(f"解析WebSocket消息失败: {e}")
+                continue
+            if "echo" in data:
+                conn.resolve(data)
+                continue
+            spawn_event(data, conn)
+        elif msg.type == WSMsgType.CLOSED:
+            logger.warning("WebSocket连接已关闭")
+            break
+        elif msg.type == WSMsgType.ERROR:
+            logger.error(f"WebSocket错误: {ws.exception()}")
+            break
+
+
+def check_access_token(request) -> bool:
+    if not ONEBOT_ACCESS_TOKEN:
+        return True
+    auth = request.headers.get('Authorization', '')
+    token = auth[len('Bearer '):] if auth.startswith('Bearer ') else auth[len('Token '):] if auth.startswith('Token ') else ''
+    token = token or request.query.get('access_token', '')
+    return hmac.compare_digest(token, ONEBOT_ACCESS_TOKEN)
+
+
+async def handle_reverse_websocket(request):
+    """反向WebSocket：OneBot实现主动连接到本机器人"""
+    if not check_access_token(request):
+        logger.warning(f"反向WebSocket鉴权失败: {request.remote}")
+        return web.Response(status=401)
+    
+    ws = web.WebSocketResponse(heartbeat=30)
+    await ws.prepare(request)
+    self_id = request.headers.get('X-Self-ID')
+    conn = WebSocketConnection(f"反向WS {request.remote}", ws)
+    register_connection(conn, self_id)
+    logger.info(f"反向WebSocket已连接: {request.remote} (账号 {self_id})")
+    
+    try:
+        await serve_websocket(ws, conn)
+    finally:
+        unregister_connection(conn)
+    return ws
+
+
+def get_http_connection(self_id) -> Optional[HttpConnection]:
+    api_url = ONEBOT_HTTP_API.get(str(self_id)) or ONEBOT_HTTP_API.get('default')
+    if not api_url:
+        return None
+    conn = BOT_CONNECTIONS.get(int(self_id)) if self_id is not None else None
+    if isinstance(conn, HttpConnection) and conn.api_url == api_url.rstrip('/'):
+        return conn
+    return HttpConnection(f"HTTP {api_url}", api_url, ONEBOT_ACCESS_TOKEN)
+
+
+async def handle_message(request):
+    """HTTP上报：OneBot实现把事件POST到本机器人，回复通过HTTP API发送"""
+    try:
+        body = await request.read()
+        if ONEBOT_SECRET:
+            signature = 'sha1=' + hmac.new(ONEBOT_SECRET.encode('utf-8'), body, hashlib.sha1).hexdigest()
+            if not hmac.compare_digest(signature, request.headers.get('X-Signature', '')):
+                logger.warning(f"HTTP上报签名校验失败: {request.remote}")
+                return web.Response(status=403)
         
-        try:
-            if PDF_ENABLED:
-                logger.info("PDF功能已启用，使用PDF发送方式")
-                pdf_path = await download_pdf(jm_id, user_id)
-                if not pdf_path or not os.path.exists(pdf_path):
-                    logger.error("PDF生成失败")
-                    await send_group_message(group_id, f"发送JM{jm_id}失败：PDF生成失败。")
-                    return web.Response()
-                    
-                if os.path.getsize(pdf_path) > MAX_ZIP_SIZE:
-                    logger.warning(f"PDF文件大小超过限制: {os.path.getsize(pdf_path)} > {MAX_ZIP_SIZE}")
-                    await send_group_message(group_id, f"抱歉，文件大小超过限制（{MAX_ZIP_SIZE/1024/1024}MB），无法发送。")
-                    os.remove(pdf_path)
-                    return web.Response()
-                
-                logger.info(f"开始上传PDF文件: {pdf_path}")
-                data = {
-                    "action": "send_group_msg",
-                    "params": {
-                        "group_id": group_id,
-                        "message": [
-                            {
-                                "type": "file",
-                                "data": {
-                                    "name": f"【{jm_id}】.pdf",
-                                    "file": pdf_path,
-                                    "path": f"【{jm_id}】.pdf"
-                                }
-                            }
-                        ]
-                    }
-                }
-                result = await call_onebot_api("send_group_msg", data)
-                
-                if result:
-                    logger.info("PDF文件上传成功")
-                    await send_group_message(group_id, f"JM{jm_id}发送完成！")
-                    await cleanup_user_files(user_id, jm_id)
-                    # 清理控制台日志
-                    os.system('cls' if os.name == 'nt' else 'clear')
-                    logger.info(f"JM{jm_id}发送完成，已清理控制台日志")
-                else:
-                    logger.error("PDF文件上传失败")
-                    await send_group_message(group_id, f"JM{jm_id}上传失败：上传请求失败。")
-                
-                GROUP_COOLDOWNS[group_id] = current_time + COOLDOWN
-                logger.info(f"群 {group_id} 进入CD，剩余 {COOLDOWN} 秒")
-                return web.Response()
-            else:
-                logger.info("使用ZIP发送方式")
-                user_download_dir = os.path.join(os.getcwd(), DOWNLOAD_DIR, str(user_id))
-                os.makedirs(user_download_dir, exist_ok=True)
-                
-                original_dir = os.getcwd()
-                
-                try:
-                    os.chdir(user_download_dir)
-                    logger.info(f"切换到用户下载目录: {user_download_dir}")
-                    
-                    # 使用配置文件创建下载选项
-                    option = jmcomic.create_option_by_file('jm-option.yml')
-                    logger.info("已加载JM下载配置")
-                    
-                    # 使用配置选项下载
-                    jmcomic.download_album(jm_id, option)
-                    logger.info(f"JM{jm_id}下载完成")
-                    
-                    zip_path = os.path.join(original_dir, ZIP_DIR, f"{jm_id}.zip")
-                    inner_zip_path = os.path.join(original_dir, ZIP_DIR, f"{jm_id}_inner.zip")
-                    logger.info(f"开始打包JM{jm_id}")
-                    
-                    password = ZIP_PASSWORD
-                    logger.info(f"使用固定密码: {password}")
-                    
-                    download_path = user_download_dir
-                    logger.info(f"下载目录: {download_path}")
-                    
-                    if not os.path.exists(download_path):
-                        logger.error(f"下载目录不存在: {download_path}")
-                        await send_group_message(group_id, f"下载JM{jm_id}失败：找不到下载目录。")
-                        return
-                        
-                    os.makedirs(ZIP_DIR, exist_ok=True)
-                    
-                    with zipfile.ZipFile(inner_zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                        for root, _, files in os.walk(download_path):
-                            for file in files:
-                                file_path = os.path.join(root, file)
-                                arcname = os.path.relpath(file_path, download_path)
-                                logger.info(f"正在添加文件到内层zip: {file_path}")
-                                zipf.write(file_path, arcname)
-                    logger.info(f"内层压缩包创建完成: {inner_zip_path}")
-                    
-                    logger.info(f"正在创建AES加密的外层压缩包: {zip_path}")
-                    password_bytes = password.encode('utf-8')
-                    with pyzipper.AESZipFile(zip_path, 'w', compression=pyzipper.ZIP_DEFLATED, encryption=pyzipper.WZ_AES) as zipf:
-                        logger.info(f"正在设置AES加密密码: {password}")
-                        zipf.setpassword(password_bytes)
-                        logger.info("正在添加内层压缩包到外层zip")
-                        zipf.write(inner_zip_path, f"{jm_id}.zip")
-                        logger.info("外层压缩包创建完成")
-                    
-                    try:
-                        with pyzipper.AESZipFile(zip_path) as zipf:
-                            logger.info("正在验证压缩包加密")
-                            zipf.setpassword(password_bytes)
-                            zipf.extractall(path=os.path.join(original_dir, "test_extract"))
-                            logger.info("压缩包AES加密验证成功")
-                        shutil.rmtree(os.path.join(original_dir, "test_extract"))
-                    except Exception as e:
-                        logger.error(f"压缩包AES加密验证失败: {e}")
-                        raise Exception("压缩包AES加密失败")
-                    
-                    if not os.path.exists(zip_path):
-                        logger.error(f"zip文件创建失败: {zip_path}")
-                        await send_group_message(group_id, f"打包JM{jm_id}失败。")
-                        return
-                        
-                    logger.info(f"zip文件创建成功: {zip_path}")
-                    
-                    if os.path.getsize(zip_path) > MAX_ZIP_SIZE:
-                        logger.warning(f"文件大小超过限制: {os.path.getsize(zip_path)} > {MAX_ZIP_SIZE}")
-                        await send_group_message(group_id, f"抱歉，文件大小超过限制（{MAX_ZIP_SIZE/1024/1024}MB），无法发送。")
-                        return
-                    
-                    logger.info(f"开始上传文件: {zip_path}")
-                    
-                    data = {
-                        "action": "send_group_msg",
-                        "params": {
-                            "group_id": group_id,
-                            "message": [
-                                {
-                                    "type": "file",
-                                    "data": {
-                                        "name": f"密码{password}【{jm_id}】.zip",
-                                        "file": zip_path,
-                                        "path": f"密码{password}【{jm_id}】.zip"
-                                    }
-                                }
-                            ]
-                        }
-                    }
-                    result = await call_onebot_api("send_group_msg", data)
-                    
-                    if result:
-                        logger.info("文件上传成功")
-                        await send_group_message(group_id, f"JM{jm_id}发送完成！")
-                        await cleanup_user_files(user_id, jm_id)
-                    else:
-                        logger.error("文件上传失败")
-                        await send_group_message(group_id, f"JM{jm_id}上传失败：上传请求失败。")
-                    
-                    GROUP_COOLDOWNS[group_id] = current_time + COOLDOWN
-                    logger.info(f"群 {group_id} 进入CD，剩余 {COOLDOWN} 秒")
-                    
-                    logger.info(f"JM{jm_id}处理完成")
-                    
-                finally:
-                    os.chdir(original_dir)
-                    logger.info(f"恢复工作目录: {original_dir}")
-                    
-        except Exception as e:
-            logger.error(f"下载JM{jm_id}失败: {e}")
-            await send_group_message(group_id, f"下载JM{jm_id}失败，请稍后重试。")
+        if is_chat_frame(body):
+            return web.Response(status=204)
         
-        finally:
-            try:
-                if 'download_path' in locals() and os.path.exists(download_path):
-                    shutil.rmtree(download_path)
-                if 'zip_path' in locals() and os.path.exists(zip_path):
-                    os.remove(zip_path)
-            except Exception as e:
-                logger.error(f"清理临时文件失败: {e}")
+        data = json_loads(body)
+        self_id = data.get('self_id', request.headers.get('X-Self-ID'))
+        conn = get_http_connection(self_id)
+        if conn is None:
+            logger.error(f"账号 {self_id} 未配置HTTP API地址，无法回复")
+            return web.Response(status=204)
         
-        return web.Response()
+        spawn_event(data, conn)
+        return web.Response(status=204)
         
     except Exception as e:
         logger.error(f"处理消息失败: {e}")
-        return web.Response()
+        return web.Response(status=400)
+
+async def cleanup_expired(current_time: float):
+    """一轮过期清理：下载目录、成品文件和共享状态"""
+    max_age = 24 * 60 * 60
+
+    # 任务目录以 进程名_ 开头，进程失联（崩溃或重启换了进程号）后它的目录不用等满24小时
+    live = await run_backend(BACKEND.live_workers, current_time - WORKER_STALE_AFTER)
+    live.add(WORKER_ID)
+    for root in {DOWNLOAD_DIR, *SCRATCH.roots()}:
+        if not os.path.exists(root):
+            continue
+        for item in os.listdir(root):
+            item_path = os.path.join(root, item)
+            age = current_time - os.path.getmtime(item_path)
+            orphaned = age > WORKER_STALE_AFTER and not any(item.startswith(f"{worker}_") for worker in live)
+            if orphaned or age > max_age:
+                logger.info(f"删除过期文件: {item_path}")
+                FILE_LEASES.remove(item_path)
+
+    # 成品文件由索引管理，过期后从索引和磁盘一起删除；任何进程正在上传的都等下一轮再删，
+    # 本进程持有的由FILE_LEASES推迟到上传结束
+    artifacts = await run_backend(BACKEND.list_artifacts)
+    leased = await run_backend(BACKEND.leased_artifacts)
+    for artifact in artifacts:
+        if artifact['key'] in leased and os.path.exists(artifact['path']):
+            continue
+        if artifact['created'] < current_time - ARTIFACT_TTL or not os.path.exists(artifact['path']):
+            await run_backend(BACKEND.remove_artifact, artifact['key'])
+            logger.info(f"删除过期文件: {artifact['path']}")
+            FILE_LEASES.remove(artifact['path'])
+
+    # 不在索引里的文件：崩溃的进程留下的 *.tmp 临时文件、生成后没来得及写入索引的成品；
+    # 正在写的临时文件修改时间一直在更新，超过stale_after没有变化才删
+    indexed = {os.path.normpath(artifact['path']) for artifact in artifacts}
+    for root in {PDF_DIR, ZIP_DIR}:
+        for item in os.listdir(root):
+            item_path = os.path.join(root, item)
+            if os.path.normpath(item_path) in indexed:
+                continue
+            if os.path.getmtime(item_path) < current_time - WORKER_STALE_AFTER:
+                logger.info(f"删除未登记的文件: {item_path}")
+                FILE_LEASES.remove(item_path)
+
+    await run_backend(BACKEND.prune, current_time)
 
 async def cleanup_task():
     while True:
         try:
-            current_time = time.time()
-            max_age = 24 * 60 * 60
-            
-            for item in os.listdir(DOWNLOAD_DIR):
-                item_path = os.path.join(DOWNLOAD_DIR, item)
-                if os.path.getmtime(item_path) < current_time - max_age:
-                    try:
-                        if os.path.isdir(item_path):
-                            shutil.rmtree(item_path)
-                        else:
-                            os.remove(item_path)
-                        logger.info(f"已删除过期文件: {item_path}")
-                    except Exception as e:
-                        logger.error(f"删除过期文件失败: {e}")
-            
-            for item in os.listdir(ZIP_DIR):
-                item_path = os.path.join(ZIP_DIR, item)
-                if os.path.getmtime(item_path) < current_time - max_age:
-                    try:
-                        os.remove(item_path)
-                        logger.info(f"已删除过期文件: {item_path}")
-                    except Exception as e:
-                        logger.error(f"删除过期文件失败: {e}")
-            
+            await cleanup_expired(time.time())
             await asyncio.sleep(CLEANUP_INTERVAL)
             
         except Exception as e:
@@ -804,59 +2630,74 @@ def find_free_port(start_port: int = 10000, max_port: int = 65535) -> int:
 async def init_app():
     app = web.Application()
     
+    if 'ws_reverse' in ONEBOT_TRANSPORTS:
+        for path in ('/', '/ws', '/onebot/v11/ws'):
+            app.router.add_get(path, handle_reverse_websocket)
+        logger.info(f"反向WebSocket已启用: ws://{SERVER_HOST}:{SERVER_PORT}/onebot/v11/ws")
+    
+    if 'http' in ONEBOT_TRANSPORTS:
+        for path in ('/', '/onebot/v11/http'):
+            app.router.add_post(path, handle_message)
+        logger.info(f"HTTP上报已启用: http://{SERVER_HOST}:{SERVER_PORT}/onebot/v11/http")
+    
     asyncio.create_task(cleanup_task())
+    asyncio.create_task(sync_task())
+    asyncio.create_task(DOMAIN_HEALTH.run())
+    asyncio.create_task(WATCHDOG.run())
+    if PREFETCH_ENABLED:
+        start_prefetch()
+    
+    start_workers()
+    asyncio.create_task(config_watch_task())
     
-    asyncio.create_task(connect_websocket())
+    if 'ws' in ONEBOT_TRANSPORTS:
+        accounts = ONEBOT_ACCOUNTS or [{
+            "host": ONEBOT_HOST,
+            "port": ONEBOT_PORT,
+            "access_token": ONEBOT_ACCESS_TOKEN
+        }]
+        for account in accounts:
+            asyncio.create_task(connect_websocket(account))
     
     return app
 
-async def connect_websocket():
-    global ws_client
+async def connect_websocket(account: dict):
+    host = account.get('host', ONEBOT_HOST)
+    port = account.get('port', ONEBOT_PORT)
+    access_token = account.get('access_token', ONEBOT_ACCESS_TOKEN)
     
     while True:
+        conn = None
         try:
-            url = f"ws://{ONEBOT_HOST}:{ONEBOT_PORT}"
+            url = f"ws://{host}:{port}"
             logger.info(f"正在连接WebSocket: {url}")
             
-            timeout = ClientTimeout(total=30)
+            timeout = ClientTimeout(total=None, sock_connect=30)
             connector = TCPConnector(ssl=False, force_close=True)
+            headers = {"Authorization": f"Bearer {access_token}"} if access_token else None
             
             async with ClientSession(timeout=timeout, connector=connector) as session:
-                async with session.ws_connect(url) as ws:
-                    ws_client = ws
+                async with session.ws_connect(url, headers=headers, heartbeat=30) as ws:
+                    conn = WebSocketConnection(f"正向WS {url}", ws)
                     logger.info("WebSocket连接成功")
                     
-                    if ONEBOT_ACCESS_TOKEN:
+                    if access_token:
                         auth_data = {
                             "type": "auth",
-                            "token": ONEBOT_ACCESS_TOKEN
+                            "token": access_token
                         }
                         await ws.send_json(auth_data)
                         logger.info("已发送认证信息")
                     
-                    async for msg in ws:
-                        if msg.type == WSMsgType.TEXT:
-                            try:
-                                data = json.loads(msg.data)
-                                if "echo" in data:
-                                    continue
-                                await handle_message_data(data)
-                            except json.JSONDecodeError as e:
-                                logger.error(f"解析WebSocket消息失败: {e}")
-                        elif msg.type == WSMsgType.CLOSED:
-                            logger.warning("WebSocket连接已关闭")
-                            ws_client = None
-                            break
-                        elif msg.type == WSMsgType.ERROR:
-                            logger.error(f"WebSocket错误: {msg.data}")
-                            ws_client = None
-                            break
+                    await serve_websocket(ws, conn)
                 
         except Exception as e:
             logger.error(f"WebSocket连接失败: {e}")
-            ws_client = None
-            logger.info("5秒后重试连接...")
-            await asyncio.sleep(5)
+        finally:
+            if conn is not None:
+                unregister_connection(conn)
+        logger.info("5秒后重试连接...")
+        await asyncio.sleep(5)
 
 async def handle_message_data(data: dict):
     try:
@@ -869,234 +2710,929 @@ async def handle_message_data(data: dict):
         else:
             message = str(message_parts)
         
+        # 普通聊天占绝大多数，不是命令的消息直接丢弃，不记日志
         message = message.strip()
+        if not message.startswith(COMMAND_PREFIX):
+            return
+        command = COMMANDS.get(message.split(None, 1)[0])
+        if command is None:
+            return
+        handler, requires_enabled, takes_args = command
+        if not takes_args and message not in COMMANDS:
+            return
+        
         group_id = data.get('group_id')
         user_id = data.get('user_id')
+        logger.info(f"群 {group_id} 用户 {user_id} 发送命令: {message}")
         
-        logger.info(f"群 {group_id} 用户 {user_id} 发送消息: {message}")
-        
-        if message in ["/启用jm", "/禁用jm"]:
-            logger.info(f"处理管理员命令: {message}")
-            await handle_admin_command(message, group_id, user_id)
+        if requires_enabled and group_id not in ENABLED_GROUPS:
+            logger.info(f"群 {group_id} 未启用JM功能")
             return
         
-        if message == "/帮助":
-            logger.info("处理帮助命令")
-            await handle_help_command(group_id, user_id)
+        await handler(message, group_id, user_id)
+                
+    except Exception as e:
+        logger.error(f"处理消息数据失败: {e}")
+
+async def handle_jm_command(message: str, group_id: int, user_id: int):
+    match = JM_COMMAND_PATTERN.fullmatch(message)
+    if not match:
+        # JM号后面跟了多余的内容或者JM号里混了字母，不猜测用户的意思
+        logger.info(f"JM下载命令格式不正确: {message}")
+        await send_group_message(group_id, f"用法：/jm <JM号> [JM号 ...] [格式]，格式可选 {'、'.join(ALLOWED_FORMATS)}")
+        return
+    
+    fmt = await resolve_format(match.group(2), group_id)
+    if fmt is None:
+        await send_group_message(group_id, f"不支持的格式：{match.group(2)}，可选 {'、'.join(ALLOWED_FORMATS)}")
+        return
+    
+    jm_ids = list(dict.fromkeys(match.group(1).split()))
+    if len(jm_ids) > BATCH_MAX_IDS:
+        await send_group_message(group_id, f"一次最多下载 {BATCH_MAX_IDS} 个JM号。")
+        return
+    label = "、".join(jm_ids)
+    logger.info(f"开始下载JM{label}")
+    
+    # 本群已经在处理的本子直接回复进度，不重复排队
+    pending = await run_backend(BACKEND.list_jobs, group_id)
+    for job in pending:
+        if set(job['jm_ids']) & set(jm_ids):
+            logger.info(f"JM{label}已在本群任务 {job['id']} 中")
+            await send_group_message(group_id, f"已经在处理了：{describe_job(job)}")
             return
+    
+    current_time = time.time()
+    remaining_time = int(await run_backend(BACKEND.get_cooldown, group_id) - current_time)
+    if remaining_time > 0 and not (RATE_LIMITER.exempt_admins and is_admin(user_id)):
+        wait_time = format_wait_time(remaining_time)
+        logger.info(f"群 {group_id} 在CD中，剩余 {wait_time}")
+        await send_group_message(group_id, f"本群需要等待 {wait_time} 后才能再次下载。")
+        return
+    
+    # 批量请求按本子数扣令牌
+    limit_wait, limit_scope = RATE_LIMITER.check(group_id, user_id, amount=len(jm_ids))
+    if limit_wait > 0:
+        wait_time = format_wait_time(max(1, int(limit_wait + 0.999)))
+        scope_msg = {
+            'user': "您的请求过于频繁",
+            'group': "本群请求过于频繁",
+            'global': "当前下载请求较多"
+        }[limit_scope]
+        logger.info(f"群 {group_id} 用户 {user_id} 触发{limit_scope}限流，需等待 {wait_time}")
+        await send_group_message(group_id, f"{scope_msg}，请 {wait_time} 后再试。")
+        return
+    
+    # 入队时就进入CD，避免排队期间同一个群重复提交
+    await run_backend(BACKEND.set_cooldown, group_id, current_time + COOLDOWN)
+    logger.info(f"群 {group_id} 进入CD，剩余 {COOLDOWN} 秒")
+    
+    job = {
+        "key": f"{','.join(jm_ids)}.{fmt}",
+        "jm_ids": jm_ids,
+        "fmt": fmt,
+        "group_id": group_id,
+        "user_id": user_id,
+        "self_id": current_self_id.get(),
+        "created": current_time
+    }
+    job_id = await run_backend(BACKEND.enqueue_job, job)
+    JOB_AVAILABLE.set()
+    await run_backend(BACKEND.record_requests, jm_ids, fmt, current_time)
+    logger.info(f"JM{label}已加入任务队列 (任务 {job_id})")
+    
+    if len(jm_ids) == 1:
+        await send_group_message(group_id, f"正在发送JM{label}（{OUTPUT_FORMATS[fmt]}），请稍候...")
+    else:
+        await send_group_message(group_id, f"正在发送JM{label}（共{len(jm_ids)}个，{OUTPUT_FORMATS[fmt]}），请稍候...")
+
+def parse_format(name: str) -> Optional[str]:
+    name = name.lower()
+    fmt = FORMAT_ALIASES.get(name, name)
+    return fmt if fmt in ALLOWED_FORMATS else None
+
+async def resolve_format(requested: Optional[str], group_id: int) -> Optional[str]:
+    """命令里指定的格式优先，其次是本群设置的格式，最后是全局默认格式；指定了不支持的格式返回None"""
+    if requested:
+        return parse_format(requested)
+    fmt = await run_backend(BACKEND.get_group_format, group_id)
+    return fmt if fmt in ALLOWED_FORMATS else DEFAULT_FORMAT
+
+async def handle_format_command(message: str, group_id: int, user_id: int):
+    args = message.split()[1:]
+    if not args:
+        fmt = await resolve_format(None, group_id)
+        await send_group_message(group_id, f"本群默认格式：{OUTPUT_FORMATS[fmt]}，可选 {'、'.join(ALLOWED_FORMATS)}")
+        return
+    if not is_admin(user_id):
+        await send_group_message(group_id, "抱歉，您没有权限执行此命令。")
+        return
+    
+    if args[0] == "默认":
+        await run_backend(BACKEND.set_group_format, group_id, None)
+        await send_group_message(group_id, f"本群已恢复默认格式：{OUTPUT_FORMATS[DEFAULT_FORMAT]}")
+        return
+    fmt = parse_format(args[0])
+    if fmt is None:
+        await send_group_message(group_id, f"不支持的格式：{args[0]}，可选 {'、'.join(ALLOWED_FORMATS)}")
+        return
+    await run_backend(BACKEND.set_group_format, group_id, fmt)
+    logger.info(f"群 {group_id} 默认格式设置为 {fmt}")
+    await send_group_message(group_id, f"本群默认格式已设置为：{OUTPUT_FORMATS[fmt]}")
+
+def describe_job(job: dict) -> str:
+    if job.get('progress'):
+        return job['progress']['text'] + JobProgress.elapsed(job['progress']['started'])
+    return f"JM{'、'.join(job['jm_ids'])} {JobProgress.STAGES['queued']}"
+
+async def handle_status_command(command: str, group_id: int, user_id: int):
+    jobs = await run_backend(BACKEND.list_jobs, group_id)
+    if not jobs:
+        await send_group_message(group_id, "本群当前没有下载任务。")
+        return
+    lines = [f"{i}. {describe_job(job)}" for i, job in enumerate(jobs, 1)]
+    await send_group_message(group_id, "本群下载任务：\n" + "\n".join(lines))
+
+# 整条消息都要匹配，JM号后面最多跟一个格式
+JM_COMMAND_PATTERN = re.compile(r'\s*/jm((?:\s+\d+)+)(?:\s+(\S+))?\s*')
+
+# 命令名 -> (处理函数, 是否要求本群已启用, 是否带参数)，处理函数统一接收 (消息, 群号, 用户)
+COMMANDS = {
+    "/启用jm": (handle_admin_command, False, False),
+    "/禁用jm": (handle_admin_command, False, False),
+    "/jm限速": (handle_admin_command, False, False),
+    "/jm域名": (handle_admin_command, False, False),
+    "/jm性能": (handle_admin_command, False, True),
+    "/jm内存": (handle_admin_command, False, True),
+    "/jm任务": (handle_admin_command, False, False),
+    "/jm重载": (handle_admin_command, False, False),
+    "/帮助": (handle_help_command, False, False),
+    "/jm状态": (handle_status_command, True, False),
+    "/jm格式": (handle_format_command, False, True),
+    "/jm": (handle_jm_command, True, True),
+}
+
+async def report_progress(progress: JobProgress):
+    """把进度同步到共享状态供/jm状态查询，并按节流间隔发到群里"""
+    loop = asyncio.get_running_loop()
+    last_sent = last_synced = loop.time()
+    # 同步到共享状态和发到群里的节奏不同，各自记录上次的阶段
+    last_stage = synced_stage = progress.stages()
+    last_text = last_snapshot = None
+    while True:
+        await asyncio.sleep(1)
+        now = loop.time()
+        snapshot = dict(progress.to_dict(), group_id=progress.group_id)
+        if snapshot != last_snapshot and (now - last_synced >= PROGRESS_SYNC_INTERVAL or progress.stages() != synced_stage):
+            await run_backend(BACKEND.update_progress, progress.job_id, snapshot)
+            last_synced = now
+            synced_stage = progress.stages()
+            last_snapshot = snapshot
         
-        if group_id not in ENABLED_GROUPS:
-            logger.info(f"群 {group_id} 未启用JM功能")
-            return
+        # 阶段变化时尽快通知，但两条消息之间至少间隔min_interval；其余时候每interval秒最多一条
+        due = now - last_sent >= PROGRESS_INTERVAL
+        if progress.stages() != last_stage:
+            due = now - last_sent >= PROGRESS_MIN_INTERVAL
+        if due and progress.stage not in ('queued', 'done'):
+            text = progress.describe()
+            if text != last_text:
+                await send_group_message(progress.group_id, f"进度：{text}")
+                last_text = text
+            last_sent = now
+            last_stage = progress.stages()
+
+async def get_or_build_artifact(jm_id: str, fmt: str, job_dir: str, progress: Optional[JobProgress] = None) -> Optional[str]:
+    """优先复用其他任务或其他进程已生成的成品，本进程内同时请求同一成品只生成一次"""
+    key = artifact_key(jm_id, fmt)
+    artifact = await run_backend(BACKEND.get_artifact, key)
+    if artifact and os.path.exists(artifact['path']):
+        logger.info(f"复用已生成的文件: {artifact['path']}")
+        return artifact['path']
+    
+    building = ARTIFACT_BUILDS.get(key)
+    if building is not None:
+        logger.info(f"等待正在生成的文件: {key}")
+        # 单独的阶段和期限，生成它的任务卡住时看门狗取消本任务，这里每秒检查一次
+        if progress is not None:
+            progress.set_stage('shared')
+        shared = asyncio.shield(building)
+        try:
+            while not (await asyncio.wait({shared}, timeout=1))[0]:
+                if progress is not None:
+                    progress.raise_if_cancelled()
+            return shared.result()
+        except asyncio.CancelledError:
+            # 生成它的任务被看门狗回收了，本任务没有被取消
+            if building.cancelled():
+                raise JobCancelled("生成文件的任务已被取消")
+            raise
+        finally:
+            shared.cancel()
+    
+    loop = asyncio.get_running_loop()
+    building = ARTIFACT_BUILDS[key] = loop.run_in_executor(None, build_artifact, jm_id, fmt, job_dir, progress)
+    try:
+        path = await building
+    finally:
+        del ARTIFACT_BUILDS[key]
+    if path and os.path.exists(path):
+        await run_backend(BACKEND.put_artifact, key, path, os.path.getsize(path))
+    return path
+
+def artifact_name(jm_id: str, fmt: str) -> str:
+    if fmt == 'ezip':
+        return f"密码{ZIP_PASSWORD}【{jm_id}】.zip"
+    return f"【{jm_id}】.{fmt}"
+
+def build_bundle(files: list, bundle_path: str, password: Optional[str] = None) -> str:
+    """把批量任务的多个成品打成一个不压缩的zip，成品本身已经压缩过，这一步几乎不耗CPU
+
+    给出password时外层也用AES加密，和文件名里写的密码一致。
+    """
+    if password:
+        zipf = pyzipper.AESZipFile(bundle_path, 'w', compression=pyzipper.ZIP_STORED, encryption=pyzipper.WZ_AES)
+        zipf.setpassword(password.encode('utf-8'))
+    else:
+        zipf = zipfile.ZipFile(bundle_path, 'w', zipfile.ZIP_STORED)
+    with zipf:
+        for path, name in files:
+            zipf.write(path, name)
+    return bundle_path
+
+async def send_file_message(group_id: int, path: str, name: str) -> Optional[dict]:
+    """旧的发送方式：一条带本地路径的文件消息，由OneBot实现自己读取文件。成功时返回响应数据"""
+    data = {
+        "action": "send_group_msg",
+        "params": {
+            "group_id": group_id,
+            "message": [
+                {
+                    "type": "file",
+                    "data": {
+                        "name": name,
+                        "file": path,
+                        "path": name
+                    }
+                }
+            ]
+        }
+    }
+    result = await call_onebot_api("send_group_msg", data)
+    return None if result is None else result.get("data") or {}
+
+class StreamUnsupported(Exception):
+    """OneBot实现不支持upload_file_stream"""
+
+class StreamUpload:
+    """一个文件的分片上传会话，连接断开后用同一个stream_id只补发未确认的分片"""
+
+    def __init__(self, path: str, name: str, self_id: int, sha256: str):
+        self.path = path
+        self.name = name
+        self.self_id = self_id
+        self.sha256 = sha256
+        self.size = os.path.getsize(path)
+        # 分片大小在会话内固定，重载配置不影响已经在传的文件
+        self.chunk_size = UPLOAD_CHUNK_SIZE
+        self.total_chunks = max(1, -(-self.size // self.chunk_size))
+        self.stream_id = uuid.uuid4().hex
+        self.acked = set()
+
+    def read_chunk(self, index: int) -> str:
+        with open(self.path, 'rb') as f:
+            f.seek(index * self.chunk_size)
+            return base64.b64encode(f.read(self.chunk_size)).decode('ascii')
+
+    def chunk_params(self, index: int, chunk_data: str) -> dict:
+        return {
+            "stream_id": self.stream_id,
+            "chunk_data": chunk_data,
+            "chunk_index": index,
+            "total_chunks": self.total_chunks,
+            "file_size": self.size,
+            "expected_sha256": self.sha256,
+            "filename": self.name,
+            "file_retention": UPLOAD_FILE_RETENTION * 1000
+        }
+
+# 未完成的分片上传: (路径, 大小, 修改时间, 账号) -> StreamUpload，再次上传同一文件时续传
+UPLOAD_SESSIONS = {}
+# 不支持分片上传的账号，改用文件消息
+STREAM_UNSUPPORTED = set()
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+async def call_stream_api(self_id: int, action: str, params: dict) -> Optional[dict]:
+    """分片上传的所有调用必须发给同一个账号，断线时等待该账号重连后重试"""
+    for attempt in range(UPLOAD_RETRIES + 1):
+        conn = BOT_CONNECTIONS.get(self_id)
+        if conn is not None and conn.connected:
+            try:
+                result = await conn.call(action, params)
+                if result is not None and result.get("status") != "failed":
+                    return result
+                if result is not None and result.get("retcode") == 1404:
+                    raise StreamUnsupported(result.get('msg', ''))
+                logger.error(f"{action} 调用失败: {(result or {}).get('msg', (result or {}).get('wording', '未知错误'))}")
+            except StreamUnsupported:
+                raise
+            except Exception as e:
+                logger.error(f"{action} 调用失败: {e!r}")
+        if attempt < UPLOAD_RETRIES:
+            await asyncio.sleep(min(UPLOAD_RETRY_INTERVAL * (2 ** attempt), MAX_RETRY_INTERVAL))
+    return None
+
+async def upload_stream(group_id: int, path: str, name: str, self_id: int) -> Optional[dict]:
+    """NapCat分片上传：按块发送base64数据，带整个文件的sha256校验，再把临时文件上传到群文件。
+    成功时返回upload_group_file的响应数据"""
+    loop = asyncio.get_running_loop()
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime, self_id)
+    session = UPLOAD_SESSIONS.get(key)
+    if session is not None and session.chunk_size != UPLOAD_CHUNK_SIZE:
+        # 分片大小改过，已确认的分片编号对不上新的切法，重新开始
+        logger.info(f"分片大小已变更，重新上传 {name}")
+        session = UPLOAD_SESSIONS[key] = StreamUpload(path, name, self_id, session.sha256)
+    elif session is None:
+        for stale in [k for k in UPLOAD_SESSIONS if not os.path.exists(k[0])]:
+            del UPLOAD_SESSIONS[stale]
+        sha256 = await loop.run_in_executor(None, file_sha256, path)
+        session = UPLOAD_SESSIONS[key] = StreamUpload(path, name, self_id, sha256)
+    elif session.acked:
+        logger.info(f"续传 {name}: 已确认 {len(session.acked)}/{session.total_chunks} 块")
+    
+    semaphore = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+    
+    async def send_chunk(index: int) -> bool:
+        async with semaphore:
+            chunk_data = await loop.run_in_executor(None, session.read_chunk, index)
+            result = await call_stream_api(self_id, "upload_file_stream", session.chunk_params(index, chunk_data))
+            if result is None:
+                return None
+            session.acked.add(index)
+            return True
+    
+    missing = [i for i in range(session.total_chunks) if i not in session.acked]
+    try:
+        results = await asyncio.gather(*(send_chunk(i) for i in missing))
+    except StreamUnsupported:
+        UPLOAD_SESSIONS.pop(key, None)
+        raise
+    if not all(results):
+        logger.error(f"分片上传中断: {name}，已确认 {len(session.acked)}/{session.total_chunks} 块，下次上传时续传")
+        return None
+    
+    result = await call_stream_api(self_id, "upload_file_stream", {"stream_id": session.stream_id, "is_complete": True})
+    data = (result or {}).get("data") or {}
+    if not data.get("file_path"):
+        # OneBot端已经丢失这个分片会话（比如重启过），只能从头上传
+        logger.error(f"分片上传合并失败: {name}")
+        UPLOAD_SESSIONS.pop(key, None)
+        return None
+    if data.get("sha256") and data["sha256"] != session.sha256:
+        logger.error(f"分片上传校验失败: {name}")
+        UPLOAD_SESSIONS.pop(key, None)
+        return None
+    
+    UPLOAD_SESSIONS.pop(key, None)
+    result = await call_stream_api(self_id, "upload_group_file", {
+        "group_id": group_id,
+        "file": data["file_path"],
+        "name": name
+    })
+    return None if result is None else result.get("data") or {}
+
+async def upload_group_file(group_id: int, path: str, name: str) -> Optional[dict]:
+    """上传成功时返回上传记录（群号、文件id、消息id、账号），供之后复用"""
+    logger.info(f"开始上传文件: {path}")
+    conn = pick_connection(group_id)
+    if conn is None:
+        logger.error("没有可用的OneBot连接，无法上传文件")
+        return None
+    
+    data = None
+    streamed = False
+    if UPLOAD_MODE == 'stream' and conn.self_id is not None and conn.self_id not in STREAM_UNSUPPORTED:
+        try:
+            data = await upload_stream(group_id, path, name, conn.self_id)
+            streamed = True
+        except StreamUnsupported:
+            logger.warning(f"账号 {conn.self_id} 不支持分片上传，改用文件消息发送")
+            STREAM_UNSUPPORTED.add(conn.self_id)
+    if not streamed:
+        data = await send_file_message(group_id, path, name)
+    
+    if data is None:
+        logger.error("文件上传失败")
+        return None
+    logger.info("文件上传成功")
+    return {
+        "group_id": group_id,
+        "name": name,
+        "file_id": data.get("file_id"),
+        "message_id": data.get("message_id"),
+        "self_id": conn.self_id,
+        "time": time.time()
+    }
+
+async def share_uploaded_file(group_id: int, jm_id: str, fmt: str) -> bool:
+    """同一成品之前上传过就不再生成和上传：本群还在群文件里就直接提示，
+    其他群的优先转发原文件消息，其次让OneBot实现从群文件链接转存；都失败时走正常流程"""
+    if not UPLOAD_REUSE:
+        return False
+    key = artifact_key(jm_id, fmt)
+    records = await run_backend(BACKEND.get_uploads, key)
+    # 本群的记录优先
+    records.sort(key=lambda r: r['group_id'] != group_id)
+    conn = pick_connection(group_id)
+    
+    for record in records:
+        if record['time'] < time.time() - UPLOAD_REUSE_TTL:
+            continue
+        url = None
+        if record.get('file_id'):
+            result = await call_onebot_api("get_group_file_url", {
+                "params": {"group_id": record['group_id'], "file_id": record['file_id'], "busid": 102}
+            })
+            url = ((result or {}).get("data") or {}).get("url")
         
-        match = re.match(r'/jm\s+(\d+)', message)
-        if not match:
-            logger.debug("不是JM下载命令，忽略")
-            return
+        if record['group_id'] == group_id and url:
+            logger.info(f"JM{jm_id}已在群 {group_id} 的群文件中")
+            await send_group_message(group_id, f"JM{jm_id}已在本群群文件中：{record['name']}")
+            return True
+        # 消息id只在上传它的账号上有效
+        if record.get('message_id') and conn is not None and conn.self_id == record.get('self_id'):
+            result = await call_onebot_api("forward_group_single_msg", {
+                "params": {"group_id": group_id, "message_id": record['message_id']}
+            })
+            if result is not None:
+                logger.info(f"已从群 {record['group_id']} 转发JM{jm_id}")
+                return True
+        if url:
+            data = await send_file_message(group_id, url, record['name'])
+            if data is not None:
+                logger.info(f"已从群 {record['group_id']} 的群文件转存JM{jm_id}")
+                await record_upload(jm_id, fmt, dict(record, group_id=group_id, file_id=None,
+                                                     message_id=data.get("message_id"), time=time.time()))
+                return True
         
-        jm_id = match.group(1)
-        logger.info(f"开始下载JM{jm_id}")
+        logger.info(f"群 {record['group_id']} 的JM{jm_id}已失效，不再复用")
+        await run_backend(BACKEND.remove_upload, key, record['group_id'])
+    return False
+
+async def record_upload(jm_id: str, fmt: str, record: dict):
+    if UPLOAD_REUSE:
+        await run_backend(BACKEND.put_upload, artifact_key(jm_id, fmt), record)
+
+async def prepare_artifact(jm_id: str, fmt: str, job_dir: str, progress: Optional[JobProgress] = None):
+    """返回 (成品路径, 失败提示)，二者有且只有一个不为None；成功时成品已加租约"""
+    try:
+        path = await get_or_build_artifact(jm_id, fmt, os.path.join(job_dir, jm_id), progress)
+    except DiskSpaceError as e:
+        logger.error(f"下载JM{jm_id}失败: {e}")
+        return None, f"JM{jm_id}太大，服务器临时空间不足（约需{e.needed // 1024 // 1024}MB），暂时无法下载。"
+    except (JobCancelled, DownloadCancelledException) as e:
+        logger.warning(f"JM{jm_id}已取消: {e}")
+        reason = progress.cancel_reason if progress is not None and progress.cancel_reason else "任务被取消"
+        return None, f"JM{jm_id}已取消：{reason}，请稍后重试。"
+    except Exception as e:
+        logger.error(f"下载JM{jm_id}失败: {e}")
+        return None, f"下载JM{jm_id}失败，请稍后重试。"
+    
+    if not path or not os.path.exists(path):
+        logger.error(f"{OUTPUT_FORMATS[fmt]}生成失败")
+        return None, f"发送JM{jm_id}失败：{OUTPUT_FORMATS[fmt]}生成失败。"
+    
+    if os.path.getsize(path) > MAX_ZIP_SIZE:
+        logger.warning(f"文件大小超过限制: {os.path.getsize(path)} > {MAX_ZIP_SIZE}")
+        await run_backend(BACKEND.remove_artifact, artifact_key(jm_id, fmt))
+        FILE_LEASES.remove(path)
+        return None, f"抱歉，JM{jm_id}文件大小超过限制（{MAX_ZIP_SIZE/1024/1024}MB），无法发送。"
+    
+    # 持有到上传结束，期间过期清理不会删掉它；由调用方释放
+    FILE_LEASES.acquire(path)
+    return path, None
+
+async def process_job(job: dict):
+    jm_ids = job['jm_ids']
+    group_id = job['group_id']
+    fmt = job['fmt']
+    label = "、".join(jm_ids)
+    current_self_id.set(job.get('self_id'))
+    job_dir = os.path.join(DOWNLOAD_DIR, f"{WORKER_ID}_{job['id']}")
+    progress = JOB_PROGRESS[job['id']] = JobProgress(job)
+    reporter = asyncio.create_task(report_progress(progress))
+    # 任务目录归本任务所有，任务结束前过期清理只会推迟删除
+    FILE_LEASES.acquire(job_dir)
+    built = []
+    
+    try:
+        logger.info(f"使用{OUTPUT_FORMATS[fmt]}发送方式")
+        semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
         
-        current_time = time.time()
-        if group_id in GROUP_COOLDOWNS:
-            remaining_time = int(GROUP_COOLDOWNS[group_id] - current_time)
-            if remaining_time > 0:
-                hours = remaining_time // 3600
-                minutes = (remaining_time % 3600) // 60
-                seconds = remaining_time % 60
-                
-                time_msg = []
-                if hours > 0:
-                    time_msg.append(f"{hours}小时")
-                if minutes > 0:
-                    time_msg.append(f"{minutes}分钟")
-                if seconds > 0:
-                    time_msg.append(f"{seconds}秒")
-                
-                wait_time = "".join(time_msg)
-                logger.info(f"群 {group_id} 在CD中，剩余 {wait_time}")
-                await send_group_message(group_id, f"本群需要等待 {wait_time} 后才能再次下载。")
-                return
+        async def prepare(jm_id):
+            async with semaphore:
+                # 轮到这个本子时才开始计时，排在同一批后面不算超时
+                album = progress.album(jm_id)
+                try:
+                    return await prepare_artifact(jm_id, fmt, job_dir, album)
+                finally:
+                    album.set_stage('done')
         
-        await send_group_message(group_id, f"正在发送JM{jm_id}，请稍候...")
+        # 已经上传过的直接转发，不用重新下载和生成
+        reused = [jm_id for jm_id in jm_ids if await share_uploaded_file(group_id, jm_id, fmt)]
+        remaining = [jm_id for jm_id in jm_ids if jm_id not in reused]
         
-        try:
-            if PDF_ENABLED:
-                logger.info("使用PDF发送方式")
-                pdf_path = await download_pdf(jm_id, user_id)
-                if not pdf_path or not os.path.exists(pdf_path):
-                    logger.error("PDF生成失败")
-                    await send_group_message(group_id, f"发送JM{jm_id}失败：PDF生成失败。")
-                    return
-                    
-                if os.path.getsize(pdf_path) > MAX_ZIP_SIZE:
-                    logger.warning(f"PDF文件大小超过限制: {os.path.getsize(pdf_path)} > {MAX_ZIP_SIZE}")
-                    await send_group_message(group_id, f"抱歉，文件大小超过限制（{MAX_ZIP_SIZE/1024/1024}MB），无法发送。")
-                    os.remove(pdf_path)
-                    return
-                
-                logger.info(f"开始上传PDF文件: {pdf_path}")
-                data = {
-                    "action": "send_group_msg",
-                    "params": {
-                        "group_id": group_id,
-                        "message": [
-                            {
-                                "type": "file",
-                                "data": {
-                                    "name": f"【{jm_id}】.pdf",
-                                    "file": pdf_path,
-                                    "path": f"【{jm_id}】.pdf"
-                                }
-                            }
-                        ]
-                    }
-                }
-                result = await call_onebot_api("send_group_msg", data)
-                
-                if result:
-                    logger.info("PDF文件上传成功")
-                    await send_group_message(group_id, f"JM{jm_id}发送完成！")
-                    await cleanup_user_files(user_id, jm_id)
-                    # 清理控制台日志
-                    os.system('cls' if os.name == 'nt' else 'clear')
-                    logger.info(f"JM{jm_id}发送完成，已清理控制台日志")
+        progress.set_stage('prepare')
+        results = await asyncio.gather(*(prepare(jm_id) for jm_id in remaining))
+        built = [(jm_id, path) for jm_id, (path, _) in zip(remaining, results) if path]
+        errors = [error for _, error in results if error]
+        # 上传时read_chunk每片重新打开文件，其他进程的清理要看到租约才不会中途删掉
+        for jm_id, _ in built:
+            await run_backend(BACKEND.lease_artifact, artifact_key(jm_id, fmt), job['id'])
+        
+        sent = list(reused)
+        progress.set_stage('upload')
+        if len(built) > 1 and BATCH_BUNDLE and sum(os.path.getsize(p) for _, p in built) <= MAX_ZIP_SIZE:
+            sent_ids = [jm_id for jm_id, _ in built]
+            os.makedirs(job_dir, exist_ok=True)
+            bundle_path = os.path.join(job_dir, f"{'_'.join(sent_ids)}.zip")
+            loop = asyncio.get_running_loop()
+            # 加密zip的合集文件名带着密码，外层也要用同一个密码加密
+            password = ZIP_PASSWORD if fmt == 'ezip' else None
+            await loop.run_in_executor(None, build_bundle, [(p, artifact_name(j, fmt)) for j, p in built], bundle_path, password)
+            if fmt == 'ezip':
+                bundle_name = artifact_name("、".join(sent_ids), fmt)
+            else:
+                bundle_name = f"【{'、'.join(sent_ids)}】.zip"
+            if await upload_group_file(group_id, bundle_path, bundle_name):
+                sent += sent_ids
+            else:
+                errors.append(f"JM{'、'.join(sent_ids)}上传失败：上传请求失败。")
+        else:
+            for jm_id, path in built:
+                record = await upload_group_file(group_id, path, artifact_name(jm_id, fmt))
+                if record:
+                    sent.append(jm_id)
+                    await record_upload(jm_id, fmt, record)
                 else:
-                    logger.error("PDF文件上传失败")
-                    await send_group_message(group_id, f"JM{jm_id}上传失败：上传请求失败。")
-                
-                GROUP_COOLDOWNS[group_id] = current_time + COOLDOWN
-                logger.info(f"群 {group_id} 进入CD，剩余 {COOLDOWN} 秒")
-                return
+                    errors.append(f"JM{jm_id}上传失败：上传请求失败。")
+        
+        if len(jm_ids) == 1:
+            if sent:
+                await send_group_message(group_id, f"JM{label}发送完成！")
             else:
-                logger.info("使用ZIP发送方式")
-                user_download_dir = os.path.join(os.getcwd(), DOWNLOAD_DIR, str(user_id))
-                os.makedirs(user_download_dir, exist_ok=True)
-                
-                original_dir = os.getcwd()
-                
+                await send_group_message(group_id, errors[0])
+        elif sent:
+            summary = f"JM{'、'.join(sent)}发送完成！"
+            if errors:
+                summary += "\n" + "\n".join(errors)
+            await send_group_message(group_id, summary)
+        else:
+            await send_group_message(group_id, "\n".join(errors))
+        
+        if not sent:
+            await run_backend(BACKEND.set_cooldown, group_id, 0)
+        
+        logger.info(f"JM{label}处理完成")
+        
+    except asyncio.CancelledError:
+        # 被看门狗强制回收时告诉用户，进程退出时的取消直接传下去
+        if job['id'] in WATCHDOG.recycled:
+            await send_group_message(group_id, f"JM{label}已取消：{progress.cancel_reason}，请稍后重试。")
+            await run_backend(BACKEND.set_cooldown, group_id, 0)
+        raise
+    
+    except Exception as e:
+        logger.error(f"下载JM{label}失败: {e}")
+        await send_group_message(group_id, f"下载JM{label}失败，请稍后重试。")
+        await run_backend(BACKEND.set_cooldown, group_id, 0)
+    
+    finally:
+        progress.set_stage('done')
+        reporter.cancel()
+        JOB_PROGRESS.pop(job['id'], None)
+        for _, path in built:
+            FILE_LEASES.release(path)
+        FILE_LEASES.release(job_dir)
+        remove_job_dir(job_dir)
+        if built:
+            await run_backend(BACKEND.release_leases, job['id'])
+
+def start_workers():
+    """按WORKER_CONCURRENCY补齐worker，启动时和重新加载配置后调用"""
+    for index in range(WORKER_CONCURRENCY):
+        if index not in WORKER_TASKS:
+            WORKER_TASKS[index] = asyncio.create_task(worker_loop(index))
+
+async def worker_loop(index: int):
+    """从共享队列领取任务，多个进程的worker一起消费同一个队列"""
+    logger.info(f"worker {WORKER_ID}#{index} 已启动")
+    while True:
+        if index >= WORKER_CONCURRENCY:
+            WORKER_TASKS.pop(index, None)
+            logger.info(f"worker {WORKER_ID}#{index} 已停止")
+            return
+        try:
+            job = await run_backend(BACKEND.claim_job, WORKER_ID, list(BOT_CONNECTIONS))
+            if job is None:
+                JOB_AVAILABLE.clear()
                 try:
-                    os.chdir(user_download_dir)
-                    logger.info(f"切换到用户下载目录: {user_download_dir}")
-                    
-                    # 使用配置文件创建下载选项
-                    option = jmcomic.create_option_by_file('jm-option.yml')
-                    logger.info("已加载JM下载配置")
-                    
-                    # 使用配置选项下载
-                    jmcomic.download_album(jm_id, option)
-                    logger.info(f"JM{jm_id}下载完成")
-                    
-                    zip_path = os.path.join(original_dir, ZIP_DIR, f"{jm_id}.zip")
-                    inner_zip_path = os.path.join(original_dir, ZIP_DIR, f"{jm_id}_inner.zip")
-                    logger.info(f"开始打包JM{jm_id}")
-                    
-                    password = ZIP_PASSWORD
-                    logger.info(f"使用固定密码: {password}")
-                    
-                    download_path = user_download_dir
-                    logger.info(f"下载目录: {download_path}")
-                    
-                    if not os.path.exists(download_path):
-                        logger.error(f"下载目录不存在: {download_path}")
-                        await send_group_message(group_id, f"下载JM{jm_id}失败：找不到下载目录。")
-                        return
-                        
-                    os.makedirs(ZIP_DIR, exist_ok=True)
-                    
-                    with zipfile.ZipFile(inner_zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                        for root, _, files in os.walk(download_path):
-                            for file in files:
-                                file_path = os.path.join(root, file)
-                                arcname = os.path.relpath(file_path, download_path)
-                                logger.info(f"正在添加文件到内层zip: {file_path}")
-                                zipf.write(file_path, arcname)
-                    logger.info(f"内层压缩包创建完成: {inner_zip_path}")
-                    
-                    logger.info(f"正在创建AES加密的外层压缩包: {zip_path}")
-                    password_bytes = password.encode('utf-8')
-                    with pyzipper.AESZipFile(zip_path, 'w', compression=pyzipper.ZIP_DEFLATED, encryption=pyzipper.WZ_AES) as zipf:
-                        logger.info(f"正在设置AES加密密码: {password}")
-                        zipf.setpassword(password_bytes)
-                        logger.info("正在添加内层压缩包到外层zip")
-                        zipf.write(inner_zip_path, f"{jm_id}.zip")
-                        logger.info("外层压缩包创建完成")
-                    
-                    try:
-                        with pyzipper.AESZipFile(zip_path) as zipf:
-                            logger.info("正在验证压缩包加密")
-                            zipf.setpassword(password_bytes)
-                            zipf.extractall(path=os.path.join(original_dir, "test_extract"))
-                            logger.info("压缩包AES加密验证成功")
-                        shutil.rmtree(os.path.join(original_dir, "test_extract"))
-                    except Exception as e:
-                        logger.error(f"压缩包AES加密验证失败: {e}")
-                        raise Exception("压缩包AES加密失败")
-                    
-                    if not os.path.exists(zip_path):
-                        logger.error(f"zip文件创建失败: {zip_path}")
-                        await send_group_message(group_id, f"打包JM{jm_id}失败。")
-                        return
-                        
-                    logger.info(f"zip文件创建成功: {zip_path}")
-                    
-                    if os.path.getsize(zip_path) > MAX_ZIP_SIZE:
-                        logger.warning(f"文件大小超过限制: {os.path.getsize(zip_path)} > {MAX_ZIP_SIZE}")
-                        await send_group_message(group_id, f"抱歉，文件大小超过限制（{MAX_ZIP_SIZE/1024/1024}MB），无法发送。")
-                        return
-                    
-                    logger.info(f"开始上传文件: {zip_path}")
-                    
-                    data = {
-                        "action": "send_group_msg",
-                        "params": {
-                            "group_id": group_id,
-                            "message": [
-                                {
-                                    "type": "file",
-                                    "data": {
-                                        "name": f"密码{password}【{jm_id}】.zip",
-                                        "file": zip_path,
-                                        "path": f"密码{password}【{jm_id}】.zip"
-                                    }
-                                }
-                            ]
-                        }
-                    }
-                    result = await call_onebot_api("send_group_msg", data)
-                    
-                    if result:
-                        logger.info("文件上传成功")
-                        await send_group_message(group_id, f"JM{jm_id}发送完成！")
-                        await cleanup_user_files(user_id, jm_id)
-                    else:
-                        logger.error("文件上传失败")
-                        await send_group_message(group_id, f"JM{jm_id}上传失败：上传请求失败。")
-                    
-                    GROUP_COOLDOWNS[group_id] = current_time + COOLDOWN
-                    logger.info(f"群 {group_id} 进入CD，剩余 {COOLDOWN} 秒")
-                    
-                    logger.info(f"JM{jm_id}处理完成")
-                    
-                finally:
-                    os.chdir(original_dir)
-                    logger.info(f"恢复工作目录: {original_dir}")
-                    
+                    await asyncio.wait_for(JOB_AVAILABLE.wait(), STORAGE_SYNC_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            logger.info(f"worker {WORKER_ID}#{index} 领取任务 {job['id']}: JM{'、'.join(job['jm_ids'])}")
+            # 单独的协程任务，卡住时看门狗只取消它，worker继续领取下一个任务
+            job_task = WATCHDOG.tasks[job['id']] = asyncio.create_task(process_job(job))
+            requeue = False
+            try:
+                await job_task
+            except asyncio.CancelledError:
+                if job['id'] not in WATCHDOG.recycled:
+                    # 进程退出时worker被取消，任务还没做完，放回队列由其他进程或重启后继续
+                    requeue = True
+                    raise
+                logger.warning(f"worker {WORKER_ID}#{index} 的任务 {job['id']} 已被回收")
+            finally:
+                WATCHDOG.tasks.pop(job['id'], None)
+                WATCHDOG.recycled.discard(job['id'])
+                if requeue:
+                    await run_backend(BACKEND.requeue_job, job['id'])
+                    logger.info(f"任务 {job['id']} 已放回队列")
+                else:
+                    await run_backend(BACKEND.finish_job, job['id'])
+                
+        except Exception as e:
+            logger.error(f"worker {WORKER_ID}#{index} 出错: {e}")
+            await asyncio.sleep(5)
+
+async def sync_task():
+    """定期同步其他进程修改的共享状态，并为正在执行的任务续期"""
+    global ENABLED_GROUPS
+    while True:
+        try:
+            await asyncio.sleep(STORAGE_SYNC_INTERVAL)
+            groups = await run_backend(BACKEND.get_enabled_groups)
+            if groups != ENABLED_GROUPS:
+                save_enabled_groups(groups)
+            ENABLED_GROUPS = groups
+            await run_backend(BACKEND.heartbeat, WORKER_ID)
         except Exception as e:
-            logger.error(f"下载JM{jm_id}失败: {e}")
-            await send_group_message(group_id, f"下载JM{jm_id}失败，请稍后重试。")
+            logger.error(f"同步共享状态失败: {e}")
+
+def in_quiet_hours(now: datetime) -> bool:
+    """quiet_hours格式为 "03:00-07:00"，结束时间早于开始时间表示跨过午夜"""
+    start, end = (datetime.strptime(t.strip(), "%H:%M").time() for t in PREFETCH_QUIET_HOURS.split('-'))
+    current = now.time()
+    if start <= end:
+        return start <= current < end
+    return current >= start or current < end
+
+async def prefetch_ready() -> bool:
+    """预取只在没有用户任务、镜像站没有限流、磁盘空间充足时进行"""
+    if not in_quiet_hours(datetime.now()):
+        return False
+    if JOB_PROGRESS:
+        logger.info("有正在执行的任务，暂停预取")
+        return False
+    if GOVERNOR.stats()['paused'] > 0:
+        logger.info("镜像站限流中，暂停预取")
+        return False
+    artifacts = await run_backend(BACKEND.list_artifacts)
+    if sum(a['size'] for a in artifacts) >= PREFETCH_MAX_DISK:
+        logger.info("成品文件已达到预取磁盘配额，停止预取")
+        return False
+    if shutil.disk_usage(DOWNLOAD_DIR).free < PREFETCH_MIN_FREE:
+        logger.info("磁盘剩余空间不足，停止预取")
+        return False
+    return True
+
+async def run_prefetch():
+    since = time.time() - PREFETCH_WINDOW_DAYS * 86400
+    candidates = await run_backend(BACKEND.top_requests, since, PREFETCH_TOP_N)
+    for jm_id, fmt, count in candidates:
+        if count < PREFETCH_MIN_REQUESTS:
+            break
+        artifact = await run_backend(BACKEND.get_artifact, artifact_key(jm_id, fmt))
+        if artifact and os.path.exists(artifact['path']):
+            continue
+        if not await prefetch_ready():
+            return
         
+        logger.info(f"预取热门本子JM{jm_id}（{OUTPUT_FORMATS.get(fmt, fmt)}，近{PREFETCH_WINDOW_DAYS}天请求{count}次）")
+        job_dir = os.path.join(DOWNLOAD_DIR, f"{WORKER_ID}_prefetch_{jm_id}")
+        # 和用户任务一样受看门狗管理，卡住的预取不会一直占着正在生成的文件
+        job = {"id": f"预取JM{jm_id}", "jm_ids": [jm_id], "group_id": None}
+        progress = JOB_PROGRESS[job['id']] = JobProgress(job)
+        build = WATCHDOG.tasks[job['id']] = asyncio.create_task(get_or_build_artifact(jm_id, fmt, job_dir, progress))
+        FILE_LEASES.acquire(job_dir)
+        try:
+            await build
+        except asyncio.CancelledError:
+            if job['id'] not in WATCHDOG.recycled:
+                build.cancel()
+                raise
+            logger.warning(f"预取JM{jm_id}已被回收: {progress.cancel_reason}")
+        except Exception as e:
+            logger.error(f"预取JM{jm_id}失败: {e}")
         finally:
-            try:
-                if 'download_path' in locals() and os.path.exists(download_path):
-                    shutil.rmtree(download_path)
-                if 'zip_path' in locals() and os.path.exists(zip_path):
-                    os.remove(zip_path)
-            except Exception as e:
-                logger.error(f"清理临时文件失败: {e}")
-                
+            progress.set_stage('done')
+            JOB_PROGRESS.pop(job['id'], None)
+            WATCHDOG.tasks.pop(job['id'], None)
+            WATCHDOG.recycled.discard(job['id'])
+            FILE_LEASES.release(job_dir)
+            remove_job_dir(job_dir)
+
+async def prefetch_task():
+    """在闲时把近期请求最多的本子提前下载生成好，高峰期的首次请求可以直接复用"""
+    logger.info(f"已启用闲时预取，时段 {PREFETCH_QUIET_HOURS}，每次最多 {PREFETCH_TOP_N} 个")
+    while True:
+        try:
+            await asyncio.sleep(PREFETCH_INTERVAL)
+            if not PREFETCH_ENABLED:
+                logger.info("已停用闲时预取")
+                return
+            if await prefetch_ready():
+                await run_prefetch()
+        except Exception as e:
+            logger.error(f"预取任务失败: {e}")
+
+PREFETCH_TASK = None
+
+def start_prefetch():
+    global PREFETCH_TASK
+    if PREFETCH_TASK is None or PREFETCH_TASK.done():
+        PREFETCH_TASK = asyncio.create_task(prefetch_task())
+
+CONFIG_PATH = os.path.join(script_dir, "config.yml")
+
+# 配置项 -> 最小值，重新加载前检查，启动时沿用原来宽松的读取方式
+CONFIG_NUMBERS = {
+    'download': {'cooldown': 0},
+    'files': {'max_zip_size': 1},
+    'cleanup': {'interval': 1},
+    'worker': {'concurrency': 1, 'stale_after': 1, 'rebind_after': 1},
+    'batch': {'max_ids': 1, 'concurrency': 1},
+    'governor': {'max_concurrency': 1, 'min_concurrency': 1, 'bytes_per_second': 0, 'recover_after': 1, 'max_backoff': 0},
+    'upload': {'chunk_size': 1, 'concurrency': 1, 'retries': 0, 'retry_interval': 0, 'file_retention': 0, 'reuse_ttl': 0},
+    'scratch': {'page_size': 1, 'unknown_pages': 1, 'reserve': 0, 'wait': 0},
+    'watchdog': {'queued_timeout': 0, 'download_timeout': 0, 'render_timeout': 0, 'save_timeout': 0, 'upload_timeout': 0, 'stall_timeout': 0, 'grace': 0,
+                 'shared_timeout': 0, 'check_interval': 1},
+    'progress': {'interval': 1, 'min_interval': 0, 'sync_interval': 1},
+    'storage': {'sync_interval': 1, 'artifact_ttl': 0, 'flush_delay': 0},
+    'prefetch': {'top_n': 1, 'window_days': 1, 'min_requests': 1, 'max_disk_usage': 0, 'min_free_disk': 0, 'check_interval': 1},
+    'mirror': {'probe_interval': 1, 'probe_timeout': 1},
+    'debug': {'max_profile_seconds': 1},
+    'reload': {'interval': 1}
+}
+
+# 改了之后要重启才生效的配置：连接、存储后端和日志在启动时就已经建立
+RESTART_SETTINGS = [
+    ('onebot', None), ('server', None), ('log', None), ('console', None), ('worker', 'id'),
+    ('storage', 'backend'), ('storage', 'sqlite_path'), ('storage', 'redis_url'), ('debug', 'report_dir'),
+    ('files', 'password')
+]
+
+def validate_config(config) -> list:
+    """返回配置中的错误说明，空列表表示可以使用"""
+    if not isinstance(config, dict):
+        return ["config.yml 顶层必须是字典"]
+    errors = [f"{name} 必须是字典" for name, section in config.items() if not isinstance(section, dict)]
+    if errors:
+        return errors
+    
+    for name, limits in CONFIG_NUMBERS.items():
+        for key, minimum in limits.items():
+            value = config.get(name, {}).get(key)
+            if value is None:
+                continue
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value < minimum:
+                errors.append(f"{name}.{key} 必须是不小于{minimum}的数字")
+    
+    for level in ('user', 'group', 'global'):
+        limit = config.get('ratelimit', {}).get(level, {})
+        if not isinstance(limit, dict) or any(
+                isinstance(limit.get(key, 0), bool) or not isinstance(limit.get(key, 0), (int, float)) or limit.get(key, 0) < 0
+                for key in ('per_minute', 'burst')):
+            errors.append(f"ratelimit.{level} 的per_minute和burst必须是非负数")
+        elif limit.get('per_minute', 0) and limit.get('burst', 1) < 1:
+            # 容量为0的桶会放行所有请求，要关闭这一级限流应把per_minute设为0
+            errors.append(f"ratelimit.{level}.burst 至少为1，不限制请把per_minute设为0")
+    
+    admins = config.get('admin', {}).get('qq_numbers', [])
+    if not isinstance(admins, list) or not all(isinstance(qq, int) for qq in admins):
+        errors.append("admin.qq_numbers 必须是QQ号列表")
+    
+    output = config.get('output', {})
+    if output.get('default_format') and output['default_format'] not in OUTPUT_FORMATS:
+        errors.append(f"output.default_format 必须是 {'、'.join(OUTPUT_FORMATS)} 之一")
+    if not isinstance(output.get('formats', []), list):
+        errors.append("output.formats 必须是列表")
+    
+    if config.get('upload', {}).get('mode', 'stream') not in ('stream', 'message'):
+        errors.append("upload.mode 必须是 stream 或 message")
+    
+    governor = config.get('governor', {})
+    if governor.get('min_concurrency', 2) > governor.get('max_concurrency', 16):
+        errors.append("governor.min_concurrency 不能大于 max_concurrency")
+    
+    stall_timeout = config.get('watchdog', {}).get('stall_timeout', 180)
+    if stall_timeout and config.get('scratch', {}).get('wait', 120) >= stall_timeout:
+        errors.append("scratch.wait 必须小于 watchdog.stall_timeout")
+    
+    dirs = config.get('scratch', {}).get('dirs', []) or []
+    if not isinstance(dirs, list) or not all(isinstance(d, str) or (isinstance(d, dict) and d.get('path')) for d in dirs):
+        errors.append("scratch.dirs 的每一项必须是路径或包含path的字典")
+    
+    if not re.fullmatch(r'\s*\d{1,2}:\d{2}\s*-\s*\d{1,2}:\d{2}\s*', str(config.get('prefetch', {}).get('quiet_hours', "03:00-07:00"))):
+        errors.append("prefetch.quiet_hours 格式应为 HH:MM-HH:MM")
+    return errors
+
+def load_settings() -> tuple:
+    """读取并校验两个配置文件，任何一个有问题都抛出异常，在线程池中调用"""
+    with open(CONFIG_PATH, 'r', encoding='utf-8') as f:
+        config = yaml.safe_load(f) or {}
+    errors = validate_config(config)
+    if errors:
+        raise ValueError("；".join(errors))
+    try:
+        jm_option_data = load_jm_option_data()
     except Exception as e:
-        logger.error(f"处理消息数据失败: {e}")
+        raise ValueError(f"jm-option.yml 无效: {e}")
+    return config, jm_option_data
+
+def apply_settings(config: dict, jm_option_data: dict) -> list:
+    """在事件循环线程里一次性切换到新配置，返回需要重启才能生效的配置项"""
+    global CONFIG, JM_OPTION_DATA
+    restart = []
+    for section, key in RESTART_SETTINGS:
+        old = CONFIG.get(section, {})
+        new = config.get(section, {})
+        if key is not None:
+            old, new = old.get(key), new.get(key)
+        if old != new:
+            restart.append(section if key is None else f"{section}.{key}")
+    
+    apply_config(config)
+    RATE_LIMITER.configure(config.get('ratelimit', {}))
+    GOVERNOR.configure(config.get('governor', {}))
+    DOMAIN_HEALTH.configure(config.get('mirror', {}))
+    SCRATCH.configure(config.get('scratch', {}))
+    WATCHDOG.configure(config.get('watchdog', {}))
+    ENABLED_GROUPS_STATE.delay = config.get('storage', {}).get('flush_delay', 2)
+    CONFIG = config
+    JM_OPTION_DATA = jm_option_data
+    
+    start_workers()
+    # 唤醒空闲的worker，多出来的立即退出
+    JOB_AVAILABLE.set()
+    if PREFETCH_ENABLED:
+        start_prefetch()
+    return restart
+
+async def reload_config() -> list:
+    config, jm_option_data = await asyncio.get_running_loop().run_in_executor(None, load_settings)
+    restart = apply_settings(config, jm_option_data)
+    logger.info(f"配置已重新加载: worker {WORKER_CONCURRENCY} 个，图片并发上限 {GOVERNOR.max_concurrency}，"
+                f"下载冷却 {COOLDOWN} 秒，最大文件 {MAX_ZIP_SIZE/1024/1024}MB")
+    if restart:
+        logger.warning(f"以下配置需要重启后生效: {'、'.join(restart)}")
+    return restart
+
+def config_mtimes() -> tuple:
+    mtimes = []
+    for path in (CONFIG_PATH, JM_OPTION_PATH):
+        try:
+            mtimes.append(os.stat(path).st_mtime_ns)
+        except OSError:
+            mtimes.append(None)
+    return tuple(mtimes)
+
+async def config_watch_task():
+    """配置文件修改后自动重新加载；文件连续两次检查没有变化才加载，避免读到写了一半的文件"""
+    applied = pending = config_mtimes()
+    while True:
+        await asyncio.sleep(RELOAD_INTERVAL)
+        if not RELOAD_WATCH:
+            continue
+        current = config_mtimes()
+        if current == applied:
+            continue
+        if current != pending:
+            pending = current
+            continue
+        applied = current
+        try:
+            await reload_config()
+        except Exception as e:
+            logger.error(f"重新加载配置失败，继续使用原配置: {e}")
 
 def check_port(host: str, port: int) -> bool:
     try:
@@ -1125,11 +3661,15 @@ def generate_random_password(length=8):
     return ''.join(random.choice(characters) for _ in range(length))
 
 def cleanup_all_files():
+    """启动时只清理本进程留下的下载目录，共享的成品文件由索引管理"""
     try:
-        # 清理downloads目录
-        if os.path.exists(DOWNLOAD_DIR):
-            for item in os.listdir(DOWNLOAD_DIR):
-                item_path = os.path.join(DOWNLOAD_DIR, item)
+        for root in {DOWNLOAD_DIR, *SCRATCH.roots()}:
+            if not os.path.exists(root):
+                continue
+            for item in os.listdir(root):
+                if not item.startswith(f"{WORKER_ID}_"):
+                    continue
+                item_path = os.path.join(root, item)
                 try:
                     if os.path.isdir(item_path):
                         shutil.rmtree(item_path)
@@ -1139,35 +3679,49 @@ def cleanup_all_files():
                 except Exception as e:
                     logger.error(f"删除文件失败 {item_path}: {e}")
 
-        # 清理zips目录
-        if os.path.exists(ZIP_DIR):
-            for item in os.listdir(ZIP_DIR):
-                item_path = os.path.join(ZIP_DIR, item)
-                try:
-                    os.remove(item_path)
-                    logger.info(f"已删除: {item_path}")
-                except Exception as e:
-                    logger.error(f"删除文件失败 {item_path}: {e}")
-
-        # 清理pdf目录
-        if os.path.exists(PDF_DIR):
-            for item in os.listdir(PDF_DIR):
-                item_path = os.path.join(PDF_DIR, item)
-                try:
-                    os.remove(item_path)
-                    logger.info(f"已删除: {item_path}")
-                except Exception as e:
-                    logger.error(f"删除文件失败 {item_path}: {e}")
+        # 去掉文件已不存在的索引
+        for artifact in BACKEND.list_artifacts():
+            if not os.path.exists(artifact['path']):
+                BACKEND.remove_artifact(artifact['key'])
 
         logger.info("所有临时文件清理完成")
     except Exception as e:
         logger.error(f"清理文件失败: {e}")
 
+def init(data_dir: Optional[str] = None):
+    """启动前的准备：日志、数据目录和共享状态后端，导入本模块本身不创建任何文件
+
+    data_dir 为下载、成品、状态数据库、日志和调试报告所在目录，默认为bot.py所在目录；
+    bench.py、loadtest.py和测试传入临时目录，不会碰到正在使用的机器人数据。
+    """
+    global DOWNLOAD_DIR, ZIP_DIR, PDF_DIR, STORAGE_DB_PATH, DEBUG_REPORT_DIR
+    data_dir = data_dir or script_dir
+    setup_logging(os.path.join(data_dir, "log"))
+
+    DOWNLOAD_DIR = os.path.join(data_dir, "downloads")
+    ZIP_DIR = os.path.join(data_dir, "zips")
+    PDF_DIR = os.path.join(data_dir, "pdf")
+    for path in (DOWNLOAD_DIR, ZIP_DIR, PDF_DIR):
+        os.makedirs(path, exist_ok=True)
+    STORAGE_DB_PATH = os.path.join(data_dir, CONFIG.get('storage', {}).get('sqlite_path', 'state.db'))
+    DEBUG_REPORT_DIR = os.path.join(data_dir, CONFIG.get('debug', {}).get('report_dir', 'reports'))
+    ENABLED_GROUPS_STATE.path = os.path.join(data_dir, "enabled_groups.json")
+    # 没有配置临时目录时使用DOWNLOAD_DIR
+    SCRATCH.configure(CONFIG.get('scratch', {}))
+
+    load_shared_state()
+
 if __name__ == '__main__':
+    init()
     logger.info("正在清理临时文件...")
     cleanup_all_files()
     
-    max_retries = 3
+    if ONEBOT_TRANSPORTS & {'ws_reverse', 'http'}:
+        # 反向WebSocket和HTTP上报需要固定端口供OneBot实现连接
+        client_port = SERVER_PORT
+        max_retries = 0
+    else:
+        max_retries = 3
     for attempt in range(max_retries):
         try:
             client_port = find_free_port()
@@ -1182,5 +3736,6 @@ if __name__ == '__main__':
                 logger.error(f"选择客户端端口失败，已重试 {max_retries} 次")
                 sys.exit(1)
     
-    logger.info(f"机器人已启动，正在连接go-cqhttp WebSocket ({ONEBOT_HOST}:{ONEBOT_PORT})...")
-    web.run_app(init_app(), host=SERVER_HOST, port=client_port)
\ No newline at end of file
+    logger.info(f"机器人已启动，连接方式: {', '.join(sorted(ONEBOT_TRANSPORTS))}")
+    web.run_app(init_app(), host=SERVER_HOST, port=client_port)
+    ENABLED_GROUPS_STATE.flush()
\ No newline at end of file
@@ -0,0 +1,268 @@
+"""本地假服务，用于在不连接真实镜像站和QQ的情况下测试机器人
+
+    python fake_servers.py mirror --domains 3
+    python fake_servers.py onebot --port 5700
+
+假镜像：把输出的域名填到 config.yml 的 mirror.domains，并把 mirror.scheme 改为 http。
+假OneBot：机器人用默认的正向WebSocket配置即可连上，收到的API调用会打印出来。
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import itertools
+import json
+import random
+import time
+
+from aiohttp import web, WSMsgType
+
+
+class FakeMirror:
+    """模拟一组jmcomic镜像域名，每个域名一个端口，可分别设置延迟和错误率"""
+
+    def __init__(self, host: str = '127.0.0.1'):
+        self.host = host
+        self.domains = {}
+        self.requests = {}
+        self.image = b''
+        self.app = web.Application()
+        self.app.router.add_route('*', '/{tail:.*}', self.handle)
+        self.runner = None
+
+    def add_domain(self, port: int, latency: float = 0.0, error_rate: float = 0.0, status: int = 503) -> str:
+        domain = f"{self.host}:{port}"
+        self.domains[domain] = {"latency": latency, "error_rate": error_rate, "status": status}
+        self.requests[domain] = 0
+        return domain
+
+    def set_domain(self, domain: str, **settings):
+        self.domains[domain].update(settings)
+
+    def set_image(self, data: bytes):
+        """/media/photos/ 下的所有请求都返回这张图片"""
+        self.image = data
+
+    async def handle(self, request):
+        settings = self.domains.get(request.host)
+        if settings is None:
+            return web.Response(status=404)
+        self.requests[request.host] += 1
+        if settings["latency"]:
+            await asyncio.sleep(settings["latency"])
+        if random.random() < settings["error_rate"]:
+            return web.Response(status=settings["status"])
+        if request.path.startswith('/media/photos/'):
+            return web.Response(body=self.image, content_type='image/jpeg')
+        return web.Response(text="ok")
+
+    async def start(self):
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        for domain in self.domains:
+            port = int(domain.rsplit(':', 1)[1])
+            await web.TCPSite(self.runner, self.host, port).start()
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+
+class FakeOneBot:
+    """模拟OneBot正向WebSocket服务端：按echo回复机器人的API调用，并能向机器人推送群消息事件
+
+    支持NapCat的upload_file_stream分片上传和upload_group_file，上传完成的文件记录在uploads里；
+    stream_support=False 时这两个动作返回1404，模拟不支持分片上传的实现。
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 5700, self_id: int = 10000,
+                 latency: float = 0.0, jitter: float = 0.0, fail_rate: float = 0.0, stream_support: bool = True):
+        self.host = host
+        self.port = port
+        self.self_id = self_id
+        self.latency = latency
+        self.jitter = jitter
+        self.fail_rate = fail_rate
+        self.stream_support = stream_support
+        # 分片会话跨连接保留，断线重连后可以续传
+        self.streams = {}
+        self.stream_files = {}
+        self.uploads = []
+        self.clients = set()
+        self.calls = []
+        self.on_call = None
+        self.connected = asyncio.Event()
+        self.message_ids = itertools.count(1)
+        self.app = web.Application()
+        self.app.router.add_get('/', self.handle)
+        self.runner = None
+
+    async def handle(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.clients.add(ws)
+        self.connected.set()
+        await ws.send_json({
+            "time": int(time.time()),
+            "self_id": self.self_id,
+            "post_type": "meta_event",
+            "meta_event_type": "lifecycle",
+            "sub_type": "connect"
+        })
+        try:
+            async for msg in ws:
+                if msg.type == WSMsgType.TEXT:
+                    call = json.loads(msg.data)
+                    if "action" in call:
+                        asyncio.create_task(self.reply(ws, call))
+                elif msg.type in (WSMsgType.CLOSED, WSMsgType.ERROR):
+                    break
+        finally:
+            self.clients.discard(ws)
+            if not self.clients:
+                self.connected.clear()
+        return ws
+
+    async def reply(self, ws, call: dict):
+        received = time.perf_counter()
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        if random.random() < self.fail_rate:
+            response = {"status": "failed", "retcode": 1400, "msg": "fake failure"}
+        else:
+            response = self.handle_action(call.get("action"), call.get("params", {}))
+        response["echo"] = call.get("echo")
+        self.calls.append((received, call))
+        if self.on_call is not None:
+            self.on_call(received, call)
+        if not ws.closed:
+            await ws.send_json(response)
+
+    def handle_action(self, action: str, params: dict) -> dict:
+        """按动作生成响应；get_group_file_url只认通过upload_group_file上传过的文件"""
+        if action in ("upload_file_stream", "upload_group_file") and not self.stream_support:
+            return {"status": "failed", "retcode": 1404, "msg": "不支持的Api"}
+        if action == "upload_file_stream":
+            return self.handle_stream(params)
+        if action == "upload_group_file":
+            data = self.stream_files.get(params.get("file"))
+            if data is None:
+                return {"status": "failed", "retcode": 1400, "msg": "file not found"}
+            file_id = f"/{hashlib.md5(data).hexdigest()}"
+            self.uploads.append({"group_id": params.get("group_id"), "name": params.get("name"), "data": data, "file_id": file_id})
+            return {"status": "ok", "retcode": 0, "data": {"file_id": file_id}}
+        if action == "get_group_file_url":
+            for upload in self.uploads:
+                if upload["group_id"] == params.get("group_id") and upload["file_id"] == params.get("file_id"):
+                    return {"status": "ok", "retcode": 0, "data": {"url": f"https://fake.qq/ftn{upload['file_id']}"}}
+            return {"status": "failed", "retcode": 1400, "msg": "file not found"}
+        return {"status": "ok", "retcode": 0, "data": {"message_id": next(self.message_ids)}}
+
+    def handle_stream(self, params: dict) -> dict:
+        stream_id = params.get("stream_id")
+        if params.get("is_complete"):
+            stream = self.streams.pop(stream_id, None)
+            if stream is None or len(stream["chunks"]) != stream["total_chunks"]:
+                return {"status": "failed", "retcode": 1400, "msg": "stream incomplete"}
+            data = b''.join(stream["chunks"][i] for i in range(stream["total_chunks"]))
+            sha256 = hashlib.sha256(data).hexdigest()
+            if stream["expected_sha256"] and sha256 != stream["expected_sha256"]:
+                return {"status": "failed", "retcode": 1400, "msg": "sha256 mismatch"}
+            file_path = f"/tmp/fake_onebot/{stream_id}/{stream['filename']}"
+            self.stream_files[file_path] = data
+            return {"status": "ok", "retcode": 0, "data": {
+                "type": "response", "status": "file_complete",
+                "file_path": file_path, "file_size": len(data), "sha256": sha256
+            }}
+        stream = self.streams.setdefault(stream_id, {
+            "chunks": {},
+            "total_chunks": params.get("total_chunks"),
+            "expected_sha256": params.get("expected_sha256"),
+            "filename": params.get("filename")
+        })
+        stream["chunks"][params.get("chunk_index")] = base64.b64decode(params.get("chunk_data", ""))
+        return {"status": "ok", "retcode": 0, "data": {
+            "type": "stream", "stream_id": stream_id, "status": "chunk_received",
+            "received_chunks": len(stream["chunks"]), "total_chunks": stream["total_chunks"]
+        }}
+
+    async def disconnect(self):
+        """断开所有客户端，模拟网络中断"""
+        for ws in list(self.clients):
+            await ws.close()
+
+    def group_message(self, group_id: int, user_id: int, text: str) -> dict:
+        return {
+            "time": int(time.time()),
+            "self_id": self.self_id,
+            "post_type": "message",
+            "message_type": "group",
+            "sub_type": "normal",
+            "message_id": next(self.message_ids),
+            "group_id": group_id,
+            "user_id": user_id,
+            "raw_message": text,
+            "message": [{"type": "text", "data": {"text": text}}],
+            "sender": {"user_id": user_id, "nickname": str(user_id)}
+        }
+
+    async def push_event(self, event: dict):
+        for ws in list(self.clients):
+            if not ws.closed:
+                await ws.send_str(json.dumps(event, ensure_ascii=False))
+
+    async def start(self):
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+
+async def run_onebot(args):
+    onebot = FakeOneBot(args.host, args.port, latency=args.latency)
+    onebot.on_call = lambda received, call: print(json.dumps(call, ensure_ascii=False))
+    await onebot.start()
+    print(f"假OneBot已启动: ws://{args.host}:{args.port}")
+    while True:
+        await asyncio.sleep(3600)
+
+
+async def run_mirror(args):
+    mirror = FakeMirror(args.host)
+    for i in range(args.domains):
+        mirror.add_domain(args.port + i, latency=args.latency * (i + 1), error_rate=args.error_rate)
+    await mirror.start()
+    print("假镜像域名: " + ", ".join(mirror.domains))
+    while True:
+        await asyncio.sleep(3600)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地假服务")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    mirror = sub.add_parser("mirror", help="假镜像站")
+    mirror.add_argument("--host", default="127.0.0.1")
+    mirror.add_argument("--port", type=int, default=18000, help="第一个域名的端口，后续域名依次加1")
+    mirror.add_argument("--domains", type=int, default=3)
+    mirror.add_argument("--latency", type=float, default=0.05, help="第n个域名的延迟为 n*latency 秒")
+    mirror.add_argument("--error-rate", type=float, default=0.0)
+
+    onebot = sub.add_parser("onebot", help="假OneBot正向WebSocket服务端")
+    onebot.add_argument("--host", default="127.0.0.1")
+    onebot.add_argument("--port", type=int, default=5700)
+    onebot.add_argument("--latency", type=float, default=0.0, help="每次API调用的回复延迟（秒）")
+
+    args = parser.parse_args()
+    if args.command == "mirror":
+        asyncio.run(run_mirror(args))
+    elif args.command == "onebot":
+        asyncio.run(run_onebot(args))
+
+
+if __name__ == '__main__':
+    main()
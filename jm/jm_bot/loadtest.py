@@ -0,0 +1,202 @@
+"""模拟大量群同时使用机器人的压测工具
+
+启动一个假的OneBot正向WebSocket服务端，让机器人连上来，然后按设定的速率从许多群注入
+群消息事件（/jm、/帮助 和普通聊天），统计机器人回复的延迟、丢失和超时情况：
+
+    python loadtest.py --groups 300 --rate 200 --duration 60 --mix jm=2,help=1,noise=97
+
+下载任务不会真的访问禁漫，build_artifact 被替换成等待 --job-seconds 秒后生成一个小文件，
+压测关注的是事件分发、队列和 connect_websocket / call_onebot_api 这条消息链路。
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import bot
+from fake_servers import FakeOneBot
+from bench import percentile
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.mix = []
+        for item in args.mix.split(','):
+            name, _, weight = item.partition('=')
+            self.mix.append((name.strip(), float(weight or 1)))
+        self.group_ids = [args.first_group + i for i in range(args.groups)]
+        self.jm_ids = itertools.count(100000)
+        # 群号 -> 等待首个回复的命令 [(注入时间, 类型)]
+        self.pending = {}
+        self.ack_latency = []
+        self.late = 0
+        self.dropped = 0
+        self.sent = {name: 0 for name, _ in self.mix}
+        self.api_latency = []
+        self.api_failures = 0
+        self.loop_lag = []
+        self.work_dir = tempfile.mkdtemp(prefix="jm_loadtest_")
+
+    def on_call(self, received: float, call: dict):
+        """假OneBot收到API调用时调用，把回复和最早一条等待中的同类命令配对"""
+        params = call.get("params", {})
+        group_id = params.get("group_id")
+        message = params.get("message")
+        if not isinstance(message, str):
+            return
+        if "可用命令" in message:
+            kind = "help"
+        elif message.startswith("进度：") or "发送完成" in message or "失败" in message:
+            return
+        else:
+            kind = "jm"
+        queue = self.pending.get(group_id, [])
+        for i, (injected, pending_kind) in enumerate(queue):
+            if pending_kind == kind:
+                del queue[i]
+                latency = received - injected
+                self.ack_latency.append(latency)
+                if latency * 1000 > self.args.late_ms:
+                    self.late += 1
+                return
+
+    def fake_build_artifact(self, jm_id, fmt, job_dir, progress=None):
+        if progress is not None:
+            progress.set_stage('download')
+        time.sleep(self.args.job_seconds)
+        path = os.path.join(self.work_dir, f"{jm_id}.{fmt}")
+        with open(path, 'wb') as f:
+            f.write(b'\0' * 1024)
+        return path
+
+    def instrument(self):
+        """在临时目录里初始化机器人，并统计机器人侧每次call_onebot_api的耗时和失败"""
+        # 状态数据库、日志和下载目录从一开始就建在临时目录里，不会打开或清理机器人自己的数据
+        bot.STORAGE_BACKEND = 'sqlite'
+        bot.init(self.work_dir)
+        call_onebot_api = bot.call_onebot_api
+
+        async def timed_call(endpoint, data, retry_count=0):
+            start = time.perf_counter()
+            result = await call_onebot_api(endpoint, data, retry_count)
+            if retry_count == 0:
+                self.api_latency.append(time.perf_counter() - start)
+                if result is None:
+                    self.api_failures += 1
+            return result
+
+        bot.call_onebot_api = timed_call
+        bot.build_artifact = self.fake_build_artifact
+        for group_id in self.group_ids:
+            bot.BACKEND.set_group_enabled(group_id, True)
+        bot.ENABLED_GROUPS = set(self.group_ids)
+        # 序号不小于WORKER_CONCURRENCY的worker会自行退出
+        bot.WORKER_CONCURRENCY = self.args.workers
+        if self.args.no_limits:
+            bot.RATE_LIMITER = bot.RateLimiter({})
+            bot.COOLDOWN = 0
+
+    async def measure_loop_lag(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(0.05)
+            self.loop_lag.append(loop.time() - start - 0.05)
+
+    def next_event(self, onebot: FakeOneBot):
+        kind = random.choices([n for n, _ in self.mix], [w for _, w in self.mix])[0]
+        group_id = random.choice(self.group_ids)
+        user_id = random.randint(1, self.args.users)
+        if kind == "jm":
+            text = f"/jm {next(self.jm_ids)}"
+        elif kind == "help":
+            text = "/帮助"
+        else:
+            text = random.choice(["哈哈哈", "今天吃什么", "[图片]", "有人吗", "jm是什么", "/jmx"])
+        self.sent[kind] += 1
+        if kind != "noise":
+            self.pending.setdefault(group_id, []).append((time.perf_counter(), kind))
+        return onebot.group_message(group_id, user_id, text)
+
+    async def run(self):
+        args = self.args
+        self.instrument()
+        onebot = FakeOneBot(port=args.port, latency=args.api_latency, jitter=args.api_jitter, fail_rate=args.fail_rate)
+        onebot.on_call = self.on_call
+        await onebot.start()
+
+        tasks = [
+            asyncio.create_task(bot.connect_websocket({"host": "127.0.0.1", "port": args.port})),
+            asyncio.create_task(bot.sync_task()),
+            asyncio.create_task(self.measure_loop_lag())
+        ]
+        tasks += [asyncio.create_task(bot.worker_loop(i)) for i in range(args.workers)]
+        await asyncio.wait_for(onebot.connected.wait(), 10)
+        while onebot.self_id not in bot.BOT_CONNECTIONS:
+            await asyncio.sleep(0.05)
+
+        print(f"开始压测: {args.groups}个群, {args.rate}条/秒, 持续{args.duration}秒")
+        start = time.perf_counter()
+        next_at = start
+        while time.perf_counter() - start < args.duration:
+            next_at += random.expovariate(args.rate)
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await onebot.push_event(self.next_event(onebot))
+
+        # 等待还没回复的命令，超过timeout的记为丢失
+        deadline = time.perf_counter() + args.timeout
+        while any(self.pending.values()) and time.perf_counter() < deadline:
+            await asyncio.sleep(0.1)
+        self.dropped = sum(len(queue) for queue in self.pending.values())
+
+        for task in tasks:
+            task.cancel()
+        await onebot.stop()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def report(self):
+        def ms(values, pct):
+            return f"{percentile(values, pct) * 1000:.1f}ms" if values else "-"
+
+        print("\n注入事件: " + ", ".join(f"{k}={v}" for k, v in self.sent.items()))
+        print(f"命令回复: {len(self.ack_latency)} 条, p50 {ms(self.ack_latency, 50)}, p95 {ms(self.ack_latency, 95)}, "
+              f"p99 {ms(self.ack_latency, 99)}, 最大 {ms(self.ack_latency, 100)}")
+        print(f"迟到(>{self.args.late_ms}ms): {self.late} 条, 丢失(>{self.args.timeout}s未回复): {self.dropped} 条")
+        print(f"call_onebot_api: {len(self.api_latency)} 次, p50 {ms(self.api_latency, 50)}, "
+              f"p95 {ms(self.api_latency, 95)}, 失败 {self.api_failures} 次")
+        print(f"事件循环延迟: p50 {ms(self.loop_lag, 50)}, p95 {ms(self.loop_lag, 95)}, 最大 {ms(self.loop_lag, 100)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JM机器人消息链路压测")
+    parser.add_argument("--groups", type=int, default=100, help="模拟的群数量")
+    parser.add_argument("--users", type=int, default=1000, help="模拟的用户数量")
+    parser.add_argument("--first-group", type=int, default=900000)
+    parser.add_argument("--rate", type=float, default=50, help="每秒注入的事件数（泊松分布）")
+    parser.add_argument("--duration", type=float, default=30, help="注入持续时间（秒）")
+    parser.add_argument("--mix", default="jm=2,help=1,noise=97", help="事件类型比例")
+    parser.add_argument("--port", type=int, default=18092)
+    parser.add_argument("--api-latency", type=float, default=0.02, help="假OneBot回复延迟（秒）")
+    parser.add_argument("--api-jitter", type=float, default=0.03, help="回复延迟的随机抖动（秒）")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="API调用返回失败的比例")
+    parser.add_argument("--workers", type=int, default=bot.WORKER_CONCURRENCY, help="下载worker数量")
+    parser.add_argument("--job-seconds", type=float, default=2.0, help="模拟每个下载任务耗时（秒）")
+    parser.add_argument("--no-limits", action="store_true", help="关闭限流和冷却")
+    parser.add_argument("--late-ms", type=float, default=500, help="超过多少毫秒算迟到")
+    parser.add_argument("--timeout", type=float, default=10, help="注入结束后最多等待多少秒")
+    args = parser.parse_args()
+
+    test = LoadTest(args)
+    asyncio.run(test.run())
+    test.report()
+
+
+if __name__ == '__main__':
+    main()
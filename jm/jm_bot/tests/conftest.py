@@ -0,0 +1,22 @@
+"""测试共用的准备：机器人的下载目录、状态数据库和日志都放在临时目录里"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot
+
+
+@pytest.fixture(scope="session", autouse=True)
+def data_dir(tmp_path_factory):
+    path = tmp_path_factory.mktemp("jm_bot")
+    bot.STORAGE_BACKEND = 'sqlite'
+    bot.init(str(path))
+    return path
+
+
+@pytest.fixture
+def free_port():
+    return bot.find_free_port(20000)
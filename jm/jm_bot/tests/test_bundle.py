@@ -0,0 +1,44 @@
+import zipfile
+
+import pyzipper
+import pytest
+
+import bot
+
+
+def test_ezip_bundle_is_encrypted_with_zip_password(tmp_path):
+    member = tmp_path / "123.zip"
+    member.write_bytes(b"inner")
+    bundle = str(tmp_path / "bundle.zip")
+    bot.build_bundle([(str(member), bot.artifact_name("123", 'ezip'))], bundle, bot.ZIP_PASSWORD)
+
+    with zipfile.ZipFile(bundle) as zipf:
+        with pytest.raises(RuntimeError):
+            zipf.read(zipf.namelist()[0])
+    with pyzipper.AESZipFile(bundle) as zipf:
+        zipf.setpassword(bot.ZIP_PASSWORD.encode('utf-8'))
+        assert zipf.read(bot.artifact_name("123", 'ezip')) == b"inner"
+
+
+def test_plain_bundle_has_no_password(tmp_path):
+    member = tmp_path / "123.pdf"
+    member.write_bytes(b"pdf")
+    bundle = str(tmp_path / "bundle.zip")
+    bot.build_bundle([(str(member), bot.artifact_name("123", 'pdf'))], bundle)
+
+    with zipfile.ZipFile(bundle) as zipf:
+        assert zipf.read("【123】.pdf") == b"pdf"
+
+
+def test_ezip_cache_is_keyed_by_password(monkeypatch):
+    password = bot.ZIP_PASSWORD
+    # 运行中改密码不生效，只能重启
+    bot.apply_config(dict(bot.CONFIG, files={'password': password + "new"}))
+    assert bot.ZIP_PASSWORD == password
+    assert ('files', 'password') in bot.RESTART_SETTINGS
+
+    key, path = bot.artifact_key("123", 'ezip'), bot.artifact_path("123", 'ezip')
+    monkeypatch.setattr(bot, 'ZIP_PASSWORD_TAG', "othertag")
+    assert bot.artifact_key("123", 'ezip') != key
+    assert bot.artifact_path("123", 'ezip') != path
+    assert bot.artifact_key("123", 'pdf') == "123.pdf"
@@ -0,0 +1,62 @@
+import asyncio
+import os
+import time
+
+import bot
+
+
+def touch(path: str, mtime: float, is_dir: bool = False) -> str:
+    if is_dir:
+        os.makedirs(path)
+    else:
+        with open(path, 'wb') as f:
+            f.write(b'data')
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_cleanup_removes_files_left_by_dead_workers():
+    now = time.time()
+    old = now - bot.WORKER_STALE_AFTER - 60
+    bot.BACKEND.heartbeat("other-host-2")
+
+    dead_dir = touch(os.path.join(bot.DOWNLOAD_DIR, "other-host-1_7"), old, is_dir=True)
+    live_dir = touch(os.path.join(bot.DOWNLOAD_DIR, "other-host-2_8"), old, is_dir=True)
+    own_dir = touch(os.path.join(bot.DOWNLOAD_DIR, f"{bot.WORKER_ID}_9"), old, is_dir=True)
+    crashed_tmp = touch(os.path.join(bot.PDF_DIR, "123.other-host-1.tmp.pdf"), old)
+    unindexed = touch(os.path.join(bot.ZIP_DIR, "456.cbz"), old)
+    writing_tmp = touch(os.path.join(bot.ZIP_DIR, "789.zip.other-host-2.tmp"), now)
+    indexed = touch(os.path.join(bot.PDF_DIR, "321.pdf"), old)
+    bot.BACKEND.put_artifact("321.pdf", indexed, 4)
+
+    asyncio.run(bot.cleanup_expired(now))
+
+    assert not os.path.exists(dead_dir)
+    assert not os.path.exists(crashed_tmp)
+    assert not os.path.exists(unindexed)
+    assert os.path.exists(live_dir)
+    assert os.path.exists(own_dir)
+    assert os.path.exists(writing_tmp)
+    assert os.path.exists(indexed)
+
+
+def test_cleanup_keeps_artifact_leased_by_another_process(monkeypatch):
+    monkeypatch.setattr(bot, 'ARTIFACT_TTL', -1)
+    now = time.time()
+    path = touch(os.path.join(bot.PDF_DIR, "654.pdf"), now)
+    bot.BACKEND.put_artifact("654.pdf", path, 4)
+    job_id = bot.BACKEND.enqueue_job({"key": "654.pdf", "jm_ids": ["654"], "fmt": "pdf", "group_id": 61, "user_id": 2})
+    assert bot.BACKEND.claim_job("other-host-3", [])['id'] == job_id
+    bot.BACKEND.lease_artifact("654.pdf", job_id)
+
+    # 过期了，但另一个进程正在上传
+    asyncio.run(bot.cleanup_expired(now))
+    assert os.path.exists(path)
+    assert bot.BACKEND.get_artifact("654.pdf") is not None
+
+    # 任务结束时没有释放租约（进程崩溃），清理时由prune释放，下一轮删除
+    bot.BACKEND.finish_job(job_id)
+    asyncio.run(bot.cleanup_expired(now))
+    asyncio.run(bot.cleanup_expired(now))
+    assert not os.path.exists(path)
+    assert bot.BACKEND.get_artifact("654.pdf") is None
@@ -0,0 +1,36 @@
+import asyncio
+
+import pytest
+
+import bot
+
+
+@pytest.mark.parametrize("message, jm_ids, fmt", [
+    ("/jm 123", "123", None),
+    ("/jm 123 456", "123 456", None),
+    (" /jm 123 pdf ", "123", "pdf"),
+    ("/jm\t123\t加密", "123", "加密"),
+])
+def test_command_pattern_accepts(message, jm_ids, fmt):
+    match = bot.JM_COMMAND_PATTERN.fullmatch(message)
+    assert match.group(1).split() == jm_ids.split()
+    assert match.group(2) == fmt
+
+
+@pytest.mark.parametrize("message, reply", [
+    ("/jm 123abc", "用法"),
+    ("/jm 123 pdf xyz", "用法"),
+    ("/jm abc", "用法"),
+    ("/jm 123 xyz", "不支持的格式：xyz"),
+])
+def test_malformed_command_is_rejected(monkeypatch, message, reply):
+    sent = []
+
+    async def send_group_message(group_id, text):
+        sent.append(text)
+
+    monkeypatch.setattr(bot, 'send_group_message', send_group_message)
+    asyncio.run(bot.handle_jm_command(message, 41, 2))
+
+    assert len(sent) == 1 and sent[0].startswith(reply)
+    assert bot.BACKEND.list_jobs(41) == []
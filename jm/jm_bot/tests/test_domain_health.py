@@ -0,0 +1,69 @@
+import asyncio
+
+import bot
+from fake_servers import FakeMirror
+
+
+def mirror_with(free_port: int, *settings: dict):
+    mirror = FakeMirror()
+    domains = []
+    port = free_port
+    for item in settings:
+        domains.append(mirror.add_domain(port, **item))
+        port = bot.find_free_port(port + 1)
+    return mirror, domains
+
+
+async def probe(health: bot.DomainHealth, times: int = 1) -> list:
+    for _ in range(times):
+        ranked = await health.probe_all()
+    return ranked
+
+
+def test_ranking_prefers_fast_healthy_domain(free_port):
+    mirror, (slow, failing, fast) = mirror_with(
+        free_port,
+        {"latency": 0.2},
+        {"error_rate": 1.0},
+        {"latency": 0.0}
+    )
+    health = bot.DomainHealth({"scheme": "http", "domains": [slow, failing, fast], "probe_timeout": 2})
+
+    async def main():
+        await mirror.start()
+        try:
+            assert await probe(health, times=2) == [fast, slow, failing]
+        finally:
+            await mirror.stop()
+
+    asyncio.run(main())
+    # 没探测过的域名排在健康域名之后、故障域名之前
+    assert health.ranked(["127.0.0.1:1", failing, slow]) == [slow, "127.0.0.1:1", failing]
+
+
+def test_failing_domain_is_demoted_then_recovered_by_probing(free_port):
+    mirror, (flaky, backup) = mirror_with(
+        free_port,
+        {"latency": 0.0},
+        {"latency": 0.05}
+    )
+    health = bot.DomainHealth({"scheme": "http", "domains": [flaky, backup], "probe_timeout": 0.2})
+
+    async def main():
+        await mirror.start()
+        try:
+            assert await probe(health) == [flaky, backup]
+
+            # 下载中途出错和探测失败都会让域名降级
+            health.observe(flaky, None, False)
+            mirror.set_domain(flaky, error_rate=1.0)
+            assert await probe(health, times=2) == [backup, flaky]
+            assert dict(health.report())[flaky]["error_rate"] >= health.unhealthy_error_rate
+
+            mirror.set_domain(flaky, error_rate=0.0)
+            assert await probe(health, times=10) == [flaky, backup]
+            assert dict(health.report())[flaky]["error_rate"] < health.unhealthy_error_rate
+        finally:
+            await mirror.stop()
+
+    asyncio.run(main())
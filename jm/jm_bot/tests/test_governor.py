@@ -0,0 +1,36 @@
+import asyncio
+import copy
+
+import pytest
+
+import bot
+from fake_servers import FakeMirror
+
+
+@pytest.mark.parametrize("retry_times, limit", [(2, 1), (0, 4)])
+def test_throttled_images_lower_concurrency(monkeypatch, free_port, tmp_path, retry_times, limit):
+    monkeypatch.setattr(bot, 'GOVERNOR', bot.DownloadGovernor({'max_concurrency': 8, 'min_concurrency': 1, 'max_backoff': 0}))
+    mirror = FakeMirror()
+    domain = mirror.add_domain(free_port, error_rate=1.0, status=429)
+    mirror.set_image(b'\xff\xd8' + b'\0' * 64)
+    # 显式给出域名，构造客户端时不用联网获取
+    option_data = copy.deepcopy(bot.JM_OPTION_DATA)
+    option_data['client'] = {'impl': 'html', 'domain': [domain], 'retry_times': retry_times}
+    monkeypatch.setattr(bot, 'JM_OPTION_DATA', option_data)
+
+    def fetch():
+        client = bot.GovernedDownloader(bot.create_jm_option(str(tmp_path))).client
+        with pytest.raises(Exception):
+            client.get_jm_image(f"http://{domain}/media/photos/1/00001.jpg")
+
+    async def main():
+        await mirror.start()
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, fetch)
+        finally:
+            await mirror.stop()
+
+    asyncio.run(main())
+    stats = bot.GOVERNOR.stats()
+    assert stats['throttled'] == retry_times + 1
+    assert stats['limit'] == limit
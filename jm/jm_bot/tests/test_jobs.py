@@ -0,0 +1,57 @@
+import asyncio
+import time
+
+import pytest
+
+import bot
+
+
+def enqueue(jm_id: str, group_id: int = 1, self_id=None, created=None) -> int:
+    return bot.BACKEND.enqueue_job({
+        "key": f"{jm_id}.pdf",
+        "jm_ids": [jm_id],
+        "fmt": "pdf",
+        "group_id": group_id,
+        "user_id": 2,
+        "self_id": self_id,
+        "created": time.time() if created is None else created
+    })
+
+
+def test_cancelled_worker_puts_job_back(monkeypatch):
+    started = []
+
+    async def slow_job(job):
+        started.append(job['id'])
+        await asyncio.sleep(3600)
+
+    monkeypatch.setattr(bot, 'process_job', slow_job)
+    job_id = enqueue("111", group_id=31)
+
+    async def main():
+        worker = asyncio.create_task(bot.worker_loop(0))
+        while not started:
+            await asyncio.sleep(0.01)
+        worker.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await worker
+
+    asyncio.run(main())
+    assert [(job['id'], job['status']) for job in bot.BACKEND.list_jobs(31)] == [(job_id, 'queued')]
+    bot.BACKEND.finish_job(job_id)
+
+
+def test_job_for_vanished_account_is_rebound():
+    now = time.time()
+    job_id = enqueue("222", group_id=32, self_id=123, created=now - bot.WORKER_REBIND_AFTER - 1)
+    fresh_id = enqueue("333", group_id=32, self_id=123, created=now)
+
+    assert bot.BACKEND.claim_job("test-worker", []) is None
+    bot.BACKEND.prune(now)
+    job = bot.BACKEND.claim_job("test-worker", [])
+    assert job['id'] == job_id
+    assert job['self_id'] is None
+    assert bot.BACKEND.claim_job("test-worker", []) is None
+
+    bot.BACKEND.finish_job(job_id)
+    bot.BACKEND.finish_job(fresh_id)
@@ -0,0 +1,36 @@
+import asyncio
+
+import bot
+
+
+def test_progress_is_synced_only_when_it_changes(monkeypatch):
+    synced = []
+    sent = []
+
+    def update_progress(job_id, snapshot):
+        synced.append(snapshot)
+
+    async def send_group_message(group_id, text):
+        sent.append(text)
+
+    monkeypatch.setattr(bot.BACKEND, 'update_progress', update_progress)
+    monkeypatch.setattr(bot, 'send_group_message', send_group_message)
+    monkeypatch.setattr(bot, 'PROGRESS_SYNC_INTERVAL', 0)
+    # 阶段变化后的群消息被最小间隔压住，期间不能每秒都重写共享状态
+    monkeypatch.setattr(bot, 'PROGRESS_MIN_INTERVAL', 3600)
+    progress = bot.JobProgress({"id": 1, "jm_ids": ["123"], "group_id": 51})
+
+    async def main():
+        reporter = asyncio.create_task(bot.report_progress(progress))
+        progress.set_stage('download')
+        await asyncio.sleep(2.5)
+        progress.pages_total = 10
+        progress.pages_done = 1
+        await asyncio.sleep(1)
+        reporter.cancel()
+
+    asyncio.run(main())
+    assert [(s['stage'], s['pages_done']) for s in synced] == [('download', 0), ('download', 1)]
+    assert sent == []
+    job = {"jm_ids": ["123"], "progress": synced[-1]}
+    assert bot.describe_job(job).startswith("JM123 下载中 1/10页（10%），已用时 ")
@@ -0,0 +1,75 @@
+import pytest
+
+import bot
+
+
+def test_token_bucket_refills_up_to_capacity():
+    bucket = bot.TokenBucket(rate=1, capacity=3, now=0)
+    bucket.take(3)
+    assert bucket.wait_time(0) == 1
+    assert bucket.wait_time(0.5, amount=2) == 1.5
+    assert bucket.wait_time(2) == 0
+    assert bucket.tokens == 2
+    assert bucket.is_full(100) and bucket.tokens == 3
+
+    bucket.resize(rate=2, capacity=1, now=100)
+    assert bucket.tokens == 1
+    assert bot.TokenBucket(rate=0, capacity=0, now=0).wait_time(0) == float('inf')
+
+
+@pytest.fixture
+def limiter(monkeypatch):
+    monkeypatch.setattr(bot, 'ADMIN_QQ_NUMBERS', [1])
+    return bot.RateLimiter({
+        'user': {'per_minute': 60, 'burst': 2},
+        'group': {'per_minute': 60, 'burst': 3},
+        'global': {'per_minute': 600, 'burst': 100}
+    })
+
+
+def test_user_then_group_limit(limiter):
+    assert limiter.check(10, 100, now=0) == (0, None)
+    assert limiter.check(10, 100, now=0) == (0, None)
+    wait, scope = limiter.check(10, 100, now=0)
+    assert scope == 'user' and wait == pytest.approx(1)
+
+    assert limiter.check(10, 101, now=0) == (0, None)
+    wait, scope = limiter.check(10, 102, now=0)
+    assert scope == 'group' and wait == pytest.approx(1)
+    # 被拒绝的请求不扣令牌
+    assert limiter.check(11, 102, now=0) == (0, None)
+    # 管理员不受限
+    assert limiter.check(10, 1, now=0) == (0, None)
+
+
+def test_batch_charges_one_token_per_album(limiter):
+    assert limiter.check(20, 200, now=0, amount=2) == (0, None)
+    wait, scope = limiter.check(20, 201, now=0, amount=2)
+    assert scope == 'group' and wait == pytest.approx(1)
+    # 超过容量的批量按容量计算，等桶满了仍能放行
+    assert limiter.check(21, 202, now=0, amount=5)[1] is None
+    assert limiter.users[202].tokens == 0 and limiter.groups[21].tokens == 0
+
+
+def test_idle_full_buckets_are_evicted_oldest_first(limiter):
+    limiter.max_entries = 2
+    for user_id in (300, 301, 302):
+        limiter.check(30, user_id, now=0)
+    assert list(limiter.users) == [301, 302]
+
+    # 已经攒满的桶即使没超过上限也会从头部淘汰，没攒满的保留
+    limiter.check(31, 303, now=1.5)
+    assert list(limiter.users) == [303]
+    limiter.check(31, 304, now=1.6)
+    assert list(limiter.users) == [303, 304]
+
+
+@pytest.mark.parametrize("limit, valid", [
+    ({'per_minute': 2, 'burst': 3}, True),
+    ({'per_minute': 0, 'burst': 0}, True),
+    ({'per_minute': 2, 'burst': 0}, False),
+    ({'per_minute': -1}, False),
+])
+def test_validate_ratelimit(limit, valid):
+    errors = [e for e in bot.validate_config({'ratelimit': {'user': limit}}) if e.startswith('ratelimit')]
+    assert (errors == []) == valid
@@ -0,0 +1,65 @@
+import os
+import types
+import xml.etree.ElementTree as ET
+import zipfile
+
+from PIL import Image
+
+import bot
+
+
+def make_pages(directory, names) -> list:
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i, name in enumerate(names):
+        path = os.path.join(directory, name)
+        Image.new("RGB", (8, 12), (i * 20 % 256, 0, 0)).save(path)
+        paths.append(path)
+    return paths
+
+
+def test_pdf_render_progress_reaches_total(tmp_path):
+    pages = make_pages(tmp_path / "album", ["1.jpg", "2.jpg", "3.jpg"])
+    progress = bot.JobProgress({"id": 1, "jm_ids": ["1"], "group_id": 91})
+
+    bot.all2PDF(pages, str(tmp_path), "out", progress)
+
+    assert os.path.exists(tmp_path / "out.pdf")
+    assert progress.render_done == progress.render_total == 3
+
+
+def test_scan_pages_uses_natural_and_chapter_order(tmp_path):
+    album = tmp_path / "album"
+    second = make_pages(album / "第2话", ["10.jpg", "2.jpg", "1.jpg"])
+    first = make_pages(album / "第10话", ["3.png"])
+    extra = make_pages(album / "其他", ["1.webp"])
+    (album / "第2话" / "notes.txt").write_text("not a page")
+
+    # jmcomic给出的章节顺序优先于目录名，不在其中的目录排在最后
+    pages = bot.scan_pages(str(album), [str(album / "第10话"), str(album / "第2话")])
+    assert pages == first + [second[2], second[1], second[0]] + extra
+
+    # 没有章节顺序时按目录名自然排序
+    pages = [page for page in bot.scan_pages(str(album)) if page not in extra]
+    assert pages == [second[2], second[1], second[0]] + first
+
+
+def test_cbz_is_stored_with_ordered_pages_and_comic_info(tmp_path):
+    album_dir = tmp_path / "album"
+    pages = make_pages(album_dir / "第1话", ["1.jpg", "2.png"]) + make_pages(album_dir / "第2话", ["1.JPG"])
+    album = types.SimpleNamespace(name="测试本子", author="作者", tags=["a", "b"], album_id="777")
+    cbz = str(tmp_path / "777.cbz")
+
+    assert bot.build_image_zip("777", str(album_dir), cbz, pages=pages, album=album) == cbz
+
+    with zipfile.ZipFile(cbz) as zipf:
+        infos = zipf.infolist()
+        assert all(info.compress_type == zipfile.ZIP_STORED for info in infos)
+        assert [info.filename for info in infos] == ["0001.jpg", "0002.png", "0003.jpg", "ComicInfo.xml"]
+        with open(pages[1], 'rb') as f:
+            assert zipf.read("0002.png") == f.read()
+        info = ET.fromstring(zipf.read("ComicInfo.xml"))
+    assert info.findtext("PageCount") == "3"
+    assert info.findtext("Title") == "测试本子"
+    assert info.findtext("Notes") == "JM777"
+    assert not [name for name in os.listdir(tmp_path) if ".tmp" in name]
@@ -0,0 +1,58 @@
+import asyncio
+import json
+import os
+
+import bot
+
+
+def test_saves_are_debounced_into_one_write(tmp_path, monkeypatch):
+    state = bot.JsonStateFile(str(tmp_path / "state.json"), delay=0.2)
+    writes = []
+    write_now = state.write_now
+    monkeypatch.setattr(state, 'write_now', lambda data: writes.append(data) or write_now(data))
+
+    async def main():
+        for groups in ([1], [1, 2], [1, 2, 3]):
+            state.save(groups)
+        await asyncio.sleep(0.05)
+        assert not os.path.exists(state.path)
+        await asyncio.sleep(0.4)
+
+    asyncio.run(main())
+    assert writes == [[1, 2, 3]]
+    with open(state.path) as f:
+        assert json.load(f) == [1, 2, 3]
+
+
+def test_flush_writes_pending_changes(tmp_path):
+    state = bot.JsonStateFile(str(tmp_path / "state.json"), delay=3600)
+
+    async def main():
+        state.save([5])
+
+    asyncio.run(main())
+    state.flush()
+    with open(state.path) as f:
+        assert json.load(f) == [5]
+
+
+def test_failed_write_keeps_previous_file(tmp_path):
+    state = bot.JsonStateFile(str(tmp_path / "state.json"))
+    assert state.write_now([1, 2])
+    # 写到一半失败时旧文件不变，也不留下临时文件
+    assert not state.write_now([3, object()])
+    with open(state.path) as f:
+        assert json.load(f) == [1, 2]
+    assert os.listdir(tmp_path) == ["state.json"]
+
+
+def test_truncated_file_loads_as_empty(tmp_path, monkeypatch):
+    state = bot.JsonStateFile(str(tmp_path / "enabled_groups.json"))
+    monkeypatch.setattr(bot, 'ENABLED_GROUPS_STATE', state)
+    with open(state.path, 'w') as f:
+        f.write('[1, 2')
+    assert bot.load_enabled_groups() == set()
+
+    with open(state.path, 'w') as f:
+        f.write('[1, 2]')
+    assert bot.load_enabled_groups() == {1, 2}
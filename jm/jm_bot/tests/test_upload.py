@@ -0,0 +1,190 @@
+import asyncio
+import hashlib
+import os
+
+import pytest
+
+import bot
+from fake_servers import FakeOneBot
+
+GROUP_ID = 71
+
+
+@pytest.fixture
+def payload_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, 'UPLOAD_MODE', 'stream')
+    monkeypatch.setattr(bot, 'UPLOAD_CHUNK_SIZE', 64 * 1024)
+    monkeypatch.setattr(bot, 'UPLOAD_CONCURRENCY', 2)
+    monkeypatch.setattr(bot, 'STREAM_UNSUPPORTED', set())
+    monkeypatch.setattr(bot, 'UPLOAD_SESSIONS', {})
+    monkeypatch.setattr(bot, 'GROUP_ACCOUNTS', {})
+    path = tmp_path / "upload.zip"
+    path.write_bytes(os.urandom(16 * 64 * 1024 + 123))
+    return str(path)
+
+
+async def connect(onebot: FakeOneBot) -> asyncio.Task:
+    task = asyncio.create_task(bot.connect_websocket({"host": onebot.host, "port": onebot.port}))
+    while onebot.self_id not in bot.BOT_CONNECTIONS:
+        await asyncio.sleep(0.01)
+    bot.GROUP_ACCOUNTS[GROUP_ID] = {onebot.self_id}
+    return task
+
+
+def chunk_calls(onebot: FakeOneBot) -> list:
+    return [call['params'] for _, call in onebot.calls
+            if call['action'] == 'upload_file_stream' and not call['params'].get('is_complete')]
+
+
+def run_upload(free_port, test, **settings):
+    onebot = FakeOneBot(port=free_port, **settings)
+
+    async def main():
+        await onebot.start()
+        tasks = []
+        try:
+            await test(onebot, tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await onebot.stop()
+
+    asyncio.run(main())
+    return onebot
+
+
+def test_chunked_upload_completes_with_file_hash(free_port, payload_file):
+    async def test(onebot, tasks):
+        tasks.append(await connect(onebot))
+        record = await bot.upload_group_file(GROUP_ID, payload_file, "upload.zip")
+        assert record['file_id'] == onebot.uploads[-1]['file_id']
+
+    onebot = run_upload(free_port, test, latency=0.01, jitter=0.01)
+    with open(payload_file, 'rb') as f:
+        data = f.read()
+    assert onebot.uploads[-1]['data'] == data
+    chunks = chunk_calls(onebot)
+    assert len(chunks) == 17
+    assert {c['expected_sha256'] for c in chunks} == {hashlib.sha256(data).hexdigest()}
+
+
+def test_upload_resumes_after_disconnect(free_port, payload_file, monkeypatch):
+    monkeypatch.setattr(bot, 'UPLOAD_RETRIES', 0)
+
+    async def test(onebot, tasks):
+        def on_call(received, call):
+            if len(chunk_calls(onebot)) == 6:
+                asyncio.create_task(onebot.disconnect())
+
+        onebot.on_call = on_call
+        tasks.append(await connect(onebot))
+        assert await bot.upload_group_file(GROUP_ID, payload_file, "upload.zip") is None
+        session, = bot.UPLOAD_SESSIONS.values()
+        acked = len(session.acked)
+        assert 0 < acked < session.total_chunks
+
+        onebot.on_call = None
+        sent = len(chunk_calls(onebot))
+        while onebot.self_id in bot.BOT_CONNECTIONS:
+            await asyncio.sleep(0.01)
+        tasks.append(await connect(onebot))
+        assert await bot.upload_group_file(GROUP_ID, payload_file, "upload.zip") is not None
+        # 只补发没确认的分片，沿用同一个stream_id
+        resent = chunk_calls(onebot)[sent:]
+        assert len(resent) == session.total_chunks - acked
+        assert {c['stream_id'] for c in resent} == {session.stream_id}
+
+    onebot = run_upload(free_port, test, latency=0.05)
+    with open(payload_file, 'rb') as f:
+        assert onebot.uploads[-1]['data'] == f.read()
+    assert bot.UPLOAD_SESSIONS == {}
+
+
+def test_resume_restarts_when_chunk_size_changes(free_port, payload_file, monkeypatch):
+    monkeypatch.setattr(bot, 'UPLOAD_RETRIES', 0)
+
+    async def test(onebot, tasks):
+        def on_call(received, call):
+            if len(chunk_calls(onebot)) == 6:
+                asyncio.create_task(onebot.disconnect())
+
+        onebot.on_call = on_call
+        tasks.append(await connect(onebot))
+        assert await bot.upload_group_file(GROUP_ID, payload_file, "upload.zip") is None
+        old, = bot.UPLOAD_SESSIONS.values()
+
+        # 断线期间重载了配置，旧会话的分片编号不能接着用
+        onebot.on_call = None
+        bot.UPLOAD_CHUNK_SIZE = 128 * 1024
+        sent = len(chunk_calls(onebot))
+        while onebot.self_id in bot.BOT_CONNECTIONS:
+            await asyncio.sleep(0.01)
+        tasks.append(await connect(onebot))
+        assert await bot.upload_group_file(GROUP_ID, payload_file, "upload.zip") is not None
+        resent = chunk_calls(onebot)[sent:]
+        assert len(resent) == 9
+        assert old.stream_id not in {c['stream_id'] for c in resent}
+
+    onebot = run_upload(free_port, test, latency=0.05)
+    with open(payload_file, 'rb') as f:
+        assert onebot.uploads[-1]['data'] == f.read()
+
+
+def test_upload_falls_back_when_stream_api_is_unsupported(free_port, payload_file):
+    async def test(onebot, tasks):
+        tasks.append(await connect(onebot))
+        record = await bot.upload_group_file(GROUP_ID, payload_file, "upload.zip")
+        assert record is not None and record['message_id'] is not None
+
+    onebot = run_upload(free_port, test, stream_support=False)
+    actions = [call['action'] for _, call in onebot.calls]
+    # 并发的分片请求都收到1404后改发文件消息
+    assert 'upload_file_stream' in actions
+    assert [action for action in actions if action != 'upload_file_stream'] == ['send_group_msg']
+    assert onebot.uploads == []
+    assert bot.STREAM_UNSUPPORTED == {onebot.self_id}
+
+
+def sent_messages(onebot: FakeOneBot, group_id: int) -> list:
+    return [call['params']['message'] for _, call in onebot.calls
+            if call['action'] in ('send_msg', 'send_group_msg') and call['params']['group_id'] == group_id]
+
+
+def test_share_uploaded_file(free_port, payload_file, monkeypatch):
+    monkeypatch.setattr(bot, 'UPLOAD_REUSE', True)
+    other_group = GROUP_ID + 1
+
+    async def test(onebot, tasks):
+        tasks.append(await connect(onebot))
+        record = await bot.upload_group_file(GROUP_ID, payload_file, "【901】.pdf")
+        await bot.record_upload("901", "pdf", record)
+
+        # 本群的群文件还在，只提示不重复上传
+        assert await bot.share_uploaded_file(GROUP_ID, "901", "pdf")
+        assert "已在本群群文件中" in sent_messages(onebot, GROUP_ID)[-1]
+
+        # 其他群：没有消息id，从群文件链接转存，并记下本群的新记录
+        assert await bot.share_uploaded_file(other_group, "901", "pdf")
+        file_message, = sent_messages(onebot, other_group)
+        assert file_message[0]['data']['file'] == f"https://fake.qq/ftn{record['file_id']}"
+        assert {r['group_id'] for r in bot.BACKEND.get_uploads("901.pdf")} == {GROUP_ID, other_group}
+
+        # 同一账号发过的文件消息直接转发
+        await bot.record_upload("902", "pdf", dict(record, file_id=None, message_id=42))
+        assert await bot.share_uploaded_file(other_group, "902", "pdf")
+        forward = [call['params'] for _, call in onebot.calls if call['action'] == 'forward_group_single_msg']
+        assert forward == [{"group_id": other_group, "message_id": 42}]
+
+        # 群文件已经被删、又不能转发的记录作废，回到正常上传流程
+        await bot.record_upload("903", "pdf", dict(record, file_id="/deleted", message_id=None))
+        assert not await bot.share_uploaded_file(other_group, "903", "pdf")
+        assert bot.BACKEND.get_uploads("903.pdf") == []
+
+        # 超过复用期限的记录直接跳过
+        await bot.record_upload("904", "pdf", dict(record, time=record['time'] - bot.UPLOAD_REUSE_TTL - 1))
+        calls = len(onebot.calls)
+        assert not await bot.share_uploaded_file(GROUP_ID, "904", "pdf")
+        assert len(onebot.calls) == calls
+
+    run_upload(free_port, test)
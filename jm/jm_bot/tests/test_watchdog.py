@@ -0,0 +1,171 @@
+import asyncio
+import os
+import threading
+import time
+
+import pytest
+
+import bot
+
+
+def make_progress(job_id: int) -> bot.JobProgress:
+    return bot.JobProgress({"id": job_id, "jm_ids": [str(job_id)], "group_id": 81})
+
+
+def test_waiting_for_space_is_not_a_stall():
+    watchdog = bot.JobWatchdog({'stall_timeout': 10, 'download_timeout': 0})
+    progress = make_progress(1)
+    progress.set_stage('space')
+    now = time.time()
+
+    assert watchdog.overdue(progress, now) is None
+    assert watchdog.overdue(progress, now + 100) is None
+    # 回到下载阶段后重新计时
+    progress.set_stage('download')
+    assert watchdog.overdue(progress, now + 200) is None
+    assert watchdog.overdue(progress, now + 205) is None
+    assert watchdog.overdue(progress, now + 211) is not None
+
+    progress.set_stage('save')
+    assert watchdog.overdue(progress, now + 300) is None
+
+
+def test_cancel_wakes_job_waiting_for_space(monkeypatch, tmp_path):
+    scratch = bot.ScratchSpace({'dirs': [str(tmp_path)], 'wait': 60, 'reserve': 0})
+    # 空间全部被其他任务预留，只能等待
+    scratch.reserved[os.stat(tmp_path).st_dev] = 1 << 60
+    monkeypatch.setattr(bot, 'SCRATCH', scratch)
+    progress = make_progress(2)
+    progress.set_stage('download')
+    errors = []
+
+    def acquire():
+        try:
+            scratch.acquire(10, 'pdf', str(tmp_path), progress)
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=acquire)
+    thread.start()
+    while progress.stage != 'space':
+        time.sleep(0.01)
+    progress.cancel("测试取消")
+    thread.join(5)
+
+    assert not thread.is_alive()
+    assert isinstance(errors[0], bot.JobCancelled)
+
+
+def test_pdf_cancelled_while_saving_is_discarded(monkeypatch, tmp_path):
+    progress = make_progress(3)
+
+    def slow_save(pages, pdfpath, pdfname, progress):
+        progress.set_stage('save')
+        with open(os.path.join(pdfpath, pdfname + ".pdf"), 'wb') as f:
+            f.write(b'%PDF')
+        progress.cancel("保存时被回收")
+
+    monkeypatch.setattr(bot, 'all2PDF', slow_save)
+    with pytest.raises(bot.JobCancelled):
+        bot.build_pdf("555", str(tmp_path), str(tmp_path / "555.pdf"), progress, ["page.jpg"])
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.parametrize("config, valid", [
+    ({}, True),
+    ({'scratch': {'wait': 300}}, False),
+    ({'scratch': {'wait': 300}, 'watchdog': {'stall_timeout': 600}}, True),
+    ({'scratch': {'wait': 300}, 'watchdog': {'stall_timeout': 0}}, True),
+])
+def test_scratch_wait_must_be_shorter_than_stall_timeout(config, valid):
+    errors = [e for e in bot.validate_config(config) if 'scratch.wait' in e]
+    assert (errors == []) == valid
+
+
+def test_hung_prefetch_is_recycled_and_waiters_are_released(monkeypatch, tmp_path):
+    release = threading.Event()
+
+    def hung_build(jm_id, fmt, job_dir, progress):
+        # 卡在单张图片里，不响应取消
+        progress.set_stage('download')
+        release.wait(10)
+
+    monkeypatch.setattr(bot, 'build_artifact', hung_build)
+    monkeypatch.setattr(bot, 'ARTIFACT_BUILDS', {})
+    monkeypatch.setattr(bot, 'PREFETCH_MIN_REQUESTS', 1)
+    monkeypatch.setattr(bot.BACKEND, 'top_requests', lambda since, n: [("950", "pdf", 9)])
+    watchdog = bot.JobWatchdog({'download_timeout': 0.2, 'stall_timeout': 0, 'grace': 0.2})
+    monkeypatch.setattr(bot, 'WATCHDOG', watchdog)
+
+    async def ready():
+        return True
+
+    monkeypatch.setattr(bot, 'prefetch_ready', ready)
+
+    async def main():
+        prefetch = asyncio.create_task(bot.run_prefetch())
+        while "950.pdf" not in bot.ARTIFACT_BUILDS:
+            await asyncio.sleep(0.01)
+        assert bot.JOB_PROGRESS["预取JM950"].stage == 'download'
+        waiter = asyncio.create_task(bot.get_or_build_artifact("950", "pdf", str(tmp_path), make_progress(5)))
+        try:
+            while not prefetch.done():
+                watchdog.check(time.time())
+                await asyncio.sleep(0.05)
+            await prefetch
+            with pytest.raises(bot.JobCancelled):
+                await waiter
+        finally:
+            release.set()
+
+    asyncio.run(main())
+    assert bot.ARTIFACT_BUILDS == {}
+    assert "预取JM950" not in bot.JOB_PROGRESS and watchdog.tasks == {}
+
+
+def test_waiting_for_shared_build_times_out(monkeypatch, tmp_path):
+    monkeypatch.setattr(bot, 'ARTIFACT_BUILDS', {})
+    watchdog = bot.JobWatchdog({'shared_timeout': 0.1})
+    progress = make_progress(6)
+
+    async def main():
+        bot.ARTIFACT_BUILDS["951.pdf"] = asyncio.get_running_loop().create_future()
+        waiter = asyncio.create_task(bot.get_or_build_artifact("951", "pdf", str(tmp_path), progress))
+        await asyncio.sleep(0.2)
+        assert progress.stage == 'shared'
+        assert watchdog.overdue(progress, time.time()) == "等待其他任务生成超时"
+        progress.cancel("等待其他任务生成超时")
+        with pytest.raises(bot.JobCancelled, match="超时"):
+            await waiter
+
+    asyncio.run(main())
+
+
+def test_albums_in_a_batch_have_their_own_deadlines(monkeypatch):
+    watchdog = bot.JobWatchdog({'stall_timeout': 10, 'queued_timeout': 5, 'save_timeout': 0, 'grace': 30})
+    progress = bot.JobProgress({"id": 7, "jm_ids": ["71", "72"], "group_id": 81})
+    monkeypatch.setitem(bot.JOB_PROGRESS, 7, progress)
+    progress.set_stage('prepare')
+    saving, stalled = progress.album("71"), progress.album("72")
+    saving.set_stage('save')
+    stalled.set_stage('download')
+    now = time.time()
+
+    watchdog.check(now)
+    # 另一个本子在保存，不能掩盖这个本子没有进度
+    watchdog.check(now + 11)
+    assert stalled.cancel_reason is not None and saving.cancel_reason is None
+    assert progress.cancel_reason is None
+    assert "JM71 保存文件中" in progress.summary()
+
+    # 取消后退出的本子不再计时，也不会触发回收
+    stalled.set_stage('done')
+    watchdog.check(now + 100)
+    assert 7 not in watchdog.recycled
+
+    # 子进度也受排队期限约束，整个任务取消时所有本子一起取消
+    queued = progress.album("73")
+    watchdog.check(queued.stage_started + 6)
+    assert queued.cancel_reason == "排队超时"
+    progress.cancel("测试取消")
+    assert saving.control.is_cancelled and progress.album("74").control.is_cancelled